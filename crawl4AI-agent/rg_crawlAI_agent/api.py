@@ -1,119 +1,305 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import os
+import re
+import logging
+import orjson
+import unicodedata
+import asyncio
+import httpx
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
 from supabase import create_client
 import uuid
 
 # Importación corregida para la ubicación actual
-from rg_pydantic_ai_expert import pydantic_ai_expert, PydanticAIDeps
+from rg_pydantic_ai_expert import pydantic_ai_expert, PydanticAIDeps, get_embedding
 
 load_dotenv()
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+# Clientes compartidos por todas las peticiones (reutilizan el pool de conexiones)
+openai_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "5")),  # Backoff exponencial en 429/5xx
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=500, max_keepalive_connections=100),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        http2=True  # Multiplexa peticiones concurrentes sobre la misma conexión
+    )
+)
+supabase = create_client(
+    os.getenv("SUPABASE_URL"),
+    os.getenv("SUPABASE_SERVICE_KEY")
+)
+
+# Limita las ejecuciones simultáneas del agente para no saturar los límites de OpenAI
+_RUN_SEMAPHORE = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_RUNS", "20")))
+
+# Similitud coseno mínima para reutilizar una respuesta de la caché semántica
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+
+# orjson serializa las respuestas (con chunks de documentación largos) bastante más rápido que json
+app = FastAPI(default_response_class=ORJSONResponse)
 
 class QueryRequest(BaseModel):
     query: str
     telegram_id: int = 0
     session_id: int = 0
 
-@app.post("/ask")
-async def ask_question(request: QueryRequest):
+async def lookup_semantic_cache(supabase, query_embedding):
+    """Devuelve la respuesta en caché más parecida a la consulta, o None."""
     try:
-        # Configurar clientes
-        openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        supabase = create_client(
-            os.getenv("SUPABASE_URL"),
-            os.getenv("SUPABASE_SERVICE_KEY")
+        # El cliente de Supabase es síncrono: se ejecuta en un hilo para no bloquear el event loop
+        result = await asyncio.to_thread(
+            supabase.rpc(
+                "match_semantic_cache",
+                {
+                    "query_embedding": query_embedding,
+                    "match_threshold": SEMANTIC_CACHE_THRESHOLD,
+                    "match_count": 1,
+                }
+            ).execute
         )
-        
-        # Extraer el ID de Telegram
-        telegram_id = request.telegram_id
-        
-        # Buscar el usuario en telegram_users
-        result = supabase.from_("telegram_users") \
-            .select("auth_user_id, is_activated") \
-            .eq("telegram_id", telegram_id) \
-            .execute()
-        
-        # Verificar si el usuario existe y está activado
-        if not result.data or not result.data[0]["is_activated"]:
-            return {"response": "Lo siento, tu cuenta no está activada. Por favor activa tu cuenta primero."}
-        
-        auth_user_id = result.data[0]["auth_user_id"]
-        
-        # Verificar suscripción
-        subscription = supabase.from_("subscriptions") \
-            .select("status, plan") \
-            .eq("user_id", auth_user_id) \
-            .eq("status", "active") \
-            .execute()
-        
-        if not subscription.data:
-            return {"response": "Tu suscripción no está activa. Por favor renueva tu suscripción."}
-        
-        # Crear dependencias
-        deps = PydanticAIDeps(
-            supabase=supabase,
-            openai_client=openai_client
+        return result.data[0] if result.data else None
+    except Exception as e:
+        print(f"Error consultando la caché semántica: {e}")
+        return None
+
+async def store_semantic_cache(supabase, query, query_embedding, answer):
+    """Guarda una respuesta nueva en la caché semántica."""
+    try:
+        await asyncio.to_thread(
+            supabase.table("semantic_cache").insert({
+                "query": query,
+                "query_embedding": query_embedding,
+                "answer": answer,
+                "sources": []
+            }).execute
         )
+    except Exception as e:
+        print(f"Error guardando en la caché semántica: {e}")
+
+ERROR_RESPONSE = "Lo siento, ocurrió un error al procesar tu consulta."
+
+# Respuestas fijas para mensajes que no necesitan embedding, búsqueda ni LLM
+GREETING_RESPONSE = (
+    "¡Hola! Soy tu asesor de comercio transfronterizo. Puedo ayudarte a vender en Amazon, "
+    "eBay y Etsy en Estados Unidos. ¿Qué te gustaría saber?"
+)
+THANKS_RESPONSE = "¡Con gusto! Si tienes otra pregunta sobre vender en Estados Unidos, aquí estoy."
+HELP_RESPONSE = (
+    "Puedo responder preguntas sobre envíos, impuestos, listados, configuración de cuentas "
+    "y pagos en Amazon, eBay y Etsy. Escribe tu pregunta con un poco de detalle."
+)
+
+DIRECT_RESPONSES = {
+    **dict.fromkeys(["hola", "hi", "hello", "hey", "buenas", "buenos dias", "buenas tardes", "buenas noches"], GREETING_RESPONSE),
+    **dict.fromkeys(["gracias", "muchas gracias", "ok", "okay", "vale", "perfecto", "thanks", "thank you"], THANKS_RESPONSE),
+    **dict.fromkeys(["ayuda", "help", "test", "prueba", "que puedes hacer"], HELP_RESPONSE),
+}
+
+_NON_WORD = re.compile(r"[^\w\s]")
+
+def normalize_query(query: str) -> str:
+    """Normaliza una consulta para compararla: minúsculas, sin acentos ni signos de puntuación."""
+    text = unicodedata.normalize("NFKD", query.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+def direct_response(query: str):
+    """Respuesta fija para saludos, agradecimientos o consultas vacías; None si hay que usar el agente."""
+    text = normalize_query(query)
+    if not text:
+        return HELP_RESPONSE
+    return DIRECT_RESPONSES.get(text)
+
+async def check_access(request: QueryRequest):
+    """
+    Verifica que el usuario pueda usar el agente y calcula el embedding de la consulta.
+
+    Returns:
+        Tupla (mensaje_de_rechazo, auth_user_id, query_embedding); el mensaje es None si tiene acceso
+    """
+    # Verificar usuario y suscripción (una sola RPC) en paralelo con el embedding de la consulta
+    access, query_embedding = await asyncio.gather(
+        asyncio.to_thread(
+            lambda: supabase.rpc("check_user_access", {"p_telegram_id": request.telegram_id}).execute()
+        ),
+        get_embedding(request.query, openai_client)
+    )
+    
+    # Verificar si el usuario existe y está activado
+    if not access.data or not access.data[0]["is_activated"]:
+        return "Lo siento, tu cuenta no está activada. Por favor activa tu cuenta primero.", None, query_embedding
+    
+    # Verificar suscripción
+    if not access.data[0]["has_active_sub"]:
+        return "Tu suscripción no está activa. Por favor renueva tu suscripción.", None, query_embedding
+    
+    return None, access.data[0]["auth_user_id"], query_embedding
+
+def build_deps() -> PydanticAIDeps:
+    """Crea las dependencias del agente para una petición."""
+    # El embedding de la consulta ya está en embedding_cache (lo calculó check_access),
+    # así que el agente lo reutiliza si busca con la consulta original
+    return PydanticAIDeps(
+        supabase=supabase,
+        openai_client=openai_client
+    )
+
+async def persist_conversation(auth_user_id, request: QueryRequest, response: str, total_tokens: int = 0, execution_time: float = 0):
+    """
+    Guarda la conversación con el auth_user_id y las métricas.
+    Se ejecuta como tarea en segundo plano, después de enviar la respuesta.
+    """
+    try:
+        await asyncio.to_thread(
+            supabase.table("user_conversations").insert({
+                "user_id": auth_user_id,  # Usamos el auth_user_id, no el telegram_id
+                "session_id": request.session_id,
+                "question": request.query,
+                "answer": response,
+                "marketplace": "general",
+                "sources": [],
+                "total_tokens": total_tokens,
+                "execution_time": execution_time
+            }).execute
+        )
+    except Exception as e:
+        print(f"Error guardando la conversación: {e}")
+
+def sse_frame(payload: dict) -> str:
+    """Formatea un evento Server-Sent Events."""
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+@app.post("/ask")
+async def ask_question(request: QueryRequest, background: BackgroundTasks):
+    try:
+        # Responder sin llamar a OpenAI a saludos y mensajes triviales
+        canned = direct_response(request.query)
+        if canned:
+            return {"response": canned}
         
-        # Ejecutar el agente
-        agent_result = await pydantic_ai_expert.run(request.query, deps=deps)
-        
-        # Extraer la respuesta de texto del resultado
-        try:
-            # Intentar obtener directamente el atributo 'data'
-            response = agent_result.data
-        except AttributeError:
-            # Si no existe 'data', usar un mensaje genérico
-            print("No se pudo extraer 'data' del resultado del agente")
-            response = "Lo siento, no pude procesar tu consulta correctamente."
+        denied, auth_user_id, query_embedding = await check_access(request)
+        if denied:
+            return {"response": denied}
         
         # Extraer métricas de uso
         total_tokens = 0
         execution_time = 0
 
-        # Obtener información de uso
-        if hasattr(agent_result, 'usage'):
+        # Buscar una respuesta previa a una pregunta semánticamente equivalente
+        cached = await lookup_semantic_cache(supabase, query_embedding) if any(query_embedding) else None
+
+        if cached:
+            response = cached["answer"]
+        else:
+            # Ejecutar el agente
+            async with _RUN_SEMAPHORE:
+                agent_result = await pydantic_ai_expert.run(request.query, deps=build_deps())
+        
+            # Extraer la respuesta de texto del resultado
             try:
-                # usage es un método, necesitamos llamarlo
-                usage_data = agent_result.usage()
-                print(f"Usage data type: {type(usage_data)}")
-                print(f"Usage data: {usage_data}")
-                
-                # Intentar extraer total_tokens de diferentes maneras
-                if hasattr(usage_data, 'total_tokens'):
-                    total_tokens = usage_data.total_tokens
-                elif isinstance(usage_data, dict) and 'total_tokens' in usage_data:
-                    total_tokens = usage_data['total_tokens']
+                # Intentar obtener directamente el atributo 'data'
+                response = agent_result.data
+            except AttributeError:
+                # Si no existe 'data', usar un mensaje genérico
+                print("No se pudo extraer 'data' del resultado del agente")
+                response = "Lo siento, no pude procesar tu consulta correctamente."
+        
+            # Obtener información de uso
+            if hasattr(agent_result, 'usage'):
+                try:
+                    # usage es un método, necesitamos llamarlo
+                    usage_data = agent_result.usage()
                 
-                print(f"Total tokens: {total_tokens}")
-            except Exception as e:
-                print(f"Error al llamar a usage(): {e}")
+                    # Intentar extraer total_tokens de diferentes maneras
+                    if hasattr(usage_data, 'total_tokens'):
+                        total_tokens = usage_data.total_tokens
+                    elif isinstance(usage_data, dict) and 'total_tokens' in usage_data:
+                        total_tokens = usage_data['total_tokens']
+                except Exception as e:
+                    print(f"Error al llamar a usage(): {e}")
+
+            # Información de debugging (el formateo solo ocurre con nivel DEBUG)
+            logger.debug("Agent result type=%s total_tokens=%s", type(agent_result).__name__, total_tokens)
 
-        # Imprimir información de debugging
-        print(f"Agent result type: {type(agent_result)}")
-        print(f"Agent result attributes: {dir(agent_result)}")
+            # Guardar la respuesta para preguntas similares futuras
+            if any(query_embedding) and hasattr(agent_result, 'data'):
+                background.add_task(store_semantic_cache, supabase, request.query, query_embedding, response)
         
-        # Guardar la conversación con el auth_user_id y las métricas
-        supabase.table("user_conversations").insert({
-            "user_id": auth_user_id,  # Usamos el auth_user_id, no el telegram_id
-            "session_id": request.session_id,
-            "question": request.query,
-            "answer": response,
-            "marketplace": "general",
-            "sources": [],
-            "total_tokens": total_tokens,
-            "execution_time": execution_time
-        }).execute()
+        # Guardar la conversación sin hacer esperar al usuario
+        background.add_task(persist_conversation, auth_user_id, request, response, total_tokens, execution_time)
         
         return {"response": response}
     
     except Exception as e:
         print(f"Error: {e}")
-        return {"response": "Lo siento, ocurrió un error al procesar tu consulta."}
+        return {"response": ERROR_RESPONSE}
+
+@app.post("/ask/stream")
+async def ask_question_stream(request: QueryRequest):
+    """
+    Igual que /ask, pero envía la respuesta como Server-Sent Events a medida que el
+    modelo la genera. Cada evento lleva {"delta": texto}; el último es [DONE].
+    """
+    cached = None
+    canned = direct_response(request.query)
+    if canned:
+        # Respuesta fija: no hace falta stream del agente
+        return StreamingResponse(
+            iter([sse_frame({"delta": canned}), "data: [DONE]\n\n"]),
+            media_type="text/event-stream"
+        )
+    try:
+        denied, auth_user_id, query_embedding = await check_access(request)
+        if not denied and any(query_embedding):
+            cached = await lookup_semantic_cache(supabase, query_embedding)
+    except Exception as e:
+        print(f"Error: {e}")
+        denied = ERROR_RESPONSE
+
+    # Se rellena mientras se emite el stream y se persiste al terminar
+    outcome = {"response": None, "total_tokens": 0, "cacheable": False}
+
+    async def token_generator():
+        if denied:
+            yield sse_frame({"delta": denied})
+        elif cached:
+            outcome["response"] = cached["answer"]
+            yield sse_frame({"delta": cached["answer"]})
+        else:
+            chunks = []
+            try:
+                async with _RUN_SEMAPHORE, pydantic_ai_expert.run_stream(request.query, deps=build_deps()) as result:
+                    async for delta in result.stream_text(delta=True):
+                        chunks.append(delta)
+                        yield sse_frame({"delta": delta})
+                    outcome["total_tokens"] = result.usage().total_tokens or 0
+            except Exception as e:
+                print(f"Error: {e}")
+                yield sse_frame({"delta": ERROR_RESPONSE})
+            else:
+                outcome["response"] = "".join(chunks)
+                outcome["cacheable"] = any(query_embedding)
+        yield "data: [DONE]\n\n"
+
+    async def persist_outcome():
+        if outcome["response"] is not None:
+            await persist_conversation(auth_user_id, request, outcome["response"], outcome["total_tokens"])
+        # Guardar la respuesta para preguntas similares futuras (después del [DONE])
+        if outcome["cacheable"]:
+            await store_semantic_cache(supabase, request.query, query_embedding, outcome["response"])
+
+    return StreamingResponse(
+        token_generator(),
+        media_type="text/event-stream",
+        background=BackgroundTask(persist_outcome)
+    )
 
 if __name__ == "__main__":
     import uvicorn
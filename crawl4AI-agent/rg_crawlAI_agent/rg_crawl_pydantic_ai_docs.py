@@ -141,12 +141,13 @@ async def get_embedding(text: str) -> List[float]:
     try:
         response = await openai_client.embeddings.create(
             model="text-embedding-3-small",
-            input=text
+            input=text,
+            dimensions=512  # Debe coincidir con site_pages.embedding halfvec(512)
         )
         return response.data[0].embedding
     except Exception as e:
         print(f"Error getting embedding: {e}")
-        return [0] * 1536  # Return zero vector on error
+        return [0] * 512  # Return zero vector on error
 
 async def process_chunk(chunk: str, chunk_number: int, url: str) -> ProcessedChunk:
     """Process a single chunk of text."""
@@ -196,7 +197,7 @@ async def insert_chunk(chunk: ProcessedChunk):
             "content": chunk.content,
             "marketplace": chunk.marketplace,
             "metadata": chunk.metadata,
-            "embedding": chunk.embedding
+            "embedding": chunk.embedding  # Postgres lo convierte a halfvec(512) al insertar
         }
         
         result = supabase.table("site_pages").insert(data).execute()
@@ -298,5 +299,11 @@ async def main():
     print(f"Crawling test URL: {test_url}")
     await crawl_parallel(urls)
 
+    # Actualizar el índice de páginas usado por list_documentation_pages
+    try:
+        supabase.rpc("refresh_pages_index").execute()
+    except Exception as e:
+        print(f"Error refreshing pages_index: {e}")
+
 if __name__ == "__main__":
     asyncio.run(main())
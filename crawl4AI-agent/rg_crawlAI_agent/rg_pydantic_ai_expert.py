@@ -1,8 +1,9 @@
 from __future__ import annotations as _annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
 import asyncio
+import hashlib
 import httpx
 import os
 
@@ -10,7 +11,8 @@ from pydantic_ai import Agent, ModelRetry, RunContext
 from pydantic_ai.models.openai import OpenAIModel
 from openai import AsyncOpenAI
 from supabase import Client
-from typing import List
+from cachetools import TTLCache
+from typing import Dict, List, Optional
 
 load_dotenv()
 
@@ -33,6 +35,8 @@ except ImportError:
 class PydanticAIDeps:
     supabase: Client
     openai_client: AsyncOpenAI
+    # Páginas completas ya traídas por match_and_expand, por URL
+    page_cache: Dict[str, Dict[str, str]] = field(default_factory=dict)
 
 system_prompt = """
 You are an expert advisor on cross-border e-commerce, specializing in helping Mexican sellers expand to US marketplaces including Amazon, eBay, and Etsy.
@@ -59,17 +63,111 @@ pydantic_ai_expert = Agent(
     retries=2
 )
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Truncado Matryoshka: 512 dimensiones en lugar de 1536 (debe coincidir con las columnas vector(512) en SQL)
+EMBEDDING_DIMENSIONS = 512
+EMBEDDING_BATCH_WINDOW = 0.01  # segundos que se esperan para juntar peticiones
+EMBEDDING_MAX_BATCH_SIZE = 48
+
+class EmbeddingBatcher:
+    """
+    Agrupa llamadas concurrentes a get_embedding en una sola petición a OpenAI.
+
+    Cada llamada se encola con su future; un worker en segundo plano junta lo que
+    llegue durante EMBEDDING_BATCH_WINDOW (o hasta EMBEDDING_MAX_BATCH_SIZE textos)
+    y lo envía como un único embeddings.create(input=[...]).
+    """
+
+    def __init__(self, max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE, window: float = EMBEDDING_BATCH_WINDOW):
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._loop = None
+        self._queue = None
+        self._worker = None
+
+    async def submit(self, text: str, openai_client: AsyncOpenAI) -> List[float]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker.done():
+            # Primer uso en este event loop: crear la cola y el worker
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+        future = loop.create_future()
+        self._queue.put_nowait((text, openai_client, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        # Una petición por cliente (normalmente solo hay uno)
+        by_client = {}
+        for text, openai_client, future in batch:
+            by_client.setdefault(openai_client, []).append((text, future))
+
+        for openai_client, items in by_client.items():
+            try:
+                response = await openai_client.embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=[text for text, _ in items],
+                    dimensions=EMBEDDING_DIMENSIONS
+                )
+                for (_, future), data in zip(items, response.data):
+                    if not future.done():
+                        future.set_result(data.embedding)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+embedding_batcher = EmbeddingBatcher()
+
+class EmbeddingCache:
+    """
+    Caché de embeddings compartida por todas las peticiones del proceso
+    (la API y las herramientas del agente). Las claves son el sha256 del texto.
+    """
+
+    def __init__(self, maxsize: int = 2048, ttl: int = 3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        return self._cache.get(self._key(text))
+
+    def set(self, text: str, embedding: List[float]) -> None:
+        self._cache[self._key(text)] = embedding
+
+embedding_cache = EmbeddingCache()
+
 async def get_embedding(text: str, openai_client: AsyncOpenAI) -> List[float]:
-    """Get embedding vector from OpenAI."""
+    """Get embedding vector from OpenAI, reusing one computed recently for the same text."""
+    embedding = embedding_cache.get(text)
+    if embedding is not None:
+        return embedding
     try:
-        response = await openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
-        )
-        return response.data[0].embedding
+        embedding = await embedding_batcher.submit(text, openai_client)
     except Exception as e:
         print(f"Error getting embedding: {e}")
-        return [0] * 1536  # Return zero vector on error
+        return [0] * EMBEDDING_DIMENSIONS  # Return zero vector on error (not cached)
+    embedding_cache.set(text, embedding)
+    return embedding
 
 @pydantic_ai_expert.tool
 async def retrieve_relevant_documentation(ctx: RunContext[PydanticAIDeps], user_query: str, marketplace: str = 'general') -> str:
@@ -87,22 +185,29 @@ async def retrieve_relevant_documentation(ctx: RunContext[PydanticAIDeps], user_
         # Get the embedding for the query
         query_embedding = await get_embedding(user_query, ctx.deps.openai_client)
         
-        # Query Supabase for relevant documents
+        # Query Supabase for relevant documents, also expanding the best page in the same roundtrip
         result = ctx.deps.supabase.rpc(
-            'match_site_pages',
+            'match_and_expand',
             {
                 'query_embedding': query_embedding,
                 'match_count': 5,
                 'marketplace_filter': marketplace,
+                'expand_top': 1,
             }
         ).execute()
         
-        if not result.data:
+        payload = result.data or {}
+        
+        # Keep the expanded page so a follow-up get_page_content doesn't hit the database
+        for page in payload.get('expansion', []):
+            ctx.deps.page_cache[page['url']] = page
+        
+        if not payload.get('matches'):
             return "No relevant documentation found."
             
         # Format the results
         formatted_chunks = []
-        for doc in result.data:
+        for doc in payload['matches']:
             # Incluir el marketplace en el encabezado
             marketplace_info = f"[{doc['marketplace'].upper()}]" if 'marketplace' in doc else ""
             chunk_text = f"""
@@ -134,36 +239,28 @@ async def list_documentation_pages(ctx: RunContext[PydanticAIDeps], marketplace:
         str: Formatted list of documentation pages grouped by marketplace
     """
     try:
-        # Build query
-        query = ctx.deps.supabase.from_('site_pages').select('url, marketplace, title').distinct('url')
+        # Build query over the one-row-per-URL materialized view, already sorted for grouping
+        query = ctx.deps.supabase.from_('pages_index').select('url, marketplace, title')
         
         # Apply marketplace filter if provided
         if marketplace:
             query = query.eq('marketplace', marketplace.lower())
             
         # Execute query
-        result = query.execute()
+        result = query.order('marketplace').order('title').execute()
         
         if not result.data:
             return "No documentation pages found."
             
-        # Group by marketplace
-        pages_by_marketplace = {}
-        for doc in result.data:
-            mkt = doc.get('marketplace', 'general').upper()
-            if mkt not in pages_by_marketplace:
-                pages_by_marketplace[mkt] = []
-            
-            title = doc.get('title', 'Untitled')
-            url = doc.get('url', '')
-            pages_by_marketplace[mkt].append(f"- [{title}]({url})")
-        
-        # Format the output
+        # Format the output, starting a new section whenever the marketplace changes
         output = ["# Available Documentation Pages"]
-        
-        for mkt, pages in sorted(pages_by_marketplace.items()):
-            output.append(f"\n## {mkt}")
-            output.extend(pages)
+        current_mkt = None
+        for doc in result.data:
+            mkt = (doc.get('marketplace') or 'general').upper()
+            if mkt != current_mkt:
+                output.append(f"\n## {mkt}")
+                current_mkt = mkt
+            output.append(f"- [{doc.get('title') or 'Untitled'}]({doc.get('url', '')})")
             
         return "\n".join(output)
         
@@ -184,26 +281,21 @@ async def get_page_content(ctx: RunContext[PydanticAIDeps], url: str) -> str:
         str: The complete page content with all chunks combined in order
     """
     try:
-        # Query Supabase for all chunks of this URL, ordered by chunk_number
-        result = ctx.deps.supabase.from_('site_pages') \
-            .select('title, content, chunk_number') \
-            .eq('url', url) \
-            .order('chunk_number') \
-            .execute()
+        # Reuse the page if retrieve_relevant_documentation already expanded it
+        page = ctx.deps.page_cache.get(url)
         
-        if not result.data:
-            return f"No content found for URL: {url}"
+        if page is None:
+            # Fetch the page with all its chunks already joined in order by the database
+            result = ctx.deps.supabase.rpc('get_page_full_content', {'page_url': url}).execute()
             
-        # Format the page with its title and all chunks
-        page_title = result.data[0]['title'].split(' - ')[0]  # Get the main title
-        formatted_content = [f"# {page_title}\n"]
-        
-        # Add each chunk's content
-        for chunk in result.data:
-            formatted_content.append(chunk['content'])
+            if not result.data:
+                return f"No content found for URL: {url}"
+            
+            page = result.data[0]
             
-        # Join everything together
-        return "\n\n".join(formatted_content)
+        # Format the page with its title and the combined content
+        page_title = page['title'].split(' - ')[0]  # Get the main title
+        return f"# {page_title}\n\n\n{page['full_content']}"
         
     except Exception as e:
         print(f"Error retrieving page content: {e}")
@@ -12,7 +12,7 @@ create table site_pages (
     summary varchar not null,
     content text not null,  -- Added content column
     metadata jsonb not null default '{}'::jsonb,  -- Added metadata column
-    embedding vector(1536),  -- OpenAI embeddings are 1536 dimensions
+    embedding halfvec(512),  -- text-embedding-3-small truncated to 512 dimensions (Matryoshka), stored as float16
     created_at timestamp with time zone default timezone('utc'::text, now()) not null,
     
     -- Add a unique constraint to prevent duplicate chunks for the same URL
@@ -39,8 +39,12 @@ create table conversation_images (
     created_at timestamp with time zone default timezone('utc', now()) not null
 );
 
--- Create an index for better vector similarity search performance
-create index on site_pages using ivfflat (embedding vector_cosine_ops);
+-- Create an HNSW index for better vector similarity search performance
+-- (en bases existentes: drop index if exists site_pages_embedding_idx; para quitar el ivfflat anterior)
+-- halfvec requiere pgvector >= 0.7. Para migrar una base existente:
+--   drop index if exists site_pages_embedding_hnsw;
+--   alter table site_pages alter column embedding type halfvec(512) using null;  -- y volver a ingerir con dimensions=512
+create index site_pages_embedding_hnsw on site_pages using hnsw (embedding halfvec_cosine_ops) with (m = 16, ef_construction = 64);
 
 -- Create an index on metadata for faster filtering
 create index idx_site_pages_metadata on site_pages using gin (metadata);
@@ -58,7 +62,7 @@ create index idx_conversation_images_conversation_id on conversation_images(conv
 
 -- Create a function to search for documentation chunks
 create or replace function match_site_pages (
-  query_embedding vector(1536),
+  query_embedding vector(512),
   match_count int default 10,
   marketplace_filter varchar default null,  -- Nuevo parámetro para filtrar por marketplace
   filter jsonb DEFAULT '{}'::jsonb
@@ -77,6 +81,9 @@ language plpgsql
 as $$
 #variable_conflict use_column
 begin
+  -- Amplitud de búsqueda del índice HNSW solo para esta transacción
+  set local hnsw.ef_search = 40;
+
   return query
   select
     id,
@@ -87,21 +94,187 @@ begin
     summary,
     content,
     metadata,
-    1 - (site_pages.embedding <=> query_embedding) as similarity
+    1 - (site_pages.embedding <=> query_embedding::halfvec(512)) as similarity
   from site_pages
   where metadata @> filter
     AND (marketplace_filter IS NULL OR marketplace = marketplace_filter)  -- Filtro condicional por marketplace
-  order by site_pages.embedding <=> query_embedding
+  order by site_pages.embedding <=> query_embedding::halfvec(512)
+  limit match_count;
+end;
+$$;
+
+-- Índice de páginas (una fila por URL) para listar la documentación sin escanear todos los chunks
+create materialized view pages_index as
+select distinct on (url)
+    url,
+    marketplace,
+    title
+from site_pages
+order by url, chunk_number;
+
+-- El índice único es necesario para refresh materialized view concurrently
+create unique index pages_index_url on pages_index (url);
+create index pages_index_marketplace on pages_index (marketplace, title);
+
+-- Refrescar después de cada ingesta. También vacía semantic_cache: las respuestas
+-- guardadas se generaron con la documentación anterior y podrían estar desactualizadas
+create or replace function refresh_pages_index()
+returns void
+language plpgsql
+security definer
+as $$
+begin
+  refresh materialized view concurrently pages_index;
+  delete from semantic_cache;
+end;
+$$;
+
+-- Devuelve una página completa con sus chunks ya concatenados en orden
+create or replace function get_page_full_content (
+  page_url varchar
+) returns table (
+  title varchar,
+  full_content text
+)
+language sql stable
+as $$
+  select
+    (array_agg(title order by chunk_number))[1] as title,
+    string_agg(content, E'\n\n' order by chunk_number) as full_content
+  from site_pages
+  where url = page_url
+  having count(*) > 0;
+$$;
+
+-- Búsqueda vectorial + expansión en una sola llamada: devuelve los chunks más similares
+-- y el contenido completo de las expand_top páginas mejor posicionadas
+create or replace function match_and_expand (
+  query_embedding vector(512),
+  match_count int default 5,
+  marketplace_filter varchar default null,
+  expand_top int default 1
+) returns jsonb
+language plpgsql
+as $$
+declare
+  matches jsonb;
+  expansion jsonb;
+begin
+  set local hnsw.ef_search = 40;
+
+  select coalesce(jsonb_agg(to_jsonb(top) order by top.similarity desc), '[]'::jsonb)
+  into matches
+  from (
+    select
+      sp.id,
+      sp.url,
+      sp.marketplace,
+      sp.chunk_number,
+      sp.title,
+      sp.summary,
+      sp.content,
+      1 - (sp.embedding <=> query_embedding::halfvec(512)) as similarity
+    from site_pages sp
+    where marketplace_filter is null or sp.marketplace = marketplace_filter
+    order by sp.embedding <=> query_embedding::halfvec(512)
+    limit match_count
+  ) top;
+
+  select coalesce(jsonb_agg(page), '[]'::jsonb)
+  into expansion
+  from (
+    select
+      best.url,
+      (array_agg(sp.title order by sp.chunk_number))[1] as title,
+      string_agg(sp.content, E'\n\n' order by sp.chunk_number) as full_content
+    from (
+      select m.url, max(m.similarity) as similarity
+      from jsonb_to_recordset(matches) as m(url varchar, similarity float)
+      group by m.url
+      order by max(m.similarity) desc
+      limit expand_top
+    ) best
+    join site_pages sp on sp.url = best.url
+    group by best.url
+  ) page;
+
+  return jsonb_build_object('matches', matches, 'expansion', expansion);
+end;
+$$;
+
+-- Caché semántica de respuestas: preguntas casi idénticas reutilizan la respuesta previa
+create table semantic_cache (
+    id bigserial primary key,
+    query text not null,
+    query_embedding vector(512) not null,
+    answer text not null,
+    sources jsonb not null default '[]'::jsonb,
+    created_at timestamp with time zone default timezone('utc', now()) not null
+);
+
+create index semantic_cache_embedding_hnsw on semantic_cache using hnsw (query_embedding vector_cosine_ops);
+
+-- Busca la respuesta en caché más similar por encima del umbral
+create or replace function match_semantic_cache (
+  query_embedding vector(512),
+  match_threshold float default 0.95,
+  match_count int default 1
+) returns table (
+  id bigint,
+  query text,
+  answer text,
+  sources jsonb,
+  similarity float
+)
+language plpgsql
+as $$
+#variable_conflict use_column
+begin
+  return query
+  select
+    id,
+    query,
+    answer,
+    sources,
+    1 - (semantic_cache.query_embedding <=> query_embedding) as similarity
+  from semantic_cache
+  where 1 - (semantic_cache.query_embedding <=> query_embedding) >= match_threshold
+  order by semantic_cache.query_embedding <=> query_embedding
   limit match_count;
 end;
 $$;
 
+-- Verifica en una sola consulta si el usuario de Telegram existe, está activado
+-- y tiene una suscripción activa (tablas telegram_users y subscriptions)
+create or replace function check_user_access (
+  p_telegram_id bigint
+) returns table (
+  auth_user_id uuid,
+  is_activated boolean,
+  has_active_sub boolean
+)
+language sql stable
+as $$
+  select
+    tu.auth_user_id,
+    tu.is_activated,
+    exists (
+      select 1
+      from subscriptions s
+      where s.user_id = tu.auth_user_id
+        and s.status = 'active'
+    ) as has_active_sub
+  from telegram_users tu
+  where tu.telegram_id = p_telegram_id;
+$$;
+
 -- Everything above will work for any PostgreSQL database. The below commands are for Supabase security
 
 -- Enable RLS on the tables
 alter table site_pages enable row level security;
 alter table user_conversations enable row level security;
 alter table conversation_images enable row level security;
+alter table semantic_cache enable row level security;
 
 
 -- Create a policy that allows authenticated users to read
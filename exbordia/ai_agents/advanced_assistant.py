@@ -1,23 +1,19 @@
 import logging
 import asyncio
-from agents import Agent, Runner, set_default_openai_key
-from config import OPENAI_API_KEY
-from services.conversation_service import ConversationService
+from functools import lru_cache
+from agents import Agent, Runner
+from config import configure_openai_agents, MAX_CONCURRENT_RUNS
+from services.conversation_service import get_conversation_service
+from utils.validators import direct_response
 
 # Configurar logging
 logger = logging.getLogger(__name__)
 
-# Configurar la API key de OpenAI
-set_default_openai_key(OPENAI_API_KEY)
+# Limita las ejecuciones simultáneas del agente para no saturar los límites de OpenAI
+_RUN_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_RUNS)
 
-# Inicializar el servicio de conversación
-conversation_service = ConversationService()
-
-# Crear agentes especializados
-logistics_agent = Agent(
-    name="Logistics Expert",
-    handoff_description="Especialista en logística y envíos a Estados Unidos",
-    instructions="""Eres un experto en logística y envíos para vendedores mexicanos en Amazon USA.
+# Instrucciones de los agentes
+LOGISTICS_INSTRUCTIONS = """Eres un experto en logística y envíos para vendedores mexicanos en Amazon USA.
     
     Proporciona información detallada sobre:
     - Opciones de envío desde México a USA
@@ -26,13 +22,9 @@ logistics_agent = Agent(
     - Trámites aduaneros y documentación necesaria
     - Mejores prácticas para embalaje y etiquetado
     - Solución de problemas comunes de logística
-    """,
-)
+    """
 
-marketing_agent = Agent(
-    name="Marketing Expert",
-    handoff_description="Especialista en marketing y optimización de listados en Amazon",
-    instructions="""Eres un experto en marketing y optimización de listados para vendedores mexicanos en Amazon USA.
+MARKETING_INSTRUCTIONS = """Eres un experto en marketing y optimización de listados para vendedores mexicanos en Amazon USA.
     
     Proporciona información detallada sobre:
     - Optimización de títulos, bullets y descripciones
@@ -42,22 +34,44 @@ marketing_agent = Agent(
     - PPC y publicidad en Amazon
     - Promociones y cupones
     - Estrategias para mejorar reseñas
-    """,
-)
+    """
 
-# Crear el agente principal con capacidad de handoff
-amazon_seller_agent = Agent(
-    name="Amazon Seller Expert",
-    instructions="""Eres un experto en ayudar a vendedores mexicanos a expandirse al mercado de Amazon USA.
+AMAZON_SELLER_INSTRUCTIONS = """Eres un experto en ayudar a vendedores mexicanos a expandirse al mercado de Amazon USA.
     
     Proporciona información clara, precisa y útil sobre todos los aspectos de vender en Amazon USA.
     Si la pregunta es específicamente sobre logística o marketing, considera hacer un handoff al agente especializado.
     
     Sé amable, profesional y proporciona ejemplos concretos cuando sea posible.
     Si no conoces la respuesta a algo, admítelo honestamente en lugar de inventar información.
-    """,
-    handoffs=[logistics_agent, marketing_agent],
-)
+    """
+
+@lru_cache()
+def get_amazon_seller_agent():
+    """
+    Construye el agente principal (y sus agentes especializados) la primera vez
+    que se necesita y lo reutiliza en las siguientes llamadas.
+    """
+    configure_openai_agents()
+
+    # Crear agentes especializados
+    logistics_agent = Agent(
+        name="Logistics Expert",
+        handoff_description="Especialista en logística y envíos a Estados Unidos",
+        instructions=LOGISTICS_INSTRUCTIONS,
+    )
+
+    marketing_agent = Agent(
+        name="Marketing Expert",
+        handoff_description="Especialista en marketing y optimización de listados en Amazon",
+        instructions=MARKETING_INSTRUCTIONS,
+    )
+
+    # Crear el agente principal con capacidad de handoff
+    return Agent(
+        name="Amazon Seller Expert",
+        instructions=AMAZON_SELLER_INSTRUCTIONS,
+        handoffs=[logistics_agent, marketing_agent],
+    )
 
 async def process_message(user_id, message_text):
     """
@@ -71,8 +85,14 @@ async def process_message(user_id, message_text):
         str: Respuesta del agente
     """
     try:
+        # Responder sin LLM a saludos, agradecimientos y mensajes triviales
+        canned = direct_response(message_text)
+        if canned:
+            return canned
+        
         # Convertir user_id a string para usarlo como clave
         user_id_str = str(user_id)
+        conversation_service = get_conversation_service()
         
         # Obtener la sesión activa o crear una nueva
         session_id = conversation_service.get_active_session(user_id_str)
@@ -95,7 +115,8 @@ async def process_message(user_id, message_text):
         start_time = asyncio.get_event_loop().time()
         
         # Ejecutar el agente
-        result = await Runner.run(amazon_seller_agent, full_message)
+        async with _RUN_SEMAPHORE:
+            result = await Runner.run(get_amazon_seller_agent(), full_message)
         
         # Calcular tiempo de ejecución
         execution_time = asyncio.get_event_loop().time() - start_time
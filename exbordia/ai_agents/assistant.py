@@ -2,9 +2,11 @@ import logging
 import asyncio
 import sys
 import os
-from agents import Agent, Runner, set_default_openai_key, trace, WebSearchTool
-from config import OPENAI_API_KEY
-from services.conversation_service import ConversationService
+from functools import lru_cache
+from cachetools import TTLCache
+from agents import Agent, Runner, RunConfig, ModelSettings, trace, WebSearchTool
+from config import configure_openai_agents, MAX_CONCURRENT_RUNS
+from utils.validators import direct_response
 from pydantic import BaseModel
 # Añadir el directorio raíz al path para evitar conflictos de importación
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
@@ -12,16 +14,11 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../.
 # Configurar logging
 logger = logging.getLogger(__name__)
 
-# Configurar la API key de OpenAI
-set_default_openai_key(OPENAI_API_KEY)
+# Limita las ejecuciones simultáneas del agente para no saturar los límites de OpenAI
+_RUN_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_RUNS)
 
-# Inicializar el servicio de conversación
-conversation_service = ConversationService()
-
-# Crear el agente principal
-amazon_seller_agent = Agent(
-    name="Amazon Seller Expert",
-    instructions="""Eres un experto en ayudar a vendedores mexicanos a expandirse al mercado de Amazon USA.
+# Instrucciones de los agentes
+AMAZON_SELLER_INSTRUCTIONS = """Eres un experto en ayudar a vendedores mexicanos a expandirse al mercado de Amazon USA.
     
     Proporciona información clara, precisa y útil sobre:
     - Cómo registrarse como vendedor en Amazon USA
@@ -34,16 +31,12 @@ amazon_seller_agent = Agent(
     
     Sé amable, profesional y proporciona ejemplos concretos cuando sea posible.
     Si no conoces la respuesta a algo, admítelo honestamente en lugar de inventar información.
-    """,
-    handoff_description="Especialista en ventas en Amazon USA",
-    tools=[WebSearchTool()],
-)
-
-Onboarding_agent = Agent(
-    name="Onboarding Agent",
-    handoff_description="""Especialista en dar de alta y la benvenida al los nuevos 
-    usuarios de Exbordia. Podrás reconocerlos si dicen que son nuevos usuarios de Exbordia.""",
-    instructions="""Tu vas a ayudar a que los nuevos usuarios se sientan cómodos
+    """
+
+ONBOARDING_HANDOFF_DESCRIPTION = """Especialista en dar de alta y la benvenida al los nuevos 
+    usuarios de Exbordia. Podrás reconocerlos si dicen que son nuevos usuarios de Exbordia."""
+
+ONBOARDING_INSTRUCTIONS = """Tu vas a ayudar a que los nuevos usuarios se sientan cómodos
     de usar Exbordia.
     Tu objetivo principal es recabar información de los usuarios haciendoles algunas preguntas:
     - ¿Cuál es tu nombre?
@@ -54,20 +47,71 @@ Onboarding_agent = Agent(
     - ¿Me puedes compartir un link a alguno de tus productos en Amazon?
     No debes de obligar al usuario a que te conteste todas las preguntas. Si sientes
     que el usuario ya no se siente cómodo, puedes pasarle el control al siguiente agente.
-    """,
-    model="gpt-4o-mini",
-)
+    """
+
+@lru_cache()
+def get_triage_agent():
+    """
+    Construye el agente de triage (y los agentes a los que delega) la primera vez
+    que se necesita y lo reutiliza en las siguientes llamadas.
+    """
+    configure_openai_agents()
+
+    # Crear el agente principal
+    amazon_seller_agent = Agent(
+        name="Amazon Seller Expert",
+        instructions=AMAZON_SELLER_INSTRUCTIONS,
+        handoff_description="Especialista en ventas en Amazon USA",
+        tools=[WebSearchTool()],
+    )
+
+    Onboarding_agent = Agent(
+        name="Onboarding Agent",
+        handoff_description=ONBOARDING_HANDOFF_DESCRIPTION,
+        instructions=ONBOARDING_INSTRUCTIONS,
+        model="gpt-4o-mini",
+    )
+
+    # Definir agente de triage
+    return Agent(
+        name="Triage Agent",
+        instructions="Determina si la pregunta es sobre ventas en Amazon o sobre historia",
+        handoffs=[amazon_seller_agent, Onboarding_agent],
+    )
 
-# Definir agente de triage
-triage_agent = Agent(
-    name="Triage Agent",
-    instructions="Determina si la pregunta es sobre ventas en Amazon o sobre historia",
-    handoffs=[amazon_seller_agent, Onboarding_agent],
-)
 
+# Número máximo de mensajes previos que se reenvían al modelo en cada turno
+MAX_HISTORY_ITEMS = 20
 
-# Diccionario para almacenar los resultados previos por user_id
-thread_results = {}
+# Caché acotada de resultados previos por user_id (expiran tras 1 hora sin actividad);
+# el historial completo ya se guarda en Supabase
+thread_results = TTLCache(maxsize=10000, ttl=3600)
+
+def trim_history(input_list):
+    """
+    Recorta el historial a los últimos MAX_HISTORY_ITEMS elementos.
+
+    El recorte empieza siempre en un mensaje del usuario para no dejar
+    resultados de herramientas sin su llamada correspondiente.
+    """
+    tail = input_list[-MAX_HISTORY_ITEMS:]
+    for i, item in enumerate(tail):
+        if isinstance(item, dict) and item.get("role") == "user":
+            return tail[i:]
+    return []
+
+def prompt_cache_config(user_id_str):
+    """
+    Configuración de ejecución con una clave de caché de prompt estable por usuario.
+
+    OpenAI cachea automáticamente los prefijos repetidos (instrucciones + historial);
+    la clave hace que los turnos del mismo usuario lleguen al mismo shard de caché.
+    Va en extra_body (cuerpo de la petición) y no en extra_args: el cliente openai fijado
+    en requirements.txt no acepta prompt_cache_key como argumento de create().
+    """
+    return RunConfig(
+        model_settings=ModelSettings(extra_body={"prompt_cache_key": f"exbordia-{user_id_str}"})
+    )
 
 async def process_message(user_id, message_text, session_id):
     """
@@ -85,22 +129,36 @@ async def process_message(user_id, message_text, session_id):
         # Convertir user_id a string para usarlo como clave
         user_id_str = str(user_id)
         
+        # Responder sin LLM a saludos, agradecimientos y mensajes triviales
+        canned = direct_response(message_text)
+        if canned:
+            return {
+                "response": canned,
+                "execution_time": 0,
+                "session_id": session_id
+            }
+        
         # Medir tiempo de ejecución
         start_time = asyncio.get_event_loop().time()
         
+        # Mantener el prefijo del prompt en la misma caché para este usuario
+        run_config = prompt_cache_config(user_id_str)
+        
         # Usar el user_id como thread_id para mantener el contexto
         with trace(workflow_name="Triage Agent", group_id=user_id_str):
             # Verificar si hay un resultado previo para este usuario
             if user_id_str in thread_results:
                 # Convertir el resultado anterior a formato de entrada y añadir el nuevo mensaje
                 previous_result = thread_results[user_id_str]
-                input_list = previous_result.to_input_list() + [{"role": "user", "content": message_text}]
+                input_list = trim_history(previous_result.to_input_list()) + [{"role": "user", "content": message_text}]
                 
                 # Ejecutar el agente de triage con el historial y el nuevo mensaje
-                result = await Runner.run(triage_agent, input_list)
+                async with _RUN_SEMAPHORE:
+                    result = await Runner.run(get_triage_agent(), input_list, run_config=run_config)
             else:
                 # Primera interacción, ejecutar el agente de triage solo con el mensaje actual
-                result = await Runner.run(triage_agent, message_text)
+                async with _RUN_SEMAPHORE:
+                    result = await Runner.run(get_triage_agent(), message_text, run_config=run_config)
             
             # Guardar el resultado para futuras interacciones
             thread_results[user_id_str] = result
@@ -1,9 +1,6 @@
-import os
-from dotenv import load_dotenv
-from agents import set_default_openai_key    
+from config import configure_openai_agents
 
-load_dotenv()
-set_default_openai_key(os.getenv("OPENAI_API_KEY"))
+configure_openai_agents()
 
 from agents import Agent, Runner, GuardrailFunctionOutput, WebSearchTool
 from pydantic import BaseModel
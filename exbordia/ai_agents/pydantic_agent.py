@@ -3,32 +3,50 @@ from __future__ import annotations as _annotations
 from dataclasses import dataclass
 from dotenv import load_dotenv
 import asyncio
-import httpx
+import collections
+import hashlib
 import os
+import sys
 import json
-from typing import List, Dict, Any, Optional
+import logging
+import numpy as np
+import orjson
+from cachetools import TTLCache
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Dict, Any, Optional
 
-from pydantic_ai import Agent, ModelRetry, RunContext
-from pydantic_ai.models.openai import OpenAIModel
-from openai import AsyncOpenAI
-from supabase import Client
+# pydantic_ai (su __init__ importa el agente y logfire: más de la mitad del tiempo de import
+# de este módulo), openai y supabase se importan de forma diferida (ver get_expert_agent);
+# aquí solo se usan en anotaciones
+if TYPE_CHECKING:
+    from pydantic_ai import Agent, RunContext
+    from openai import AsyncOpenAI
+    from supabase import Client
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 llm = os.getenv('LLM_MODEL', 'gpt-4o-mini')
-model = OpenAIModel(llm)
-
-try:
-    import logfire
-    logfire.configure(send_to_logfire='if-token-present')
-except ImportError:
-    print("Logfire no está instalado. La funcionalidad de logging estará limitada.")
-    # Crear un objeto ficticio para evitar errores
-    class DummyLogfire:
-        @staticmethod
-        def configure(*args, **kwargs):
-            pass
-    logfire = DummyLogfire
+
+class _DummyLogfire:
+    """Sustituto de logfire cuando no está configurado."""
+    @staticmethod
+    def configure(*args, **kwargs):
+        pass
+
+logfire = _DummyLogfire()
+
+def configure_logfire():
+    """
+    Configura logfire solo si hay LOGFIRE_TOKEN; se llama al crear el agente,
+    no al importar el módulo.
+    """
+    global logfire
+    if os.getenv("LOGFIRE_TOKEN"):
+        import logfire as _logfire
+        _logfire.configure(send_to_logfire='if-token-present')
+        logfire = _logfire
 
 @dataclass
 class PydanticAIDeps:
@@ -54,6 +72,22 @@ AMAZON_CATEGORIES = {
     "Reembolsos y Cargos Ocultos": "Cómo reclamar cobros indebidos en Amazon."
 }
 
+# Fragmentos de prompt precalculados una sola vez al importar el módulo
+_CATEGORIES_JSON = json.dumps(AMAZON_CATEGORIES, indent=2, ensure_ascii=False)
+
+# Se internan para que el prompt sea el mismo objeto (y bytes idénticos) en cada llamada,
+# lo que permite que el prompt caching automático de OpenAI lo reutilice
+_IDENTIFY_SYSTEM_PROMPT = sys.intern(f"""Identifica las categorías más relevantes para esta consulta sobre Amazon.
+        Categorías disponibles con descripciones:
+        {_CATEGORIES_JSON}
+        
+        Devuelve solo un array JSON con los nombres de las 1-3 categorías más relevantes.
+        Ejemplo: ["Logística", "Amazon FBA y FBM"]
+        """)
+
+# Plantilla de cada chunk de documentación devuelto por las herramientas de búsqueda
+_DOC_TEMPLATE = sys.intern("\n# {title} {header}\n{summary}\n\n{content}\n\nSource: {url}\n")
+
 # Prompt del sistema actualizado para enfocarse exclusivamente en Amazon
 system_prompt = """
 Eres un experto en Amazon para vendedores mexicanos que quieren expandirse al mercado estadounidense.
@@ -68,27 +102,178 @@ Tu proceso para responder preguntas debe ser:
 
 Recuerda que tu especialidad es ayudar a vendedores mexicanos a vender en Amazon USA, con foco en logística, regulaciones, marketing, y operaciones.
 """
+system_prompt = sys.intern(system_prompt)
 
-pydantic_ai_expert = Agent(
-    model,
-    system_prompt=system_prompt,
-    deps_type=PydanticAIDeps,
-    retries=2
-)
 
-async def get_embedding(text: str, openai_client: AsyncOpenAI) -> List[float]:
-    """Get embedding vector from OpenAI."""
+class EmbeddingCache:
+    """
+    Caché de embeddings compartida por todas las herramientas del agente.
+    
+    Las claves son el sha256 del texto y los vectores se guardan como float32
+    (unos 6KB por vector frente a ~50KB de una lista de floats de Python).
+    """
+
+    def __init__(self, maxsize: int = 2048, ttl: int = 3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        return self._cache.get(self._key(text))
+
+    def set(self, text: str, embedding: np.ndarray) -> None:
+        self._cache[self._key(text)] = embedding
+
+embedding_cache = EmbeddingCache()
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_WINDOW = 0.01  # segundos que se esperan para juntar peticiones
+EMBEDDING_MAX_BATCH_SIZE = 64
+EMBEDDING_MAX_QUEUE_SIZE = 1024  # a partir de aquí se llama a la API directamente
+EMBEDDING_TOKENS_PER_MINUTE = 250_000
+
+class EmbeddingBatcher:
+    """
+    Agrupa llamadas concurrentes a get_embedding en una sola petición a OpenAI.
+    
+    Cada llamada se encola con su future; un worker en segundo plano junta lo que
+    llegue durante EMBEDDING_BATCH_WINDOW (o hasta EMBEDDING_MAX_BATCH_SIZE textos),
+    respeta el límite de EMBEDDING_TOKENS_PER_MINUTE y lo envía como un único
+    embeddings.create(input=[...]).
+    """
+
+    def __init__(self, max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE, window: float = EMBEDDING_BATCH_WINDOW,
+                 tokens_per_minute: int = EMBEDDING_TOKENS_PER_MINUTE):
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.tokens_per_minute = tokens_per_minute
+        self._sent = collections.deque()  # (instante, tokens) de los lotes del último minuto
+        self._loop = None
+        self._queue = None
+        self._worker = None
+
+    def saturated(self) -> bool:
+        return self._queue is not None and self._queue.qsize() >= EMBEDDING_MAX_QUEUE_SIZE
+
+    async def submit(self, text: str, openai_client: AsyncOpenAI) -> List[float]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker.done():
+            # Primer uso en este event loop: crear la cola y el worker
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+        future = loop.create_future()
+        self._queue.put_nowait((text, openai_client, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._wait_for_budget(sum(len(text) // 4 + 1 for text, _, _ in batch))
+            await self._flush(batch)
+
+    async def _wait_for_budget(self, tokens: int):
+        # Estimación aproximada de ~4 caracteres por token
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            while self._sent and now - self._sent[0][0] >= 60:
+                self._sent.popleft()
+            used = sum(t for _, t in self._sent)
+            if not self._sent or used + tokens <= self.tokens_per_minute:
+                self._sent.append((now, tokens))
+                return
+            await asyncio.sleep(60 - (now - self._sent[0][0]))
+
+    async def _flush(self, batch):
+        # Una petición por cliente (normalmente solo hay uno)
+        by_client = {}
+        for text, openai_client, future in batch:
+            by_client.setdefault(openai_client, []).append((text, future))
+
+        for openai_client, items in by_client.items():
+            try:
+                response = await openai_client.embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=[text for text, _ in items]
+                )
+                for (_, future), data in zip(items, response.data):
+                    if not future.done():
+                        future.set_result(data.embedding)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+embedding_batcher = EmbeddingBatcher()
+
+async def get_embedding(text: str, openai_client: AsyncOpenAI) -> np.ndarray:
+    """
+    Get embedding vector from OpenAI as float32, reusing cached vectors for repeated texts.
+    Convert with .tolist() only when sending it to a Supabase RPC.
+    """
+    cached = embedding_cache.get(text)
+    if cached is not None:
+        return cached
+    
     try:
-        response = await openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
-        )
-        return response.data[0].embedding
+        if embedding_batcher.saturated():
+            # Cola llena: no esperar detrás de todo el backlog
+            response = await openai_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=text
+            )
+            embedding = response.data[0].embedding
+        else:
+            embedding = await embedding_batcher.submit(text, openai_client)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding_cache.set(text, embedding)
+        return embedding
     except Exception as e:
         print(f"Error getting embedding: {e}")
-        return [0] * 1536  # Return zero vector on error
+        return np.zeros(1536, dtype=np.float32)  # Return zero vector on error
+
+def _format_doc(doc: Dict[str, Any]) -> str:
+    """
+    Formatea un chunk de documentación con su encabezado (categorías y marketplace),
+    resumen, contenido y fuente.
+    """
+    # Comprobaciones explícitas en lugar de filter + join para el encabezado
+    categories = doc.get('category')
+    if categories and 'marketplace' in doc:
+        header_info = f"[{', '.join(categories)}] [{doc['marketplace'].upper()}]"
+    elif categories:
+        header_info = f"[{', '.join(categories)}]"
+    elif 'marketplace' in doc:
+        header_info = f"[{doc['marketplace'].upper()}]"
+    else:
+        header_info = ""
+    
+    # Incluir resumen si está disponible
+    summary = doc.get('summary')
+    summary = f"\n\n**Summary**: {summary}" if summary else ""
+    
+    return _DOC_TEMPLATE.format(
+        title=doc['title'],
+        header=header_info,
+        summary=summary,
+        content=doc['content'],
+        url=doc['url']
+    )
 
-@pydantic_ai_expert.tool
 async def identify_relevant_categories(ctx: RunContext[PydanticAIDeps], user_query: str) -> List[str]:
     """
     Identifica las categorías más relevantes para la consulta del usuario.
@@ -100,37 +285,78 @@ async def identify_relevant_categories(ctx: RunContext[PydanticAIDeps], user_que
     Returns:
         Lista de categorías relevantes para la consulta
     """
-    print(f"🔍 TOOL CALLED: identify_relevant_categories - Query: '{user_query}'")
+    logger.debug("TOOL CALLED: identify_relevant_categories - Query: %r", user_query)
     
     try:
-        system_prompt = f"""Identifica las categorías más relevantes para esta consulta sobre Amazon.
-        Categorías disponibles con descripciones:
-        {json.dumps(AMAZON_CATEGORIES, indent=2, ensure_ascii=False)}
-        
-        Devuelve solo un array JSON con los nombres de las 1-3 categorías más relevantes.
-        Ejemplo: ["Logística", "Amazon FBA y FBM"]
-        """
-        
         response = await ctx.deps.openai_client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": _IDENTIFY_SYSTEM_PROMPT},
                 {"role": "user", "content": user_query}
             ],
             response_format={"type": "json_object"}
         )
         
-        result = json.loads(response.choices[0].message.content)
+        result = orjson.loads(response.choices[0].message.content)
         categories = result.get("categories", [])
         
-        print(f"Categorías identificadas: {categories}")
+        logger.debug("Categorías identificadas: %s", categories)
         return categories
     except Exception as e:
         print(f"Error identificando categorías: {e}")
         # Devolver algunas categorías generales en caso de error
         return ["Logística", "Amazon FBA y FBM"]
 
-@pydantic_ai_expert.tool
+# Similitud coseno mínima para aceptar las categorías sin consultar al LLM
+CATEGORY_MATCH_THRESHOLD = float(os.getenv('CATEGORY_MATCH_THRESHOLD', '0.3'))
+CATEGORY_TOP_K = 3
+
+_CATEGORY_NAMES = list(AMAZON_CATEGORIES)
+_CAT_EMB: Optional[np.ndarray] = None  # (n_categorías, 1536) float32, normalizada L2
+_cat_emb_lock = asyncio.Lock()
+
+async def _get_category_embeddings(openai_client: AsyncOpenAI) -> np.ndarray:
+    """
+    Calcula una sola vez (en una única petición) los embeddings de todas las categorías.
+    """
+    global _CAT_EMB
+    if _CAT_EMB is None:
+        async with _cat_emb_lock:
+            if _CAT_EMB is None:
+                response = await openai_client.embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=[f"{name}: {description}" for name, description in AMAZON_CATEGORIES.items()]
+                )
+                matrix = np.array([data.embedding for data in response.data], dtype=np.float32)
+                _CAT_EMB = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    return _CAT_EMB
+
+async def classify_categories(ctx: RunContext[PydanticAIDeps], user_query: str, query_embedding: np.ndarray) -> List[str]:
+    """
+    Clasifica la consulta comparando su embedding con el de cada categoría.
+    
+    Args:
+        ctx: El contexto con el cliente OpenAI
+        user_query: La pregunta del usuario
+        query_embedding: El embedding ya calculado de la pregunta
+        
+    Returns:
+        Las categorías más similares, o las que identifique el LLM si ninguna supera el umbral
+    """
+    try:
+        cat_emb = await _get_category_embeddings(ctx.deps.openai_client)
+        norm = np.linalg.norm(query_embedding)
+        if norm > 0:
+            scores = cat_emb @ (query_embedding / norm)
+            top = np.argpartition(scores, -CATEGORY_TOP_K)[-CATEGORY_TOP_K:]
+            top = top[np.argsort(scores[top])[::-1]]
+            if scores[top[0]] >= CATEGORY_MATCH_THRESHOLD:
+                return [_CATEGORY_NAMES[i] for i in top]
+    except Exception as e:
+        print(f"Error clasificando categorías por embeddings: {e}")
+    
+    return await identify_relevant_categories(ctx, user_query)
+
 async def retrieve_relevant_documentation(ctx: RunContext[PydanticAIDeps], user_query: str, marketplace: str = 'amazon') -> str:
     """
     Retrieve relevant documentation chunks based on the query with RAG.
@@ -142,21 +368,22 @@ async def retrieve_relevant_documentation(ctx: RunContext[PydanticAIDeps], user_
     Returns:
         A formatted string containing the top 5 most relevant documentation chunks
     """
-    print(f"🔍 TOOL CALLED: retrieve_relevant_documentation - Query: '{user_query}', Marketplace: {marketplace}")
+    logger.debug("TOOL CALLED: retrieve_relevant_documentation - Query: %r, Marketplace: %s", user_query, marketplace)
     
     try:
-        # Primero identificar categorías relevantes
-        categories = await identify_relevant_categories(ctx, user_query)
-        
-        # Get the embedding for the query
+        # Obtener el embedding y clasificar la consulta por similitud con las categorías
+        # (solo se llama al LLM si ninguna categoría se parece lo suficiente).
+        # Es secuencial a propósito: la clasificación necesita el embedding, y lanzar el LLM
+        # en paralelo (como antes con gather) pagaría una completion que casi nunca se usa
         query_embedding = await get_embedding(user_query, ctx.deps.openai_client)
+        categories = await classify_categories(ctx, user_query, query_embedding)
         
         # Intentar usar la función optimizada si existe
         try:
             result = ctx.deps.supabase.rpc(
                 'match_documents_by_category',
                 {
-                    'query_embedding': query_embedding,
+                    'query_embedding': query_embedding.tolist(),
                     'categories': categories,
                     'match_count': 5,
                     'match_threshold': 0.5
@@ -164,49 +391,27 @@ async def retrieve_relevant_documentation(ctx: RunContext[PydanticAIDeps], user_
             ).execute()
         except Exception as e:
             print(f"Error usando match_documents_by_category: {e}")
-            print("Usando match_site_pages como fallback...")
-            # Fallback a la función original si la optimizada no existe
+            print("Usando match_site_pages_with_categories como fallback...")
+            # Fallback: búsqueda vectorial filtrando solo por marketplace
             result = ctx.deps.supabase.rpc(
-                'match_site_pages',
+                'match_site_pages_with_categories',
                 {
-                    'query_embedding': query_embedding,
-                    'match_count': 5,
+                    'query_embedding': query_embedding.tolist(),
                     'marketplace_filter': marketplace,
+                    'match_count': 5,
                 }
             ).execute()
         
         if not result.data:
             return f"No relevant documentation found. I searched in these categories: {', '.join(categories)}."
             
-        # Format the results
-        formatted_chunks = []
-        for doc in result.data:
-            # Incluir categoría y marketplace en el encabezado
-            category_info = f"[{', '.join(doc['category'])}]" if 'category' in doc and doc['category'] else ""
-            marketplace_info = f"[{doc['marketplace'].upper()}]" if 'marketplace' in doc else ""
-            header_info = " ".join(filter(None, [category_info, marketplace_info]))
-            
-            # Incluir resumen si está disponible
-            summary = f"\n\n**Summary**: {doc['summary']}" if 'summary' in doc and doc['summary'] else ""
-            
-            chunk_text = f"""
-# {doc['title']} {header_info}
-{summary}
-
-{doc['content']}
-
-Source: {doc['url']}
-"""
-            formatted_chunks.append(chunk_text)
-            
-        # Join all chunks with a separator
-        return "\n\n---\n\n".join(formatted_chunks)
+        # Format the results and join all chunks with a separator
+        return "\n\n---\n\n".join([_format_doc(doc) for doc in result.data])
         
     except Exception as e:
         print(f"Error retrieving documentation: {e}")
         return f"Error retrieving documentation: {str(e)}"
 
-@pydantic_ai_expert.tool
 async def retrieve_documentation_by_category(ctx: RunContext[PydanticAIDeps], user_query: str, specific_categories: List[str]) -> str:
     """
     Busca documentación relevante filtrando específicamente por categorías proporcionadas.
@@ -219,7 +424,7 @@ async def retrieve_documentation_by_category(ctx: RunContext[PydanticAIDeps], us
     Returns:
         Documentación relevante formateada
     """
-    print(f"🔍 TOOL CALLED: retrieve_documentation_by_category - Query: '{user_query}', Categories: {specific_categories}")
+    logger.debug("TOOL CALLED: retrieve_documentation_by_category - Query: %r, Categories: %s", user_query, specific_categories)
     
     try:
         # Get the embedding for the query
@@ -230,7 +435,7 @@ async def retrieve_documentation_by_category(ctx: RunContext[PydanticAIDeps], us
             result = ctx.deps.supabase.rpc(
                 'match_documents_by_category',
                 {
-                    'query_embedding': query_embedding,
+                    'query_embedding': query_embedding.tolist(),
                     'categories': specific_categories,
                     'match_count': 5,
                     'match_threshold': 0.5
@@ -238,56 +443,27 @@ async def retrieve_documentation_by_category(ctx: RunContext[PydanticAIDeps], us
             ).execute()
         except Exception as e:
             print(f"Error usando match_documents_by_category: {e}")
-            # Fallback: filtrar manualmente por categoría después de la búsqueda vectorial
+            # Fallback: búsqueda vectorial filtrando por categoría en la misma consulta SQL
             result = ctx.deps.supabase.rpc(
-                'match_site_pages',
+                'match_site_pages_with_categories',
                 {
-                    'query_embedding': query_embedding,
-                    'match_count': 10,  # Buscar más para compensar el filtrado posterior
+                    'query_embedding': query_embedding.tolist(),
                     'marketplace_filter': 'amazon',
+                    'categories': specific_categories,
+                    'match_count': 5,
                 }
             ).execute()
-            
-            # Filtrar manualmente por categoría
-            if result.data:
-                filtered_data = []
-                for doc in result.data:
-                    if 'category' in doc and doc['category']:
-                        # Verificar si hay intersección entre las categorías
-                        if any(cat in specific_categories for cat in doc['category']):
-                            filtered_data.append(doc)
-                
-                result.data = filtered_data[:5]  # Limitar a 5 resultados
         
         if not result.data:
             return f"No relevant documentation found in the specified categories: {', '.join(specific_categories)}."
             
         # Format the results (igual que en retrieve_relevant_documentation)
-        formatted_chunks = []
-        for doc in result.data:
-            category_info = f"[{', '.join(doc['category'])}]" if 'category' in doc and doc['category'] else ""
-            marketplace_info = f"[{doc['marketplace'].upper()}]" if 'marketplace' in doc else ""
-            header_info = " ".join(filter(None, [category_info, marketplace_info]))
-            
-            summary = f"\n\n**Summary**: {doc['summary']}" if 'summary' in doc and doc['summary'] else ""
-            
-            chunk_text = f"""
-# {doc['title']} {header_info}
-{summary}
-
-{doc['content']}
-
-Source: {doc['url']}
-"""
-            formatted_chunks.append(chunk_text)
-            
-        return "\n\n---\n\n".join(formatted_chunks)
+        return "\n\n---\n\n".join([_format_doc(doc) for doc in result.data])
         
     except Exception as e:
         print(f"Error retrieving documentation by category: {e}")
         return f"Error retrieving documentation by category: {str(e)}"
 
-@pydantic_ai_expert.tool
 async def get_quick_overview(ctx: RunContext[PydanticAIDeps], topic: str) -> str:
     """
     Proporciona una visión general rápida basada en resúmenes de documentos.
@@ -299,16 +475,14 @@ async def get_quick_overview(ctx: RunContext[PydanticAIDeps], topic: str) -> str
     Returns:
         Visión general basada en resúmenes
     """
-    print(f"🔍 TOOL CALLED: get_quick_overview - Topic: '{topic}'")
+    logger.debug("TOOL CALLED: get_quick_overview - Topic: %r", topic)
     
     try:
-        # Buscar documentos relevantes por título o palabras clave
-        result = ctx.deps.supabase.from_('site_pages') \
-            .select('title, summary, url, category') \
-            .or_(f"title.ilike.%{topic}%,content.ilike.%{topic}%") \
-            .order('created_at', desc=True) \
-            .limit(5) \
-            .execute()
+        # Búsqueda de texto completo sobre título y contenido (índice GIN), ya ordenada por relevancia
+        result = ctx.deps.supabase.rpc(
+            'search_site_pages_overview',
+            {'topic': topic, 'match_count': 5}
+        ).execute()
         
         if not result.data:
             return f"No se encontraron resúmenes sobre '{topic}'."
@@ -325,7 +499,6 @@ async def get_quick_overview(ctx: RunContext[PydanticAIDeps], topic: str) -> str
         print(f"Error obteniendo visión general: {e}")
         return f"Error obteniendo visión general: {str(e)}"
 
-@pydantic_ai_expert.tool
 async def list_documentation_pages(ctx: RunContext[PydanticAIDeps], category: str = None) -> str:
     """
     Retrieve a list of all available documentation pages, optionally filtered by category.
@@ -337,57 +510,24 @@ async def list_documentation_pages(ctx: RunContext[PydanticAIDeps], category: st
     Returns:
         str: Formatted list of documentation pages grouped by category
     """
-    print(f"🔍 TOOL CALLED: list_documentation_pages - Category: '{category}'")
+    logger.debug("TOOL CALLED: list_documentation_pages - Category: %r", category)
     
     try:
-        # Build query without distinct
-        query = ctx.deps.supabase.from_('site_pages').select('url, title, category')
-        
-        # Apply category filter if provided
-        if category:
-            query = query.contains('category', [category])
-            
-        # Execute query
-        result = query.execute()
+        # Páginas distintas por URL, ya agrupadas y ordenadas por categoría en la base de datos
+        result = ctx.deps.supabase.rpc('list_distinct_pages', {'category_filter': category or None}).execute()
         
         if not result.data:
             return "No documentation pages found."
-        
-        # Manually handle distinct URLs
-        seen_urls = set()
-        distinct_pages = []
-        for page in result.data:
-            if page['url'] not in seen_urls:
-                seen_urls.add(page['url'])
-                distinct_pages.append(page)
             
-        # Group by category
-        pages_by_category = {}
-        for doc in distinct_pages:
-            # Manejar múltiples categorías por documento
-            if 'category' in doc and doc['category']:
-                for cat in doc['category']:
-                    if cat not in pages_by_category:
-                        pages_by_category[cat] = []
-                    
-                    title = doc.get('title', 'Untitled')
-                    url = doc.get('url', '')
-                    pages_by_category[cat].append(f"- [{title}]({url})")
-            else:
-                # Documentos sin categoría
-                if "Uncategorized" not in pages_by_category:
-                    pages_by_category["Uncategorized"] = []
-                
-                title = doc.get('title', 'Untitled')
-                url = doc.get('url', '')
-                pages_by_category["Uncategorized"].append(f"- [{title}]({url})")
-        
-        # Format the output
+        # Format the output, adding a header each time the category changes
         output = ["# Available Documentation Pages"]
+        current_category = None
         
-        for cat, pages in sorted(pages_by_category.items()):
-            output.append(f"\n## {cat}")
-            output.extend(pages)
+        for page in result.data:
+            if page['category'] != current_category:
+                current_category = page['category']
+                output.append(f"\n## {current_category}")
+            output.append(f"- [{page.get('title') or 'Untitled'}]({page.get('url') or ''})")
             
         return "\n".join(output)
         
@@ -395,7 +535,6 @@ async def list_documentation_pages(ctx: RunContext[PydanticAIDeps], category: st
         print(f"Error retrieving documentation pages: {e}")
         return f"Error retrieving documentation pages: {str(e)}"
 
-@pydantic_ai_expert.tool
 async def get_page_content(ctx: RunContext[PydanticAIDeps], url: str) -> str:
     """
     Retrieve the full content of a specific documentation page by combining all its chunks.
@@ -407,24 +546,22 @@ async def get_page_content(ctx: RunContext[PydanticAIDeps], url: str) -> str:
     Returns:
         str: The complete page content with all chunks combined in order
     """
-    print(f"🔍 TOOL CALLED: get_page_content - URL: '{url}'")
+    logger.debug("TOOL CALLED: get_page_content - URL: %r", url)
     
     try:
-        # Verificar primero cuántos chunks tiene el documento
-        count_result = ctx.deps.supabase.from_('site_pages').select('count', count='exact').eq('url', url).execute()
-        chunk_count = count_result.count
-        
-        # Advertir si el documento es muy grande
-        if chunk_count > 10:
-            return f"Este documento es muy grande ({chunk_count} chunks). Por favor, especifica una consulta más enfocada o solicita una sección específica."
-        
-        # Query Supabase for all chunks of this URL, ordered by chunk_number
+        # Query Supabase for the chunks of this URL, ordered by chunk_number.
+        # Se pide uno más del máximo (11) para detectar documentos grandes sin un COUNT previo
         result = ctx.deps.supabase.from_('site_pages') \
             .select('title, content, chunk_number, category, summary') \
             .eq('url', url) \
             .order('chunk_number') \
+            .limit(11) \
             .execute()
         
+        # Advertir si el documento es muy grande
+        if len(result.data) > 10:
+            return "Este documento es muy grande (más de 10 chunks). Por favor, especifica una consulta más enfocada o solicita una sección específica."
+        
         if not result.data:
             return f"No content found for URL: {url}"
             
@@ -453,8 +590,36 @@ async def get_page_content(ctx: RunContext[PydanticAIDeps], url: str) -> str:
         print(f"Error retrieving page content: {e}")
         return f"Error retrieving page content: {str(e)}"
 
+@lru_cache()
+def get_expert_agent() -> Agent:
+    """
+    Crea el agente experto la primera vez que se usa y lo reutiliza después.
+    """
+    # RunContext se publica en el módulo solo aquí, para que pydantic_ai pueda resolver
+    # las anotaciones (diferidas) de las herramientas al registrarlas
+    global RunContext
+    from pydantic_ai import Agent, RunContext
+    from pydantic_ai.models.openai import OpenAIModel
+    
+    configure_logfire()
+    
+    return Agent(
+        OpenAIModel(llm),
+        system_prompt=system_prompt,
+        deps_type=PydanticAIDeps,
+        retries=2,
+        tools=[
+            identify_relevant_categories,
+            retrieve_relevant_documentation,
+            retrieve_documentation_by_category,
+            get_quick_overview,
+            list_documentation_pages,
+            get_page_content,
+        ]
+    )
+
 async def run_with_stats(deps, user_input):
-    result = await pydantic_ai_expert.run(
+    result = await get_expert_agent().run(
         user_input,
         deps=deps
     )
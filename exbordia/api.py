@@ -1,36 +1,36 @@
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Dict, Any, Optional
-import os
-from openai import AsyncOpenAI
+import orjson
 from supabase import create_client
-from dotenv import load_dotenv
 
-from config import DEBUG
+from config import DEBUG, SUPABASE_URL, SUPABASE_SERVICE_KEY, create_openai_client
+from database.pool import create_pg_pool
 from orchestrator.orchestrator import Orchestrator
 from services.conversation_service import ConversationService
 from state.state_manager import StateManager
+from utils.validators import direct_response
+from workflows.general_workflow import drain_background_tasks
 
 # Inicializar la aplicación FastAPI
 app = FastAPI(
     title="Exbordia API",
     description="API para el sistema de orquestación de agentes Exbordia",
     version="0.1.0",
-    debug=DEBUG
+    debug=DEBUG,
+    default_response_class=ORJSONResponse  # orjson serializa más rápido que json
 )
 
 # Inicializar servicios
-load_dotenv()
 supabase = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_KEY")
+    SUPABASE_URL,
+    SUPABASE_SERVICE_KEY
 )
 conversation_service = ConversationService(database=supabase)
 
-# Inicializar cliente de OpenAI
-openai_client = AsyncOpenAI(
-    api_key=os.getenv("OPENAI_API_KEY")
-)
+# Inicializar cliente de OpenAI (pool de conexiones compartido)
+openai_client = create_openai_client()
 
 # Inicializar el orquestador
 orchestrator = Orchestrator(
@@ -39,6 +39,24 @@ orchestrator = Orchestrator(
     openai_client=openai_client
 )
 
+@app.on_event("startup")
+async def open_pools():
+    """
+    Abre el pool de conexiones a Postgres (si hay DATABASE_URL) para el servicio de conversación.
+    """
+    conversation_service.pool = await create_pg_pool()
+
+@app.on_event("shutdown")
+async def close_clients():
+    """
+    Espera a que terminen los guardados en segundo plano y cierra los pools de
+    conexiones (OpenAI y Postgres) al apagar la API.
+    """
+    await drain_background_tasks()
+    await openai_client.close()
+    if conversation_service.pool:
+        await conversation_service.pool.close()
+
 # Modelos de datos
 class MessageRequest(BaseModel):
     telegram_id: int = 0
@@ -56,6 +74,14 @@ async def process_message(request: MessageRequest):
     Procesa un mensaje del usuario y devuelve una respuesta.
     """
     try:
+        # Responder sin LLM a saludos, agradecimientos y mensajes triviales
+        canned = direct_response(request.query)
+        if canned:
+            return {
+                "response": canned,
+                "session_id": str(request.session_id) if request.session_id else "new_session"
+            }
+        
         # Usar el orquestador para procesar el mensaje
         result = await orchestrator.process_message(
             user_id=request.telegram_id,
@@ -71,6 +97,38 @@ async def process_message(request: MessageRequest):
         print(f"Error al procesar mensaje: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def sse_frame(payload: dict) -> str:
+    """Formatea un evento Server-Sent Events."""
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+@app.post("/message/stream")
+async def process_message_stream(request: MessageRequest):
+    """
+    Procesa un mensaje del usuario y devuelve la respuesta en streaming (SSE)
+    a medida que el modelo la genera.
+    """
+    session_id = str(request.session_id) if request.session_id else "new_session"
+    
+    async def event_generator():
+        try:
+            # Responder sin LLM a saludos, agradecimientos y mensajes triviales
+            canned = direct_response(request.query)
+            if canned:
+                yield sse_frame({"delta": canned, "session_id": session_id})
+            else:
+                async for delta in orchestrator.stream_message(
+                    user_id=request.telegram_id,
+                    session_id=request.session_id,
+                    message=request.query
+                ):
+                    yield sse_frame({"delta": delta, "session_id": session_id})
+        except Exception as e:
+            print(f"Error al procesar mensaje en streaming: {e}")
+            yield sse_frame({"error": str(e)})
+        yield "data: [DONE]\n\n"
+    
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
 @app.get("/health")
 async def health_check():
     """
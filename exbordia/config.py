@@ -8,10 +8,51 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
+
+# Conexión directa a Postgres (opcional) para las consultas más frecuentes
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "25"))
 
 # Configuración de la aplicación
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
 # Modelos de IA
-DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "gpt-4o")
\ No newline at end of file
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "gpt-4o")
+
+# Límites de uso de OpenAI
+MAX_CONCURRENT_RUNS = int(os.getenv("MAX_CONCURRENT_RUNS", "20"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+
+_openai_agents_configured = False
+
+def create_openai_client():
+    """
+    Crea un cliente AsyncOpenAI con un pool de conexiones HTTP/2 persistente.
+    Debe crearse una vez por proceso y reutilizarse en todas las peticiones.
+    """
+    import httpx
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=500, max_keepalive_connections=100),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            http2=True,  # Requiere h2; multiplexa las llamadas concurrentes sobre la misma conexión
+            headers={"Accept-Encoding": "gzip"}  # httpx descomprime las respuestas automáticamente
+        )
+    )
+
+def configure_openai_agents():
+    """
+    Configura el cliente por defecto del SDK de agentes una sola vez por proceso.
+    El cliente reintenta con backoff exponencial los errores 429 y 5xx.
+    """
+    global _openai_agents_configured
+    if not _openai_agents_configured:
+        from agents import set_default_openai_client
+        set_default_openai_client(create_openai_client())
+        _openai_agents_configured = True
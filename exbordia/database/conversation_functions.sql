@@ -0,0 +1,135 @@
+-- Funciones RPC de Supabase usadas por services/conversation_service.py
+
+-- Último message_sequence de cada sesión; el upsert sobre esta fila genera la secuencia
+-- de forma atómica y serializa los turnos concurrentes de la misma sesión
+create table if not exists conversation_sequences (
+    user_id uuid not null,
+    session_id bigint not null,
+    last_seq int not null,
+    primary key (user_id, session_id)
+);
+
+-- Inicializar con las sesiones existentes (solo necesario una vez al migrar)
+insert into conversation_sequences (user_id, session_id, last_seq)
+select user_id, session_id, max(message_sequence)
+from user_conversations
+group by user_id, session_id
+on conflict (user_id, session_id) do nothing;
+
+-- Garantiza que dos turnos no compartan secuencia dentro de una sesión
+create unique index if not exists user_conversations_session_sequence
+  on user_conversations (user_id, session_id, message_sequence);
+
+-- Guarda un turno de conversación en una sola llamada: resuelve telegram_id -> auth_user_id,
+-- obtiene el siguiente message_sequence de la sesión (conversation_sequences) e inserta la fila
+drop function if exists save_conversation_turn (bigint, bigint, text, text, int, float, int);
+
+create or replace function save_conversation_turn (
+  p_telegram_id bigint,
+  p_session_id bigint,
+  p_question text,
+  p_answer text,
+  p_total_tokens int default 0,
+  p_execution_time float default 0
+) returns setof user_conversations
+language plpgsql
+as $$
+declare
+  v_user_id uuid;
+  v_next_sequence int;
+begin
+  select tu.auth_user_id
+  into v_user_id
+  from telegram_users tu
+  where tu.telegram_id = p_telegram_id;
+
+  if v_user_id is null then
+    raise exception 'Usuario con telegram_id % no encontrado', p_telegram_id;
+  end if;
+
+  -- Siguiente secuencia en una sola escritura atómica (sin SELECT MAX ni bloqueos en el cliente)
+  insert into conversation_sequences as cs (user_id, session_id, last_seq)
+  values (v_user_id, p_session_id, 1)
+  on conflict (user_id, session_id) do update
+    set last_seq = cs.last_seq + 1
+  returning cs.last_seq into v_next_sequence;
+
+  return query
+  insert into user_conversations (
+    user_id,
+    session_id,
+    question,
+    answer,
+    total_tokens,
+    execution_time,
+    message_sequence,
+    metadata
+  ) values (
+    v_user_id,
+    p_session_id,
+    p_question,
+    p_answer,
+    p_total_tokens,
+    p_execution_time,
+    v_next_sequence,
+    '{}'::jsonb
+  )
+  returning *;
+end;
+$$;
+
+-- Reserva p_count secuencias consecutivas de una sesión en una sola escritura
+-- (inserciones masivas); devuelve la primera de ellas
+create or replace function reserve_conversation_sequences (
+  p_user_id uuid,
+  p_session_id bigint,
+  p_count int
+) returns int
+language plpgsql
+as $$
+declare
+  v_last_sequence int;
+begin
+  insert into conversation_sequences as cs (user_id, session_id, last_seq)
+  values (p_user_id, p_session_id, p_count)
+  on conflict (user_id, session_id) do update
+    set last_seq = cs.last_seq + excluded.last_seq
+  returning cs.last_seq into v_last_sequence;
+
+  return v_last_sequence - p_count + 1;
+end;
+$$;
+
+-- Actualiza el análisis de un lote de conversaciones con un único UPDATE ... FROM;
+-- p_rows es un array JSON de objetos {id, sentiment, summary, topics, metadata}
+create or replace function update_conversation_analyses (
+  p_rows jsonb
+) returns int
+language plpgsql
+as $$
+declare
+  v_updated int;
+begin
+  update user_conversations uc
+  set sentiment = v.sentiment,
+      summary = v.summary,
+      topics = v.topics,
+      metadata = v.metadata
+  from jsonb_populate_recordset(null::user_conversations, p_rows) v
+  where uc.id = v.id;
+
+  get diagnostics v_updated = row_count;
+  return v_updated;
+end;
+$$;
+
+-- Las inserciones masivas (COPY) no envían metadata
+alter table user_conversations alter column metadata set default '{}'::jsonb;
+
+-- Caché de análisis de conversaciones por contenido (sha256 de pregunta + respuesta),
+-- compartida entre procesos
+create table if not exists llm_analysis_cache (
+    content_hash text primary key,
+    analysis jsonb not null,
+    created_at timestamp with time zone default timezone('utc', now()) not null
+);
@@ -0,0 +1,8 @@
+-- Caché persistente de embeddings usada por tools/notion_uploader.py.
+-- La clave es el sha256 del modelo y el texto: el mismo chunk no se vuelve a enviar a OpenAI
+-- al reprocesar un documento de Notion sin cambios
+create table if not exists embedding_cache (
+    hash text primary key,
+    embedding vector(1536) not null,
+    created_at timestamp with time zone default timezone('utc', now()) not null
+);
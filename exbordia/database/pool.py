@@ -0,0 +1,34 @@
+import orjson
+
+from config import DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE
+
+async def _init_connection(conn) -> None:
+    """
+    Decodifica las columnas json/jsonb como objetos de Python (igual que el cliente de Supabase).
+    """
+    for type_name in ("json", "jsonb"):
+        await conn.set_type_codec(
+            type_name,
+            encoder=lambda value: orjson.dumps(value).decode(),
+            decoder=orjson.loads,
+            schema="pg_catalog"
+        )
+
+async def create_pg_pool():
+    """
+    Crea el pool de conexiones a Postgres compartido por todo el proceso.
+    
+    Devuelve None si no hay DATABASE_URL configurada; en ese caso los servicios
+    siguen usando el cliente de Supabase. Usar la conexión directa o el pooler en
+    modo sesión (puerto 5432): asyncpg prepara y cachea las sentencias por conexión.
+    """
+    if not DATABASE_URL:
+        return None
+    
+    import asyncpg
+    return await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        init=_init_connection
+    )
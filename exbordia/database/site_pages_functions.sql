@@ -0,0 +1,156 @@
+-- Funciones RPC de Supabase usadas por las herramientas del agente de documentación
+-- (ai_agents/pydantic_agent.py) sobre la tabla site_pages
+
+-- Índices para deduplicar por URL y filtrar por categoría
+create index if not exists idx_site_pages_url on site_pages (url);
+create index if not exists idx_site_pages_category on site_pages using gin (category);
+
+-- Lista las páginas distintas (una fila por URL y categoría), ya agrupadas y ordenadas por categoría.
+-- Las páginas sin categoría se devuelven como 'Uncategorized'.
+create or replace function list_distinct_pages (
+  category_filter text default null
+) returns table (
+  category text,
+  url varchar,
+  title varchar
+)
+language sql stable
+as $$
+  with pages as (
+    select distinct on (sp.url)
+      sp.url,
+      sp.title,
+      sp.category
+    from site_pages sp
+    where category_filter is null or category_filter = any(sp.category)
+    order by sp.url, sp.created_at desc
+  )
+  select
+    coalesce(c.cat, 'Uncategorized') as category,
+    pages.url,
+    pages.title
+  from pages
+  left join lateral unnest(pages.category) as c(cat) on true
+  order by coalesce(c.cat, 'Uncategorized') collate "C", pages.title;
+$$;
+
+-- Búsqueda de texto completo para get_quick_overview (sustituye los ILIKE '%tema%', que no usan índices)
+alter table site_pages add column if not exists search_vec tsvector
+  generated always as (to_tsvector('spanish', coalesce(title, '') || ' ' || coalesce(content, ''))) stored;
+
+create index if not exists idx_site_pages_search_vec on site_pages using gin (search_vec);
+
+-- Devuelve los resúmenes más relevantes para un tema, ordenados por ranking
+create or replace function search_site_pages_overview (
+  topic text,
+  match_count int default 5
+) returns table (
+  title varchar,
+  summary varchar,
+  url varchar,
+  category text[],
+  rank real
+)
+language sql stable
+as $$
+  select
+    sp.title,
+    sp.summary,
+    sp.url,
+    sp.category,
+    ts_rank(sp.search_vec, query) as rank
+  from site_pages sp,
+       websearch_to_tsquery('spanish', topic) as query
+  where sp.search_vec @@ query
+  order by rank desc, sp.created_at desc
+  limit match_count;
+$$;
+
+-- Búsqueda vectorial con filtros opcionales de marketplace y categorías en una sola consulta
+-- (categories && usa el índice GIN idx_site_pages_category)
+create or replace function match_site_pages_with_categories (
+  query_embedding vector(1536),
+  marketplace_filter text default null,
+  categories text[] default null,
+  match_count int default 5
+) returns table (
+  id bigint,
+  url varchar,
+  marketplace varchar,
+  chunk_number integer,
+  title varchar,
+  summary varchar,
+  content text,
+  category text[],
+  similarity float
+)
+language sql stable
+as $$
+  select
+    sp.id,
+    sp.url,
+    sp.marketplace,
+    sp.chunk_number,
+    sp.title,
+    sp.summary,
+    sp.content,
+    sp.category,
+    1 - (sp.embedding <=> query_embedding) as similarity
+  from site_pages sp
+  where (marketplace_filter is null or sp.marketplace = marketplace_filter)
+    and (categories is null or sp.category && categories)
+  order by sp.embedding <=> query_embedding
+  limit match_count;
+$$;
+
+-- Caché semántica de tools/notion_uploader.py: devuelve el chunk más parecido si su similitud
+-- coseno supera el umbral, para reutilizar su título, resumen y categorías sin llamar al LLM
+create or replace function match_chunk (
+  embedding vector(1536),
+  threshold float default 0.98
+) returns table (
+  title varchar,
+  summary varchar,
+  category text[],
+  similarity float
+)
+language sql stable
+as $$
+  select
+    sp.title,
+    sp.summary,
+    sp.category,
+    1 - (sp.embedding <=> match_chunk.embedding) as similarity
+  from site_pages sp
+  where 1 - (sp.embedding <=> match_chunk.embedding) > threshold
+  order by sp.embedding <=> match_chunk.embedding
+  limit 1;
+$$;
+
+-- Sustituye todos los chunks de un documento (tools/notion_uploader.py) en una sola transacción:
+-- si la inserción falla, el borrado se deshace y el documento conserva su versión anterior.
+-- p_rows es un array JSON de filas de site_pages
+create or replace function replace_document_chunks (
+  p_url text,
+  p_rows jsonb
+) returns int
+language plpgsql
+as $$
+declare
+  v_inserted int;
+begin
+  delete from site_pages where url = p_url;
+
+  insert into site_pages (
+    url, chunk_number, title, summary, content, marketplace, category,
+    source_name, metadata, embedding, source_id, related_links
+  )
+  select
+    r.url, r.chunk_number, r.title, r.summary, r.content, r.marketplace, r.category,
+    r.source_name, r.metadata, r.embedding, r.source_id, r.related_links
+  from jsonb_populate_recordset(null::site_pages, p_rows) r;
+
+  get diagnostics v_inserted = row_count;
+  return v_inserted;
+end;
+$$;
@@ -1,4 +1,4 @@
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, AsyncIterator
 from services.conversation_service import ConversationService
 from state.state_manager import StateManager
 from workflows import initialize_workflows
@@ -34,4 +34,16 @@ class Orchestrator:
             message=message
         )
         
-        return result
\ No newline at end of file
+        return result
+    
+    def stream_message(self, user_id: str, session_id: str, message: str) -> AsyncIterator[str]:
+        """
+        Procesa un mensaje y devuelve la respuesta en fragmentos a medida que se genera.
+        """
+        workflow = self.workflows["general"]
+        
+        return workflow.stream(
+            user_id=user_id,
+            session_id=session_id,
+            message=message
+        )
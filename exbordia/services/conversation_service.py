@@ -1,22 +1,205 @@
-from typing import Dict, List, Any, Optional
-from datetime import datetime
+from typing import Dict, List, Any, Optional, Tuple
+from datetime import datetime, timedelta
+from collections.abc import Mapping
+from functools import lru_cache
+import asyncio
+import hashlib
 import uuid
-import json
+import orjson
+
+from memoize.configuration import DefaultInMemoryCacheConfiguration, MutableCacheConfiguration
+from memoize.key import KeyExtractor
+from memoize.wrapper import memoize
+
+async def _execute(query):
+    """
+    Ejecuta una consulta del cliente (síncrono) de Supabase en un hilo aparte,
+    para no bloquear el event loop durante la llamada HTTP.
+    """
+    return await asyncio.to_thread(query.execute)
+
+def _row_to_dict(row) -> Dict[str, Any]:
+    """
+    Convierte una fila de asyncpg en un diccionario con los mismos tipos que devuelve
+    Supabase (PostgREST): los UUID como texto y las fechas en ISO 8601.
+    """
+    result = dict(row)
+    for key, value in result.items():
+        if isinstance(value, uuid.UUID):
+            result[key] = str(value)
+        elif isinstance(value, datetime):
+            result[key] = value.isoformat()
+    return result
+
+@memoize(configuration=MutableCacheConfiguration.initialized_with(
+    DefaultInMemoryCacheConfiguration(
+        capacity=10000,
+        method_timeout=timedelta(seconds=60),
+        update_after=timedelta(minutes=10),
+        expire_after=timedelta(hours=1)
+    )
+))
+async def _fetch_auth_user_id(database, telegram_id: int) -> str:
+    """
+    Consulta el auth_user_id de un usuario de Telegram.
+    
+    Cacheada con TTL y límite de tamaño; las búsquedas concurrentes del mismo
+    telegram_id comparten una sola consulta a la base de datos.
+    """
+    user_result = await _execute(
+        database.from_("telegram_users")
+            .select("auth_user_id")
+            .eq("telegram_id", telegram_id)
+    )
+    
+    if not user_result.data:
+        raise ValueError(f"Usuario con telegram_id {telegram_id} no encontrado")
+    
+    return user_result.data[0]["auth_user_id"]
+
+# Prompt de análisis de conversaciones (sin sangría para no enviar espacios de más a OpenAI)
+# El análisis es un JSON pequeño: modelo barato y salida acotada (la latencia crece con los tokens generados)
+_ANALYSIS_MODEL = "gpt-4o-mini"
+_ANALYSIS_MAX_TOKENS = 200
+
+_ANALYSIS_SYSTEM_MSG = {"role": "system", "content": "Eres un asistente especializado en análisis de conversaciones."}
+
+_ANALYSIS_PROMPT_TMPL = """Analiza la siguiente conversación entre un usuario y un asistente:
+
+Usuario: {question}
+
+Asistente: {answer}
+
+Por favor, proporciona la siguiente información en formato JSON:
+1. sentiment: El sentimiento general del usuario (positivo, negativo o neutral)
+2. summary: Un breve resumen de la conversación (máximo 100 caracteres)
+3. topics: Una lista de hasta 3 temas principales discutidos
+4. entities: Una lista de entidades mencionadas (productos, lugares, personas, etc.)
+5. intent: La intención principal del usuario (consulta, queja, solicitud, etc.)
+
+Responde solo con el JSON, sin texto adicional.
+"""
+
+class _ContentHashKeyExtractor(KeyExtractor):
+    """Usa como clave de caché el hash del contenido analizado."""
+
+    def format_key(self, method_reference, call_args: Tuple, call_kwargs: Dict[str, Any]) -> str:
+        return call_kwargs["content_hash"]
+
+@memoize(configuration=MutableCacheConfiguration.initialized_with(
+    DefaultInMemoryCacheConfiguration(
+        capacity=10000,
+        method_timeout=timedelta(seconds=60),
+        update_after=timedelta(hours=24),
+        expire_after=timedelta(hours=24)
+    )
+).set_key_extractor(_ContentHashKeyExtractor()))
+async def _cached_analysis(content_hash: str, service, question: str, answer: str, openai_client) -> Dict[str, Any]:
+    """
+    Análisis de una conversación cacheado en memoria por sha256(pregunta + respuesta).
+    """
+    return await service._fetch_analysis(
+        content_hash=content_hash,
+        question=question,
+        answer=answer,
+        openai_client=openai_client
+    )
+
+# Consultas para el pool de asyncpg (se preparan y cachean por conexión)
+SQL_SAVE_TURN = "select * from save_conversation_turn($1, $2, $3, $4, $5, $6)"
+
+# Columnas que usa el contexto del agente; metadata puede ser grande, el resto no hace falta
+CONTEXT_COLUMNS = "id,question,answer,message_sequence,metadata"
+
+SQL_RECENT_CONVERSATIONS = """
+select uc.id, uc.question, uc.answer, uc.message_sequence, uc.metadata
+from user_conversations uc
+join telegram_users tu on tu.auth_user_id = uc.user_id
+where tu.telegram_id = $1
+  and uc.session_id = $2
+order by uc.message_sequence desc
+limit $3
+"""
+
+SQL_CONVERSATION_BY_ID = f"select {CONTEXT_COLUMNS} from user_conversations where id = $1"
+
+SQL_CONVERSATION_FULL = "select * from user_conversations where id = $1"
+
+SQL_UPDATE_ANALYSES = "select update_conversation_analyses($1)"
+
+SQL_RESERVE_SEQUENCES = "select reserve_conversation_sequences($1, $2, $3)"
+
+# Columnas que escribe save_conversations_bulk (metadata toma su valor por defecto)
+BULK_COLUMNS = [
+    "user_id", "session_id", "question", "answer",
+    "total_tokens", "execution_time", "message_sequence"
+]
+
+class _FakeConversation(Mapping):
+    """
+    Conversación simulada que devuelve save_conversation cuando no hay base de datos.
+    Se comporta como un diccionario de solo lectura; el id y created_at solo se generan
+    si alguien los lee (la mayoría de las veces nadie lo hace).
+    """
+    
+    __slots__ = ("telegram_id", "session_id", "question", "answer",
+                 "total_tokens", "execution_time", "_id", "_created_at")
+    
+    _KEYS = ("id", "telegram_id", "session_id", "question", "answer",
+             "created_at", "total_tokens", "execution_time")
+    
+    def __init__(self, telegram_id, session_id, question, answer, total_tokens, execution_time):
+        self.telegram_id = telegram_id
+        self.session_id = session_id
+        self.question = question
+        self.answer = answer
+        self.total_tokens = total_tokens
+        self.execution_time = execution_time
+        self._id = None
+        self._created_at = None
+    
+    @property
+    def id(self) -> str:
+        if self._id is None:
+            self._id = str(uuid.uuid4())
+        return self._id
+    
+    @property
+    def created_at(self) -> str:
+        if self._created_at is None:
+            self._created_at = datetime.now().isoformat()
+        return self._created_at
+    
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __contains__(self, key) -> bool:
+        return key in self._KEYS
+    
+    def __iter__(self):
+        return iter(self._KEYS)
+    
+    def __len__(self) -> int:
+        return len(self._KEYS)
 
 class ConversationService:
     """
     Servicio para gestionar y almacenar conversaciones.
     """
     
-    def __init__(self, database=None):
+    def __init__(self, database=None, pool=None):
         """
         Inicializa el servicio de conversación.
         
         Args:
             database: Cliente de base de datos (Supabase)
+            pool: Pool de asyncpg opcional (database.pool.create_pg_pool); si está,
+                las lecturas y el guardado lo usan en lugar de Supabase
         """
         self.database = database
-        self._user_id_cache = {}  # Caché para auth_user_id
+        self.pool = pool
     
     async def _get_auth_user_id(self, telegram_id: int) -> str:
         """
@@ -31,28 +214,10 @@ class ConversationService:
         Raises:
             ValueError: Si el usuario no existe
         """
-        # Verificar caché primero
-        if telegram_id in self._user_id_cache:
-            return self._user_id_cache[telegram_id]
-        
         if not self.database:
             raise ValueError("No hay conexión a la base de datos")
         
-        # Consultar base de datos
-        user_result = self.database.from_("telegram_users") \
-            .select("auth_user_id") \
-            .eq("telegram_id", telegram_id) \
-            .execute()
-        
-        if not user_result.data:
-            raise ValueError(f"Usuario con telegram_id {telegram_id} no encontrado")
-        
-        auth_user_id = user_result.data[0]["auth_user_id"]
-        
-        # Guardar en caché
-        self._user_id_cache[telegram_id] = auth_user_id
-        
-        return auth_user_id
+        return await _fetch_auth_user_id(self.database, telegram_id)
     
     async def save_conversation(self, 
                                telegram_id: int, 
@@ -79,54 +244,123 @@ class ConversationService:
             # Si no hay base de datos, solo imprimimos y devolvemos datos simulados
             print(f"[User] {question}")
             print(f"[Assistant] {answer}")
-            return {
-                "id": str(uuid.uuid4()),
-                "telegram_id": telegram_id,
-                "session_id": session_id,
-                "question": question,
-                "answer": answer,
-                "created_at": datetime.now().isoformat(),
-                "total_tokens": total_tokens,
-                "execution_time": execution_time
-            }
+            return _FakeConversation(telegram_id, session_id, question, answer, total_tokens, execution_time)
         
         try:
-            # Obtener el auth_user_id usando la función con caché
-            auth_user_id = await self._get_auth_user_id(telegram_id)
+            # Resolver el usuario, generar la secuencia e insertar en una sola llamada
+            # (función save_conversation_turn, atómica en la base de datos)
+            if self.pool:
+                row = await self.pool.fetchrow(
+                    SQL_SAVE_TURN,
+                    telegram_id, session_id, question, answer,
+                    total_tokens, execution_time
+                )
+                return _row_to_dict(row) if row is not None else {}
+            
+            result = await _execute(
+                self.database.rpc("save_conversation_turn", {
+                    "p_telegram_id": telegram_id,
+                    "p_session_id": session_id,
+                    "p_question": question,
+                    "p_answer": answer,
+                    "p_total_tokens": total_tokens,
+                    "p_execution_time": execution_time
+                })
+            )
             
-            # Obtener el último message_sequence para esta sesión
-            sequence_result = self.database.from_("user_conversations") \
-                .select("message_sequence") \
-                .eq("user_id", auth_user_id) \
-                .eq("session_id", session_id) \
-                .order("message_sequence", desc=True) \
-                .limit(1) \
-                .execute()
-            
-            # Determinar el siguiente número de secuencia
-            next_sequence = 1
-            if sequence_result.data:
-                next_sequence = sequence_result.data[0]["message_sequence"] + 1
-            
-            # Insertar la nueva conversación
-            result = self.database.from_("user_conversations").insert({
-                "user_id": auth_user_id,
-                "session_id": session_id,
-                "question": question,
-                "answer": answer,
-                "total_tokens": total_tokens,
-                "execution_time": execution_time,
-                "message_sequence": next_sequence,
-                "metadata": {}  # Inicialmente vacío
-            }).execute()
+            if not result.data:
+                return {}
             
-            return result.data[0] if result.data else {}
+            return result.data[0]
             
         except Exception as e:
             print(f"Error al guardar conversación: {e}")
             # En caso de error, devolvemos un diccionario vacío
             return {}
     
+    async def save_conversations_bulk(self, rows: List[Dict[str, Any]]) -> int:
+        """
+        Guarda muchos turnos de golpe (webhooks en lote, reproducciones, backfill).
+        
+        Agrupa los turnos por sesión, reserva las secuencias de cada sesión con una
+        sola llamada y escribe todas las filas con un COPY (pool de asyncpg) o con un
+        único INSERT de varias filas (Supabase), en lugar de una llamada por turno.
+        
+        Args:
+            rows: Turnos con telegram_id, session_id, question, answer y, opcionalmente,
+                total_tokens y execution_time, en orden dentro de cada sesión
+            
+        Returns:
+            Número de turnos guardados
+        """
+        if not rows:
+            return 0
+        
+        if not self.database:
+            for row in rows:
+                print(f"[User] {row['question']}")
+                print(f"[Assistant] {row['answer']}")
+            return len(rows)
+        
+        try:
+            sessions: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+            for row in rows:
+                sessions.setdefault((row["telegram_id"], row["session_id"]), []).append(row)
+            
+            async def _reserve(telegram_id: int, session_id: int, count: int) -> Tuple[str, int]:
+                user_id = await self._get_auth_user_id(telegram_id)
+                if self.pool:
+                    first = await self.pool.fetchval(
+                        SQL_RESERVE_SEQUENCES, uuid.UUID(user_id), session_id, count
+                    )
+                else:
+                    result = await _execute(
+                        self.database.rpc("reserve_conversation_sequences", {
+                            "p_user_id": user_id,
+                            "p_session_id": session_id,
+                            "p_count": count
+                        })
+                    )
+                    first = result.data
+                return user_id, first
+            
+            keys = list(sessions)
+            reserved = await asyncio.gather(*[
+                _reserve(telegram_id, session_id, len(sessions[(telegram_id, session_id)]))
+                for telegram_id, session_id in keys
+            ])
+            
+            records = []
+            for (telegram_id, session_id), (user_id, first) in zip(keys, reserved):
+                for offset, row in enumerate(sessions[(telegram_id, session_id)]):
+                    records.append((
+                        user_id, session_id, row["question"], row["answer"],
+                        row.get("total_tokens", 0), row.get("execution_time", 0.0),
+                        first + offset
+                    ))
+            
+            if self.pool:
+                # COPY binario: un solo viaje para todas las filas
+                async with self.pool.acquire() as conn:
+                    await conn.copy_records_to_table(
+                        "user_conversations",
+                        records=[(uuid.UUID(record[0]),) + record[1:] for record in records],
+                        columns=BULK_COLUMNS
+                    )
+            else:
+                await _execute(
+                    self.database.table("user_conversations").insert(
+                        [dict(zip(BULK_COLUMNS, record)) for record in records],
+                        returning="minimal"
+                    )
+                )
+            
+            return len(records)
+            
+        except Exception as e:
+            print(f"Error al guardar conversaciones en lote: {e}")
+            return 0
+    
     async def get_recent_conversations(self, 
                                       telegram_id: int, 
                                       session_id: int, 
@@ -140,24 +374,31 @@ class ConversationService:
             limit: Número máximo de conversaciones a recuperar
             
         Returns:
-            Lista de conversaciones ordenadas por secuencia (más recientes primero)
+            Lista de conversaciones ordenadas por secuencia (más recientes primero), solo
+            con las columnas del contexto (CONTEXT_COLUMNS)
         """
         if not self.database:
             # Si no hay base de datos, devolvemos una lista vacía
             return []
         
         try:
+            if self.pool:
+                # Una sola consulta preparada, resolviendo el usuario con un join
+                rows = await self.pool.fetch(SQL_RECENT_CONVERSATIONS, telegram_id, session_id, limit)
+                return [_row_to_dict(row) for row in rows]
+            
             # Obtener el auth_user_id usando la función con caché
             auth_user_id = await self._get_auth_user_id(telegram_id)
             
             # Obtener las conversaciones recientes
-            result = self.database.from_("user_conversations") \
-                .select("*") \
-                .eq("user_id", auth_user_id) \
-                .eq("session_id", session_id) \
-                .order("message_sequence", desc=True) \
-                .limit(limit) \
-                .execute()
+            result = await _execute(
+                self.database.from_("user_conversations")
+                    .select(CONTEXT_COLUMNS)
+                    .eq("user_id", auth_user_id)
+                    .eq("session_id", session_id)
+                    .order("message_sequence", desc=True)
+                    .limit(limit)
+            )
             
             return result.data if result.data else []
             
@@ -167,7 +408,7 @@ class ConversationService:
     
     async def get_conversation_by_id(self, conversation_id: str) -> Dict[str, Any]:
         """
-        Obtiene una conversación específica por su ID.
+        Obtiene una conversación específica por su ID (solo las columnas del contexto).
         
         Args:
             conversation_id: ID de la conversación
@@ -175,14 +416,37 @@ class ConversationService:
         Returns:
             Diccionario con los datos de la conversación
         """
+        return await self._fetch_conversation(conversation_id, CONTEXT_COLUMNS, SQL_CONVERSATION_BY_ID)
+
+    async def get_conversation_full(self, conversation_id: str) -> Dict[str, Any]:
+        """
+        Obtiene una conversación con todas sus columnas (para el análisis).
+        
+        Args:
+            conversation_id: ID de la conversación
+            
+        Returns:
+            Diccionario con los datos de la conversación
+        """
+        return await self._fetch_conversation(conversation_id, "*", SQL_CONVERSATION_FULL)
+
+    async def _fetch_conversation(self, conversation_id: str, columns: str, sql: str) -> Dict[str, Any]:
+        """
+        Lee una conversación por ID con las columnas indicadas (Supabase) o la consulta sql (pool).
+        """
         if not self.database:
             return {}
         
         try:
-            result = self.database.from_("user_conversations") \
-                .select("*") \
-                .eq("id", conversation_id) \
-                .execute()
+            if self.pool:
+                row = await self.pool.fetchrow(sql, conversation_id)
+                return _row_to_dict(row) if row else {}
+            
+            result = await _execute(
+                self.database.from_("user_conversations")
+                    .select(columns)
+                    .eq("id", conversation_id)
+            )
             
             return result.data[0] if result.data else {}
             
@@ -219,14 +483,8 @@ class ConversationService:
                 "has_history": False
             }
         
-        # Formatear conversaciones para el contexto
-        formatted_messages = self.format_conversation_for_context(conversations)
-        
-        # Extraer metadatos relevantes
-        metadata = {}
-        for conv in conversations:
-            if conv.get("metadata"):
-                metadata.update(conv.get("metadata", {}))
+        # Formatear conversaciones y extraer metadatos en un solo recorrido
+        formatted_messages, metadata = self._build_context(conversations)
         
         return {
             "messages": formatted_messages,
@@ -239,45 +497,60 @@ class ConversationService:
         Formatea las conversaciones para su uso en el contexto del agente.
         
         Args:
-            conversations: Lista de conversaciones desde la base de datos
+            conversations: Lista de conversaciones ordenada por message_sequence descendente
+                (tal como la devuelve get_recent_conversations)
             
         Returns:
             Lista de mensajes formateados para el agente
         """
-        # Ordenar conversaciones por secuencia (ascendente)
-        sorted_conversations = sorted(
-            conversations, 
-            key=lambda x: x.get("message_sequence", 0)
-        )
+        return self._build_context(conversations)[0]
+
+    def _build_context(self, conversations: List[Dict[str, Any]]) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """
+        Recorre las conversaciones una sola vez en orden de secuencia (ascendente),
+        construyendo a la vez los mensajes para el agente y los metadatos combinados.
         
+        Args:
+            conversations: Lista de conversaciones ordenada por message_sequence descendente
+                (tal como la devuelve get_recent_conversations)
+            
+        Returns:
+            Tupla con la lista de mensajes formateados y el diccionario de metadatos
+        """
         formatted_messages = []
+        metadata = {}
         
-        for conv in sorted_conversations:
+        # Las filas ya vienen en orden descendente desde la base de datos: basta con invertirlas
+        for conv in reversed(conversations):
             # Añadir mensaje del usuario
-            if conv.get("question"):
-                formatted_messages.append({
-                    "role": "user",
-                    "content": conv.get("question", "")
-                })
+            question = conv.get("question")
+            if question:
+                formatted_messages.append({"role": "user", "content": question})
             
             # Añadir respuesta del asistente
-            if conv.get("answer"):
-                formatted_messages.append({
-                    "role": "assistant",
-                    "content": conv.get("answer", "")
-                })
+            answer = conv.get("answer")
+            if answer:
+                formatted_messages.append({"role": "assistant", "content": answer})
+            
+            # Los metadatos de los mensajes más recientes prevalecen
+            conv_metadata = conv.get("metadata")
+            if conv_metadata:
+                metadata.update(conv_metadata)
         
-        return formatted_messages
+        return formatted_messages, metadata
 
     async def analyze_and_update_conversation(self,
                                              conversation_id: str,
-                                             openai_client=None) -> Dict[str, Any]:
+                                             openai_client=None,
+                                             conversation: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """
         Analiza una conversación y actualiza sus metadatos con información enriquecida.
         
         Args:
             conversation_id: ID de la conversación a analizar
             openai_client: Cliente de OpenAI para realizar el análisis
+            conversation: Fila de la conversación si el llamador ya la tiene
+                (por ejemplo, la devuelta por save_conversation); evita volver a leerla
             
         Returns:
             Diccionario con los datos actualizados de la conversación
@@ -286,8 +559,9 @@ class ConversationService:
             return {}
         
         try:
-            # Obtener la conversación
-            conversation = await self.get_conversation_by_id(conversation_id)
+            # Obtener la conversación (solo si no nos la han pasado ya)
+            if not conversation:
+                conversation = await self.get_conversation_full(conversation_id)
             if not conversation:
                 return {}
             
@@ -304,26 +578,16 @@ class ConversationService:
             
             # Actualizar la conversación con los resultados del análisis
             if analysis:
-                updates = {
-                    "sentiment": analysis.get("sentiment", ""),
-                    "summary": analysis.get("summary", ""),
-                    "topics": analysis.get("topics", []),
-                    "metadata": {
-                        **conversation.get("metadata", {}),
-                        "analysis_timestamp": datetime.now().isoformat(),
-                        "entities": analysis.get("entities", []),
-                        "intent": analysis.get("intent", "")
-                    }
-                }
+                updates = self._analysis_updates(conversation, analysis)
                 
-                # Actualizar en la base de datos
-                result = self.database.from_("user_conversations") \
-                    .update(updates) \
-                    .eq("id", conversation_id) \
-                    .execute()
+                # Actualizar en la base de datos; el UPDATE devuelve la fila ya actualizada
+                result = await _execute(
+                    self.database.from_("user_conversations")
+                        .update(updates)
+                        .eq("id", conversation_id)
+                )
                 
-                # Combinar los datos originales con las actualizaciones
-                return {**conversation, **updates}
+                return result.data[0] if result.data else {**conversation, **updates}
             
             return conversation
             
@@ -331,12 +595,187 @@ class ConversationService:
             print(f"Error al analizar y actualizar conversación: {e}")
             return {}
 
+    async def analyze_many(self,
+                           conversation_ids: List[str],
+                           openai_client=None,
+                           concurrency: int = 8) -> List[Dict[str, Any]]:
+        """
+        Analiza varias conversaciones en paralelo, con un máximo de análisis simultáneos.
+        
+        Args:
+            conversation_ids: IDs de las conversaciones a analizar
+            openai_client: Cliente de OpenAI para realizar el análisis
+            concurrency: Número máximo de análisis en curso a la vez
+            
+        Returns:
+            Lista con los datos actualizados de cada conversación (en el mismo orden)
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def _one(conversation_id: str) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.analyze_and_update_conversation(
+                    conversation_id=conversation_id,
+                    openai_client=openai_client
+                )
+        
+        return await asyncio.gather(*[_one(conversation_id) for conversation_id in conversation_ids])
+
+    async def analyze_backfill(self,
+                               openai_client,
+                               session_id: Optional[int] = None,
+                               workers: int = 8,
+                               fetch_batch_size: int = 100,
+                               write_batch_size: int = 50,
+                               queue_size: int = 64) -> int:
+        """
+        Analiza todas las conversaciones pendientes (sin sentiment) en un pipeline
+        productor/consumidor: lectura por lotes -> análisis con el LLM (workers en
+        paralelo) -> escritura por lotes con un único UPDATE por lote. Las colas acotadas
+        hacen que el productor espere cuando el análisis va por detrás.
+        
+        Args:
+            openai_client: Cliente de OpenAI para realizar el análisis
+            session_id: Limitar el análisis a una sesión (opcional)
+            workers: Número de análisis simultáneos con el LLM
+            fetch_batch_size: Filas leídas por consulta
+            write_batch_size: Filas actualizadas por UPDATE
+            queue_size: Tamaño máximo de cada cola
+            
+        Returns:
+            Número de conversaciones actualizadas
+        """
+        if not self.database or not openai_client:
+            return 0
+        
+        pending: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        analyzed: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        
+        async def fetch_batches() -> None:
+            last_id = None
+            try:
+                while True:
+                    query = (
+                        self.database.from_("user_conversations")
+                            .select("id,question,answer,metadata")
+                            .is_("sentiment", "null")
+                            .order("id")
+                            .limit(fetch_batch_size)
+                    )
+                    if session_id is not None:
+                        query = query.eq("session_id", session_id)
+                    if last_id is not None:
+                        query = query.gt("id", last_id)
+                    
+                    result = await _execute(query)
+                    rows = result.data or []
+                    for row in rows:
+                        await pending.put(row)  # Espera si la cola está llena
+                    if len(rows) < fetch_batch_size:
+                        break
+                    last_id = rows[-1]["id"]
+            finally:
+                for _ in range(workers):
+                    await pending.put(None)
+        
+        async def analyze_worker() -> None:
+            try:
+                while (conversation := await pending.get()) is not None:
+                    # Un fallo en una conversación no puede matar al worker: si todos
+                    # murieran, fetch_batches se quedaría bloqueado en pending.put
+                    try:
+                        analysis = await self._analyze_with_llm(
+                            question=conversation.get("question") or "",
+                            answer=conversation.get("answer") or "",
+                            openai_client=openai_client
+                        )
+                        if not analysis:
+                            continue
+                        update = {"id": conversation["id"], **self._analysis_updates(conversation, analysis)}
+                    except Exception as e:
+                        print(f"Error al analizar la conversación {conversation.get('id')}: {e}")
+                        continue
+                    await analyzed.put(update)
+            finally:
+                await analyzed.put(None)
+        
+        async def write_batches() -> int:
+            written = 0
+            finished = 0
+            batch = []
+            while finished < workers:
+                item = await analyzed.get()
+                if item is None:
+                    finished += 1
+                    continue
+                batch.append(item)
+                if len(batch) >= write_batch_size:
+                    written += await self._write_analyses(batch)
+                    batch = []
+            if batch:
+                written += await self._write_analyses(batch)
+            return written
+        
+        results = await asyncio.gather(
+            fetch_batches(),
+            *[analyze_worker() for _ in range(workers)],
+            write_batches(),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Error en el análisis por lotes: {result}")
+        
+        written = results[-1]
+        return written if isinstance(written, int) else 0
+
+    @staticmethod
+    def _analysis_updates(conversation: Dict[str, Any], analysis: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Construye las columnas a actualizar a partir del análisis del LLM.
+        """
+        return {
+            "sentiment": analysis.get("sentiment", ""),
+            "summary": analysis.get("summary", ""),
+            "topics": analysis.get("topics", []),
+            "metadata": {
+                **(conversation.get("metadata") or {}),
+                "analysis_timestamp": datetime.now().isoformat(),
+                "entities": analysis.get("entities", []),
+                "intent": analysis.get("intent", "")
+            }
+        }
+
+    async def _write_analyses(self, rows: List[Dict[str, Any]]) -> int:
+        """
+        Escribe un lote de análisis con un único UPDATE ... FROM (función update_conversation_analyses).
+        
+        Args:
+            rows: Filas con id, sentiment, summary, topics y metadata
+            
+        Returns:
+            Número de filas actualizadas (0 si falla)
+        """
+        try:
+            if self.pool:
+                return await self.pool.fetchval(SQL_UPDATE_ANALYSES, rows)
+            
+            result = await _execute(
+                self.database.rpc("update_conversation_analyses", {"p_rows": rows})
+            )
+            return result.data or 0
+        except Exception as e:
+            print(f"Error al guardar el lote de análisis: {e}")
+            return 0
+
     async def _analyze_with_llm(self, 
                                question: str, 
                                answer: str, 
                                openai_client) -> Dict[str, Any]:
         """
         Utiliza un LLM para analizar una conversación y extraer información relevante.
+        Los análisis se reutilizan por contenido: la misma pregunta y respuesta no se
+        vuelven a enviar a OpenAI.
         
         Args:
             question: Pregunta del usuario
@@ -346,46 +785,82 @@ class ConversationService:
         Returns:
             Diccionario con los resultados del análisis
         """
+        content_hash = hashlib.sha256((question + "\x00" + answer).encode()).hexdigest()
+        
         try:
-            # Construir el prompt para el análisis
-            prompt = f"""
-            Analiza la siguiente conversación entre un usuario y un asistente:
-            
-            Usuario: {question}
-            
-            Asistente: {answer}
-            
-            Por favor, proporciona la siguiente información en formato JSON:
-            1. sentiment: El sentimiento general del usuario (positivo, negativo o neutral)
-            2. summary: Un breve resumen de la conversación (máximo 100 caracteres)
-            3. topics: Una lista de hasta 3 temas principales discutidos
-            4. entities: Una lista de entidades mencionadas (productos, lugares, personas, etc.)
-            5. intent: La intención principal del usuario (consulta, queja, solicitud, etc.)
-            
-            Responde solo con el JSON, sin texto adicional.
-            """
-            
-            # Realizar la llamada al LLM
-            response = await openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "Eres un asistente especializado en análisis de conversaciones."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3,
-                response_format={"type": "json_object"}
+            return await _cached_analysis(
+                content_hash=content_hash,
+                service=self,
+                question=question,
+                answer=answer,
+                openai_client=openai_client
             )
-            
-            # Extraer y parsear la respuesta
-            content = response.choices[0].message.content
-            analysis = json.loads(content)
-            
-            return analysis
-            
         except Exception as e:
             print(f"Error al analizar con LLM: {e}")
             return {}
 
+    async def _fetch_analysis(self,
+                              content_hash: str,
+                              question: str,
+                              answer: str,
+                              openai_client) -> Dict[str, Any]:
+        """
+        Busca el análisis en la tabla llm_analysis_cache (compartida entre procesos) y,
+        si no está, lo genera con el LLM y lo guarda. Lanza excepción si falla, para que
+        los errores no se queden en caché.
+        
+        Args:
+            content_hash: sha256 de la pregunta y la respuesta
+            question: Pregunta del usuario
+            answer: Respuesta del sistema
+            openai_client: Cliente de OpenAI
+            
+        Returns:
+            Diccionario con los resultados del análisis
+        """
+        if self.database:
+            cached = await _execute(
+                self.database.from_("llm_analysis_cache")
+                    .select("analysis")
+                    .eq("content_hash", content_hash)
+                    .limit(1)
+            )
+            if cached.data:
+                return cached.data[0]["analysis"]
+        
+        # Realizar la llamada al LLM
+        response = await openai_client.chat.completions.create(
+            model=_ANALYSIS_MODEL,
+            messages=[
+                _ANALYSIS_SYSTEM_MSG,
+                {"role": "user", "content": _ANALYSIS_PROMPT_TMPL.format(question=question, answer=answer)}
+            ],
+            temperature=0.3,
+            # Sin stop=["\n\n"]: el modelo puede devolver el JSON con saltos de línea y una
+            # secuencia de parada lo cortaría dejándolo inválido; max_tokens ya acota la salida
+            max_tokens=_ANALYSIS_MAX_TOKENS,
+            response_format={"type": "json_object"}
+        )
+        
+        # Extraer y parsear la respuesta
+        content = response.choices[0].message.content
+        analysis = orjson.loads(content)
+        if not isinstance(analysis, dict):
+            # Una lista o un texto no se guarda en caché ni rompe a quien lo use
+            raise ValueError(f"Análisis inesperado del LLM: {content[:200]}")
+        
+        if self.database:
+            try:
+                # ON CONFLICT DO NOTHING: otro proceso pudo guardarlo a la vez
+                await _execute(
+                    self.database.from_("llm_analysis_cache")
+                        .upsert({"content_hash": content_hash, "analysis": analysis}, ignore_duplicates=True)
+                )
+            except Exception as e:
+                print(f"Error al guardar el análisis en caché: {e}")
+        
+        return analysis
+
     async def generate_session_summary(self,
                                       telegram_id: int,
                                       session_id: int,
@@ -418,10 +893,15 @@ class ConversationService:
                 return "No hay conversaciones para resumir."
             
             # Formatear las conversaciones para el prompt
-            conversation_text = ""
-            for conv in sorted(conversations, key=lambda x: x.get("message_sequence", 0)):
-                conversation_text += f"Usuario: {conv.get('question', '')}\n"
-                conversation_text += f"Asistente: {conv.get('answer', '')}\n\n"
+            # (lista + join en lugar de += para no copiar el texto en cada iteración)
+            parts = []
+            append = parts.append
+            for conv in reversed(conversations):  # Ya vienen en orden descendente
+                # Extraer cada campo una sola vez por fila
+                question = conv.get("question") or ""
+                answer = conv.get("answer") or ""
+                append(f"Usuario: {question}\nAsistente: {answer}\n\n")
+            conversation_text = "".join(parts)
             
             # Construir el prompt para el resumen
             prompt = f"""
@@ -454,4 +934,13 @@ class ConversationService:
             
         except Exception as e:
             print(f"Error al generar resumen de sesión: {e}")
-            return "Error al generar el resumen de la sesión."
\ No newline at end of file
+            return "Error al generar el resumen de la sesión."
+
+
+@lru_cache()
+def get_conversation_service() -> ConversationService:
+    """
+    Devuelve la instancia compartida del servicio de conversación sin base de datos.
+    Se crea la primera vez que se usa, no al importar el módulo.
+    """
+    return ConversationService()
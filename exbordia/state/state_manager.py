@@ -1,12 +1,14 @@
 from typing import Dict, Any, Optional
+from cachetools import TTLCache
 
 class StateManager:
     """
     Gestor de estado para mantener el contexto de las conversaciones.
     """
     
-    def __init__(self):
-        self.states = {}
+    def __init__(self, maxsize: int = 100_000, ttl: int = 3600):
+        # Estados acotados en tamaño; las sesiones sin actividad durante ttl segundos caducan solas
+        self.states = TTLCache(maxsize=maxsize, ttl=ttl)
     
     async def get_state(self, user_id: str, session_id: str) -> Dict[str, Any]:
         """
@@ -19,13 +21,17 @@ class StateManager:
         Returns:
             Estado actual
         """
-        key = f"{user_id}:{session_id}"
+        key = (user_id, session_id)
         return self.states.get(key, {})
     
     async def update_state(self, user_id: str, session_id: str, state_updates: Dict[str, Any]) -> Dict[str, Any]:
         """
         Actualiza el estado para un usuario y sesión.
         
+        El estado se modifica en el mismo diccionario (no se crea una copia), así que
+        un diccionario obtenido antes con get_state refleja también los cambios; quien
+        necesite una instantánea inmutable debe hacer .copy().
+        
         Args:
             user_id: ID del usuario
             session_id: ID de la sesión
@@ -34,11 +40,15 @@ class StateManager:
         Returns:
             Estado actualizado
         """
-        key = f"{user_id}:{session_id}"
-        current_state = self.states.get(key, {})
-        updated_state = {**current_state, **state_updates}
-        self.states[key] = updated_state
-        return updated_state
+        key = (user_id, session_id)
+        # Sin await entre la lectura y la escritura: no hace falta lock en el event loop
+        state = self.states.get(key)
+        if state is None:
+            state = {}
+        state.update(state_updates)
+        # Reasignar para renovar el TTL de la sesión (no copia el diccionario)
+        self.states[key] = state
+        return state
     
     async def clear_state(self, user_id: str, session_id: str) -> None:
         """
@@ -48,6 +58,5 @@ class StateManager:
             user_id: ID del usuario
             session_id: ID de la sesión
         """
-        key = f"{user_id}:{session_id}"
-        if key in self.states:
-            del self.states[key]
+        key = (user_id, session_id)
+        self.states.pop(key, None)
@@ -0,0 +1,69 @@
+import asyncio
+import contextlib
+import io
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+try:
+    from services.conversation_service import ConversationService
+except ImportError as e:  # memoize...
+    raise unittest.SkipTest(f"conversation_service dependencies not installed: {e}")
+
+class FakeQuery:
+    """Supabase query builder over a list of user_conversations rows (ordered by id)."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.last_id = None
+        self.limit_count = None
+
+    def __getattr__(self, name):
+        # select, is_, order, eq: not needed to page through the rows
+        return lambda *args, **kwargs: self
+
+    def gt(self, column, value):
+        self.last_id = value
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def execute(self):
+        rows = [row for row in self.rows if self.last_id is None or row["id"] > self.last_id]
+        return SimpleNamespace(data=rows[:self.limit_count])
+
+class AnalyzeBackfillTest(unittest.IsolatedAsyncioTestCase):
+    async def test_bad_analyses_do_not_stop_the_pipeline(self):
+        rows = [{"id": i, "question": f"q{i}", "answer": f"a{i}", "metadata": {}} for i in range(200)]
+        database = SimpleNamespace(from_=lambda table: FakeQuery(rows))
+        service = ConversationService(database=database)
+        written = []
+
+        async def analyze_with_llm(question, answer, openai_client):
+            n = int(question[1:])
+            if n % 3 == 0:
+                return ["not", "a", "dict"]  # Would raise in _analysis_updates
+            if n % 5 == 0:
+                return {}  # Failed analysis
+            return {"sentiment": "positive", "summary": question}
+
+        async def write_analyses(batch):
+            written.extend(item["id"] for item in batch)
+            return len(batch)
+
+        with mock.patch.object(service, "_analyze_with_llm", analyze_with_llm), \
+                mock.patch.object(service, "_write_analyses", write_analyses), \
+                contextlib.redirect_stdout(io.StringIO()):
+            # Few workers and small queues: dead workers would leave fetch_batches blocked
+            count = await asyncio.wait_for(
+                service.analyze_backfill(object(), workers=2, fetch_batch_size=20, queue_size=2), timeout=5
+            )
+
+        expected = [i for i in range(200) if i % 3 and i % 5]
+        self.assertEqual(sorted(written), expected)
+        self.assertEqual(count, len(expected))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,285 @@
+import asyncio
+import contextlib
+import io
+import random
+import time
+import unittest
+from types import SimpleNamespace
+from typing import List
+from unittest import mock
+
+try:
+    from tools import notion_uploader
+    from tools.notion_uploader import NotionRateLimiter, RateLimiter, chunk_text
+except ImportError as e:  # aiohttp, httpx, notion_client, openai, supabase...
+    raise unittest.SkipTest(f"notion_uploader dependencies not installed: {e}")
+
+def rfind_chunk_text(text: str, chunk_size: int = 5000) -> List[str]:
+    """The previous chunk_text (one rfind per boundary kind and chunk), kept as reference."""
+    chunks = []
+    start = 0
+    text_length = len(text)
+
+    while start < text_length:
+        end = start + chunk_size
+
+        if end >= text_length:
+            chunks.append(text[start:].strip())
+            break
+
+        chunk = text[start:end]
+        code_block = chunk.rfind('```')
+        if code_block != -1 and code_block > chunk_size * 0.3:
+            end = start + code_block
+
+        elif '\n\n' in chunk:
+            last_break = chunk.rfind('\n\n')
+            if last_break > chunk_size * 0.3:
+                end = start + last_break
+
+        elif '. ' in chunk:
+            last_period = chunk.rfind('. ')
+            if last_period > chunk_size * 0.3:
+                end = start + last_period + 1
+
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+
+        start = max(start + 1, end)
+
+    return chunks
+
+class ChunkTextTest(unittest.TestCase):
+    PIECES = ["palabra", "Amazon", " ", " ", ". ", ".", "\n", "\n\n", "\n\n\n", "```", "````", "x" * 40]
+
+    def assert_same_chunks(self, text: str, chunk_size: int):
+        self.assertEqual(chunk_text(text, chunk_size), rfind_chunk_text(text, chunk_size))
+
+    def test_matches_rfind_version_on_random_text(self):
+        rng = random.Random(1234)
+        for _ in range(300):
+            text = "".join(rng.choice(self.PIECES) for _ in range(rng.randint(0, 400)))
+            for chunk_size in (20, 57, 200, 5000):
+                with self.subTest(text=text, chunk_size=chunk_size):
+                    self.assert_same_chunks(text, chunk_size)
+
+    def test_matches_rfind_version_on_edge_cases(self):
+        texts = [
+            "",
+            "   ",
+            "a" * 1000,
+            "```" * 200,
+            "\n\n" * 300,
+            ". " * 300,
+            "Frase corta. " * 100,
+            ("Párrafo con texto.\n\n" * 20) + "```python\nprint('hola')\n```" + (" más texto" * 50),
+        ]
+        for text in texts:
+            for chunk_size in (10, 100, 5000):
+                with self.subTest(text=text[:30], chunk_size=chunk_size):
+                    self.assert_same_chunks(text, chunk_size)
+
+    def test_prefers_code_block_then_paragraph_then_sentence(self):
+        text = "a" * 50 + "```" + "b" * 100
+        self.assertEqual(chunk_text(text, 100)[0], "a" * 50)
+        text = "a" * 50 + "\n\n" + "b" * 100
+        self.assertEqual(chunk_text(text, 100)[0], "a" * 50)
+        text = "a" * 50 + ". " + "b" * 100
+        self.assertEqual(chunk_text(text, 100)[0], "a" * 50 + ".")
+
+class RateLimiterTest(unittest.IsolatedAsyncioTestCase):
+    def test_refill_is_proportional_to_elapsed_time(self):
+        limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+        limiter.available_requests = 0
+        limiter.available_tokens = 0
+        limiter._last_update -= 30  # Half a minute ago
+        limiter._refill()
+        self.assertAlmostEqual(limiter.available_requests, 30, places=1)
+        self.assertAlmostEqual(limiter.available_tokens, 3000, delta=10)
+
+    def test_refill_is_capped_at_the_bucket_size(self):
+        limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+        limiter._last_update -= 600
+        limiter._refill()
+        self.assertEqual(limiter.available_requests, 60)
+        self.assertEqual(limiter.available_tokens, 6000)
+
+    async def test_acquire_consumes_a_request_and_tokens(self):
+        limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+        await limiter.acquire(100)
+        self.assertLess(limiter.available_requests, 59.1)
+        self.assertLess(limiter.available_tokens, 5901)
+
+    async def test_acquire_waits_for_the_bucket_to_refill(self):
+        # 6000 requests per minute: one request every 10 ms
+        limiter = RateLimiter(requests_per_minute=6000, tokens_per_minute=1_000_000)
+        limiter.available_requests = 0
+        started = time.monotonic()
+        await limiter.acquire(1)
+        self.assertGreaterEqual(time.monotonic() - started, 0.009)
+
+    async def test_acquire_never_waits_for_more_than_the_bucket_holds(self):
+        limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=100)
+        await asyncio.wait_for(limiter.acquire(10_000), timeout=1)
+        self.assertLess(limiter.available_tokens, 1)
+
+    def test_reconcile_lowers_the_buckets_to_the_server_values(self):
+        limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+        limiter.reconcile({"x-ratelimit-remaining-requests": "5", "x-ratelimit-remaining-tokens": "not-a-number"})
+        self.assertEqual(limiter.available_requests, 5)
+        self.assertEqual(limiter.available_tokens, 6000)
+
+def status_error(status_code: int):
+    """APIStatusError with the given status (built without an HTTP response)."""
+    error = notion_uploader.APIStatusError.__new__(notion_uploader.APIStatusError)
+    error.status_code = status_code
+    return error
+
+class IsTransientTest(unittest.TestCase):
+    def test_retries_what_the_openai_sdk_retried(self):
+        for status_code in (408, 409, 500, 502, 503):
+            with self.subTest(status_code=status_code):
+                self.assertTrue(notion_uploader._is_transient(status_error(status_code)))
+
+    def test_does_not_retry_client_errors(self):
+        for status_code in (400, 401, 404, 422):
+            with self.subTest(status_code=status_code):
+                self.assertFalse(notion_uploader._is_transient(status_error(status_code)))
+        self.assertFalse(notion_uploader._is_transient(ValueError("invalid JSON")))
+
+class IsUnchangedTest(unittest.TestCase):
+    EDITED = "2024-05-01T12:34:00.000Z"
+
+    def test_skips_when_read_a_minute_after_the_edit(self):
+        stored = {"last_edited_time": self.EDITED, "fetched_at": "2024-05-01T12:35:00+00:00"}
+        self.assertTrue(notion_uploader.is_unchanged(self.EDITED, stored))
+
+    def test_reprocesses_when_read_within_the_edit_minute(self):
+        # A later edit in 12:34 keeps the same truncated last_edited_time
+        stored = {"last_edited_time": self.EDITED, "fetched_at": "2024-05-01T12:34:40+00:00"}
+        self.assertFalse(notion_uploader.is_unchanged(self.EDITED, stored))
+
+    def test_reprocesses_when_edited_again(self):
+        stored = {"last_edited_time": "2024-04-01T08:00:00.000Z", "fetched_at": "2024-05-01T12:00:00+00:00"}
+        self.assertFalse(notion_uploader.is_unchanged(self.EDITED, stored))
+
+    def test_falls_back_to_processed_at_for_older_rows(self):
+        stored = {"last_edited_time": self.EDITED, "fetched_at": None, "processed_at": "2024-05-01T13:00:00+00:00"}
+        self.assertTrue(notion_uploader.is_unchanged(self.EDITED, stored))
+        self.assertFalse(notion_uploader.is_unchanged(self.EDITED, {"last_edited_time": self.EDITED}))
+
+class NotionRateLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_first_request_does_not_wait(self):
+        limiter = NotionRateLimiter(requests_per_second=10)
+        started = time.monotonic()
+        async with limiter:
+            pass
+        self.assertLess(time.monotonic() - started, 0.05)
+
+    async def test_concurrent_requests_are_spaced_by_the_interval(self):
+        limiter = NotionRateLimiter(requests_per_second=50)  # 20 ms apart
+        entered = []
+
+        async def request():
+            async with limiter:
+                entered.append(time.monotonic())
+
+        await asyncio.gather(*[request() for _ in range(5)])
+        entered.sort()
+        self.assertGreaterEqual(entered[-1] - entered[0], 4 * limiter.interval - 0.005)
+
+    async def test_idle_time_is_not_saved_up_as_a_burst(self):
+        limiter = NotionRateLimiter(requests_per_second=50)
+        async with limiter:
+            pass
+        await asyncio.sleep(0.1)
+        started = time.monotonic()
+        async with limiter:
+            pass
+        async with limiter:
+            pass
+        self.assertGreaterEqual(time.monotonic() - started, limiter.interval - 0.005)
+
+class FakeDatabases:
+    """Notion databases endpoint that returns page_count pages, 100 per response."""
+
+    def __init__(self, page_count: int, fail: bool = False):
+        self.pages = [{"id": f"page-{i}", "n": i} for i in range(page_count)]
+        self.fail = fail
+
+    async def query(self, database_id, page_size, start_cursor=None):
+        if self.fail:
+            raise RuntimeError("Notion is down")
+        start = int(start_cursor or 0)
+        end = start + page_size
+        return {
+            "results": self.pages[start:end],
+            "has_more": end < len(self.pages),
+            "next_cursor": str(end)
+        }
+
+class FetchNotionDocumentsTest(unittest.IsolatedAsyncioTestCase):
+    async def run_pipeline(self, databases: FakeDatabases, **settings):
+        stored = []
+
+        async def load_notion_page(page):
+            if page["n"] % 7 == 0:
+                raise RuntimeError("blocks failed")
+            if page["n"] % 10 == 0:
+                return None  # Unchanged or empty page
+            return SimpleNamespace(page_id=page["id"], n=page["n"])
+
+        async def analyze_document(doc):
+            if doc.n % 11 == 0:
+                raise RuntimeError("analysis failed")
+            return [f"chunk of {doc.page_id}"]
+
+        async def store_document(doc, processed_chunks):
+            if doc.n % 13 == 0:
+                raise RuntimeError("insert failed")
+            stored.append(doc.n)
+
+        patches = {
+            "get_notion_client": lambda: SimpleNamespace(databases=databases),
+            "notion_limiter": NotionRateLimiter(requests_per_second=1_000_000),
+            "load_notion_page": load_notion_page,
+            "analyze_document": analyze_document,
+            "store_document": store_document,
+            **settings
+        }
+        with contextlib.ExitStack() as stack:
+            for name, value in patches.items():
+                stack.enter_context(mock.patch.object(notion_uploader, name, value))
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            # Every stage must see its sentinels; a missing one would hang here
+            await asyncio.wait_for(notion_uploader.fetch_notion_documents("db"), timeout=5)
+        return stored
+
+    async def test_all_stages_shut_down_and_failed_pages_are_skipped(self):
+        stored = await self.run_pipeline(FakeDatabases(250))
+        expected = [
+            n for n in range(250)
+            if n % 7 and n % 10 and n % 11 and n % 13
+        ]
+        self.assertEqual(sorted(stored), expected)
+
+    async def test_shuts_down_with_small_queues_and_few_workers(self):
+        stored = await self.run_pipeline(
+            FakeDatabases(120),
+            NOTION_CONCURRENCY=2,
+            ANALYZE_CONCURRENCY=3,
+            PIPELINE_QUEUE_SIZE=1
+        )
+        self.assertEqual(len(stored), len([n for n in range(120) if n % 7 and n % 10 and n % 11 and n % 13]))
+
+    async def test_shuts_down_when_the_database_query_fails(self):
+        stored = await self.run_pipeline(FakeDatabases(10, fail=True))
+        self.assertEqual(stored, [])
+
+    async def test_shuts_down_on_an_empty_database(self):
+        stored = await self.run_pipeline(FakeDatabases(0))
+        self.assertEqual(stored, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import subprocess
+import sys
+import unittest
+from types import SimpleNamespace
+
+try:
+    from ai_agents.pydantic_agent import EmbeddingBatcher, _format_doc
+except ImportError as e:  # numpy, pydantic_ai, openai...
+    raise unittest.SkipTest(f"pydantic_agent dependencies not installed: {e}")
+
+class LazyImportTest(unittest.TestCase):
+    def test_import_does_not_load_the_pydantic_ai_agent(self):
+        # In a fresh interpreter: other tests may already have built the agent
+        code = "import sys, ai_agents.pydantic_agent; print('pydantic_ai.agent' in sys.modules)"
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True
+        )
+        self.assertEqual(result.stdout.strip().splitlines()[-1], "False")
+
+class FormatDocTest(unittest.TestCase):
+    DOC = {
+        "title": "Registro de vendedor",
+        "category": ["Registro", "Impuestos"],
+        "marketplace": "amazon",
+        "summary": "Pasos para abrir la cuenta.",
+        "content": "Contenido del chunk.",
+        "url": "https://example.com/registro"
+    }
+
+    def test_full_document(self):
+        self.assertEqual(
+            _format_doc(self.DOC),
+            "\n# Registro de vendedor [Registro, Impuestos] [AMAZON]\n"
+            "\n\n**Summary**: Pasos para abrir la cuenta.\n\n"
+            "Contenido del chunk.\n\nSource: https://example.com/registro\n"
+        )
+
+    def test_header_without_categories_or_marketplace(self):
+        doc = {**self.DOC, "category": []}
+        self.assertIn("# Registro de vendedor [AMAZON]\n", _format_doc(doc))
+        doc = {key: value for key, value in self.DOC.items() if key != "marketplace"}
+        self.assertIn("# Registro de vendedor [Registro, Impuestos]\n", _format_doc(doc))
+        doc = {key: value for key, value in self.DOC.items() if key not in ("marketplace", "category")}
+        self.assertIn("# Registro de vendedor \n", _format_doc(doc))
+
+    def test_without_summary(self):
+        doc = {**self.DOC, "summary": None}
+        formatted = _format_doc(doc)
+        self.assertNotIn("**Summary**", formatted)
+        self.assertIn("[AMAZON]\n\n\nContenido del chunk.", formatted)
+
+class FakeEmbeddings:
+    """OpenAI embeddings endpoint that records the inputs of every request."""
+
+    def __init__(self, error: Exception = None):
+        self.calls = []
+        self.error = error
+
+    async def create(self, model, input):
+        self.calls.append(list(input))
+        if self.error:
+            raise self.error
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(text))]) for text in input])
+
+class FakeOpenAI:
+    """Stand-in for AsyncOpenAI (the batcher groups requests by client, so it must be hashable)."""
+
+    def __init__(self, error: Exception = None):
+        self.embeddings = FakeEmbeddings(error)
+
+class EmbeddingBatcherTest(unittest.IsolatedAsyncioTestCase):
+    async def test_flushes_when_the_batch_is_full(self):
+        # The window is long: only reaching max_batch_size can send the requests in time
+        batcher = EmbeddingBatcher(max_batch_size=4, window=30)
+        client = FakeOpenAI()
+        texts = [f"texto {'x' * i}" for i in range(8)]
+        results = await asyncio.wait_for(
+            asyncio.gather(*[batcher.submit(text, client) for text in texts]), timeout=1
+        )
+        self.assertEqual(results, [[float(len(text))] for text in texts])
+        self.assertEqual(client.embeddings.calls, [texts[:4], texts[4:]])
+
+    async def test_flushes_when_the_window_expires(self):
+        batcher = EmbeddingBatcher(max_batch_size=64, window=0.02)
+        client = FakeOpenAI()
+        results = await asyncio.wait_for(
+            asyncio.gather(*[batcher.submit(text, client) for text in ["a", "bb", "ccc"]]), timeout=1
+        )
+        self.assertEqual(results, [[1.0], [2.0], [3.0]])
+        self.assertEqual(client.embeddings.calls, [["a", "bb", "ccc"]])
+
+    async def test_one_request_per_client(self):
+        batcher = EmbeddingBatcher(max_batch_size=64, window=0.02)
+        first, second = FakeOpenAI(), FakeOpenAI()
+        await asyncio.gather(batcher.submit("a", first), batcher.submit("b", second), batcher.submit("c", first))
+        self.assertEqual(first.embeddings.calls, [["a", "c"]])
+        self.assertEqual(second.embeddings.calls, [["b"]])
+
+    async def test_errors_reach_every_caller_in_the_batch(self):
+        batcher = EmbeddingBatcher(max_batch_size=64, window=0.02)
+        client = FakeOpenAI(RuntimeError("rate limited"))
+        results = await asyncio.gather(
+            batcher.submit("a", client), batcher.submit("b", client), return_exceptions=True
+        )
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        # The worker survives the error and keeps serving requests
+        client.embeddings.error = None
+        self.assertEqual(await asyncio.wait_for(batcher.submit("ok", client), timeout=1), [2.0])
+
+if __name__ == "__main__":
+    unittest.main()
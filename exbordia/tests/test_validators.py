@@ -0,0 +1,43 @@
+import unittest
+
+from utils.validators import (
+    DIRECT_RESPONSES,
+    GREETING_RESPONSE,
+    HELP_RESPONSE,
+    THANKS_RESPONSE,
+    direct_response,
+    normalize_message,
+)
+
+class NormalizeMessageTest(unittest.TestCase):
+    def test_lowercases_and_strips_accents_and_punctuation(self):
+        self.assertEqual(normalize_message("  ¡Buenos   Días!  "), "buenos dias")
+        self.assertEqual(normalize_message("¿Qué puedes hacer?"), "que puedes hacer")
+
+class DirectResponseTest(unittest.TestCase):
+    def test_table_entries(self):
+        for message, response in DIRECT_RESPONSES.items():
+            with self.subTest(message=message):
+                self.assertEqual(direct_response(message), response)
+
+    def test_matches_after_normalization(self):
+        self.assertEqual(direct_response("¡Hola!"), GREETING_RESPONSE)
+        self.assertEqual(direct_response("Muchas GRACIAS."), THANKS_RESPONSE)
+        self.assertEqual(direct_response("¿Qué puedes hacer?"), HELP_RESPONSE)
+
+    def test_short_table_entries_are_not_help(self):
+        self.assertEqual(direct_response("ok"), THANKS_RESPONSE)
+        self.assertEqual(direct_response("hi"), GREETING_RESPONSE)
+
+    def test_empty_or_punctuation_only_gets_help(self):
+        for message in ["", "   ", "?", "¿?", "..."]:
+            with self.subTest(message=message):
+                self.assertEqual(direct_response(message), HELP_RESPONSE)
+
+    def test_real_queries_go_to_the_agent(self):
+        for message in ["US", "IVA", "FBA", "¿Cómo me registro como vendedor?", "hola, ¿cómo pago impuestos?"]:
+            with self.subTest(message=message):
+                self.assertIsNone(direct_response(message))
+
+if __name__ == "__main__":
+    unittest.main()
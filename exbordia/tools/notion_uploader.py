@@ -1,25 +1,307 @@
 import os
 import sys
-import json
+import re
 import asyncio
-from typing import List, Dict, Any
-from dataclasses import dataclass
-from datetime import datetime, timezone
+import bisect
+import hashlib
+import io
+import time
+from typing import AsyncIterator, Callable, List, Dict, Any, Optional
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
+import aiohttp
+import httpx
+import orjson
+from cachetools import TTLCache
 from notion_client import AsyncClient as NotionClient
-from openai import AsyncOpenAI
+from openai import APIConnectionError, APIStatusError, APITimeoutError, AsyncOpenAI, RateLimitError
 from supabase import create_client, Client
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 load_dotenv()
 
-# Initialize clients
-openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-supabase = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_KEY"),
+class AiohttpResponseStream(httpx.AsyncByteStream):
+    """Stream an aiohttp response body into httpx."""
+
+    def __init__(self, response: aiohttp.ClientResponse, request: httpx.Request):
+        self._response = response
+        self._request = request
+
+    async def __aiter__(self):
+        # Errors while reading the body are mapped too, so the OpenAI client can retry them
+        try:
+            async for chunk in self._response.content.iter_chunked(64 * 1024):
+                yield chunk
+        except asyncio.TimeoutError as e:
+            raise httpx.ReadTimeout(str(e), request=self._request) from e
+        except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError) as e:
+            raise httpx.ReadError(str(e), request=self._request) from e
+
+    async def aclose(self):
+        self._response.release()
+
+class AiohttpTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport backed by a single aiohttp ClientSession.
+    httpx's own connection pool degrades under many concurrent requests;
+    aiohttp keeps latency flat as concurrency grows.
+    """
+
+    def __init__(self, limit: int = 100):
+        self._limit = limit
+        self._session = None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self._session is None:
+            # Created lazily so it is bound to the running event loop.
+            # httpx decodes gzip/br itself, so aiohttp must not decompress.
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._limit),
+                auto_decompress=False
+            )
+
+        timeout = request.extensions.get("timeout", {})
+        try:
+            response = await self._session.request(
+                request.method,
+                str(request.url),
+                headers=request.headers.multi_items(),
+                data=await request.aread(),
+                allow_redirects=False,
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=timeout.get("connect"),
+                    sock_read=timeout.get("read")
+                )
+            )
+        except asyncio.TimeoutError as e:
+            raise httpx.ReadTimeout(str(e), request=request) from e
+        except aiohttp.ClientConnectionError as e:
+            raise httpx.ConnectError(str(e), request=request) from e
+
+        return httpx.Response(
+            status_code=response.status,
+            headers=response.raw_headers,
+            stream=AiohttpResponseStream(response, request),
+            request=request
+        )
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+# Clients are created on first use (not at import) and shared for the whole run
+@lru_cache(maxsize=None)
+def get_openai_client() -> AsyncOpenAI:
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=0,  # Retries are handled by throttled_call
+        http_client=httpx.AsyncClient(transport=AiohttpTransport(), timeout=httpx.Timeout(60.0, connect=5.0))
+    )
+
+@lru_cache(maxsize=None)
+def get_supabase() -> Client:
+    return create_client(
+        os.getenv("SUPABASE_URL"),
+        os.getenv("SUPABASE_SERVICE_KEY"),
+    )
+
+@lru_cache(maxsize=None)
+def get_notion_client() -> NotionClient:
+    return NotionClient(auth=os.getenv("NOTION_API_KEY"))
+
+async def _execute(query):
+    """
+    Run a (sync) Supabase query in a worker thread so it does not block the event loop
+    while other pages and chunks are in flight.
+    """
+    return await asyncio.to_thread(query.execute)
+
+async def close_clients():
+    """Close the async clients created during the run (and the shared aiohttp session)."""
+    if get_openai_client.cache_info().currsize:
+        await get_openai_client().close()
+        get_openai_client.cache_clear()
+    if get_notion_client.cache_info().currsize:
+        await get_notion_client().aclose()
+        get_notion_client.cache_clear()
+
+# Pipeline sizing: pages whose blocks are fetched at the same time, documents
+# embedded/analyzed at the same time, and items buffered between stages
+NOTION_CONCURRENCY = int(os.getenv("NOTION_CONCURRENCY", "8"))
+ANALYZE_CONCURRENCY = int(os.getenv("ANALYZE_CONCURRENCY", "8"))
+PIPELINE_QUEUE_SIZE = 32
+
+class NotionRateLimiter:
+    """
+    Spaces Notion API requests evenly so they stay under Notion's average of
+    3 requests per second per integration, instead of hitting 429s and retrying.
+    Use as `async with notion_limiter:` around every Notion client call.
+    """
+
+    def __init__(self, requests_per_second: float = 3):
+        self.interval = 1 / requests_per_second
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+notion_limiter = NotionRateLimiter(float(os.getenv("NOTION_RPS", "3")))
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Chunks at least this similar to a stored one reuse its title/summary/categories
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.98"))
+
+class RateLimiter:
+    """
+    Client-side token bucket for OpenAI requests and tokens per minute.
+    Callers wait for capacity before sending, instead of hitting 429s and backing off;
+    the x-ratelimit-remaining-* response headers keep the buckets in sync with the server.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.max_requests = requests_per_minute
+        self.max_tokens = tokens_per_minute
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self._last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+        self.available_requests = min(self.max_requests, self.available_requests + elapsed * self.max_requests / 60)
+        self.available_tokens = min(self.max_tokens, self.available_tokens + elapsed * self.max_tokens / 60)
+
+    async def acquire(self, tokens: int):
+        # Never wait for more tokens than the bucket can hold
+        tokens = min(tokens, self.max_tokens)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.available_requests) * 60 / self.max_requests,
+                    (tokens - self.available_tokens) * 60 / self.max_tokens
+                )
+                await asyncio.sleep(wait)
+
+    def reconcile(self, headers):
+        """Lower the buckets to what the server reports as remaining."""
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        try:
+            if remaining_requests is not None:
+                self.available_requests = min(self.available_requests, float(remaining_requests))
+            if remaining_tokens is not None:
+                self.available_tokens = min(self.available_tokens, float(remaining_tokens))
+        except ValueError:
+            pass
+
+# Chat and embedding models have separate limits on OpenAI's side
+chat_rate_limiter = RateLimiter(
+    int(os.getenv("OPENAI_RPM", "500")),
+    int(os.getenv("OPENAI_TPM", "200000"))
+)
+embedding_rate_limiter = RateLimiter(
+    int(os.getenv("OPENAI_EMBEDDING_RPM", os.getenv("OPENAI_RPM", "500"))),
+    int(os.getenv("OPENAI_EMBEDDING_TPM", "1000000"))
+)
+
+def estimate_tokens(*texts: str) -> int:
+    """Rough token estimate (~4 characters per token)."""
+    return sum(len(text) for text in texts) // 4 + 1
+
+def _is_transient(error: BaseException) -> bool:
+    """Errors the OpenAI SDK itself retries: rate limits, timeouts, connection errors, 408, 409 and 5xx."""
+    if isinstance(error, (RateLimitError, APITimeoutError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code >= 500 or error.status_code in (408, 409))
+
+@retry(
+    retry=retry_if_exception(_is_transient),
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    reraise=True
 )
-notion_client = NotionClient(auth=os.getenv("NOTION_API_KEY"))
+async def throttled_call(resource, limiter: RateLimiter, est_tokens: int, **kwargs):
+    """
+    Call resource.create(**kwargs) (e.g. get_openai_client().chat.completions) once the
+    limiter has capacity, and reconcile it with the rate-limit headers of the response.
+    Transient errors (see _is_transient) are retried with exponential backoff and
+    jitter; any other error, or the last one after 6 attempts, is raised to the caller.
+    """
+    await limiter.acquire(est_tokens)
+    raw_response = await resource.with_raw_response.create(**kwargs)
+    limiter.reconcile(raw_response.headers)
+    return raw_response.parse()
+
+# In-process embedding cache: content hash -> future, so identical chunks share one request.
+# Bounded so a long sync does not keep every vector in memory (embedding_cache persists them)
+_embedding_tasks: TTLCache = TTLCache(maxsize=10000, ttl=3600)
+
+# Texts per embeddings request (the API accepts up to 2048 inputs)
+EMBEDDING_BATCH_SIZE = 100
+
+# Taxonomía de categorías para clasificar los chunks
+CATEGORIES_WITH_DESCRIPTIONS = {
+    "Logística": "Envíos, fulfillment, almacenamiento y tiempos de entrega.",
+    "Regulaciones y Aduanas": "Requisitos de importación, documentación, fracciones arancelarias.",
+    "Marketing y Publicidad": "Amazon Ads, estrategias de PPC, branding en Amazon.",
+    "Ventas y Conversión": "Cómo mejorar listados, obtener más reviews, Buy Box.",
+    "Finanzas y Costos": "Tarifas de Amazon, impuestos, costos ocultos, márgenes de ganancia.",
+    "Estrategia de Negocio": "Modelos de venta (FBA vs FBM), expansión, nichos rentables.",
+    "Legales y Compliance": "Propiedad intelectual, restricciones de productos, términos de servicio.",
+    "Operaciones y Gestión de Inventario": "Stock, reabastecimiento, proveedores, gestión con Amazon.",
+    "Optimización de Listados": "Keywords, títulos, bullet points, imágenes, descripciones.",
+    "Customer Service y Devoluciones": "Manejo de clientes, disputas, reembolsos y reputación.",
+    "Amazon FBA y FBM": "Comparación entre modelos, ventajas y desventajas.",
+    "Análisis de Competencia": "Herramientas para investigar a otros vendedores.",
+    "Expansión a Otros Mercados": "Cómo escalar de Amazon US a otros marketplaces.",
+    "Amazon Seller Central": "Manejo de la plataforma, reports, troubleshooting.",
+    "Reembolsos y Cargos Ocultos": "Cómo reclamar cobros indebidos en Amazon."
+}
+
+ALLOWED_CATEGORIES = frozenset(CATEGORIES_WITH_DESCRIPTIONS) | {"uncategorized"}
+
+# Descripción detallada de cada categoría para el prompt (se construye una sola vez)
+CATEGORIES_DESCRIPTION = "\n".join([f"- {cat}: {desc}" for cat, desc in CATEGORIES_WITH_DESCRIPTIONS.items()])
+
+CHUNK_METADATA_SYSTEM_PROMPT = f"""Eres un agente especializado en analizar contenido relacionado con Amazon Seller.
+Para el fragmento de documentación proporcionado debes:
+1. Crear un título conciso y descriptivo ("title").
+2. Crear un resumen conciso de los puntos principales ("summary").
+3. Identificar las categorías que mejor representan el tema principal ("categories"). Puedes seleccionar
+   una o varias, pero solo de la lista proporcionada. Si no encuentras ninguna categoría relevante,
+   incluye "uncategorized".
+
+CATEGORÍAS DISPONIBLES:
+{CATEGORIES_DESCRIPTION}
+
+Devuelve un objeto JSON con las claves "title", "summary" y "categories" (array).
+
+Ejemplo de respuesta:
+{{"title": "Envíos con FBA", "summary": "Cómo preparar el inventario para FBA.", "categories": ["Logística", "Amazon FBA y FBM"]}}
+"""
+CHUNK_METADATA_SYSTEM_MESSAGE = {"role": "system", "content": CHUNK_METADATA_SYSTEM_PROMPT}
+CHUNK_METADATA_PROMPT_TOKENS = len(CHUNK_METADATA_SYSTEM_PROMPT) // 4
 
 @dataclass
 class ProcessedChunk:
@@ -34,11 +316,27 @@ class ProcessedChunk:
     metadata: Dict[str, Any]
     embedding: List[float]
 
+# Chunk boundaries, found in one pass. The lookahead also reports overlapping
+# matches (e.g. "\n\n\n"), exactly like str.rfind would.
+_BOUNDARY_PATTERN = re.compile(r"(?=(```|\n\n|\. ))")
+
+def _last_boundary(positions: List[int], start: int, limit: int) -> int:
+    """Return the last position in [start, limit], or -1 if there is none."""
+    i = bisect.bisect_right(positions, limit) - 1
+    return positions[i] if i >= 0 and positions[i] >= start else -1
+
 def chunk_text(text: str, chunk_size: int = 5000) -> List[str]:
     """Split text into chunks, respecting code blocks and paragraphs."""
+    # Precompute the offsets of every code fence, paragraph break and sentence end
+    code_blocks, paragraphs, sentences = [], [], []
+    by_kind = {"```": code_blocks, "\n\n": paragraphs, ". ": sentences}
+    for match in _BOUNDARY_PATTERN.finditer(text):
+        by_kind[match.group(1)].append(match.start())
+
     chunks = []
     start = 0
     text_length = len(text)
+    min_offset = chunk_size * 0.3  # Only break if we're past 30% of chunk_size
 
     while start < text_length:
         # Calculate end position
@@ -50,24 +348,19 @@ def chunk_text(text: str, chunk_size: int = 5000) -> List[str]:
             break
 
         # Try to find a code block boundary first (```)
-        chunk = text[start:end]
-        code_block = chunk.rfind('```')
-        if code_block != -1 and code_block > chunk_size * 0.3:
-            end = start + code_block
+        code_block = _last_boundary(code_blocks, start, end - 3)
+        if code_block != -1 and code_block - start > min_offset:
+            end = code_block
 
         # If no code block, try to break at a paragraph
-        elif '\n\n' in chunk:
-            # Find the last paragraph break
-            last_break = chunk.rfind('\n\n')
-            if last_break > chunk_size * 0.3:  # Only break if we're past 30% of chunk_size
-                end = start + last_break
+        elif (last_break := _last_boundary(paragraphs, start, end - 2)) != -1:
+            if last_break - start > min_offset:
+                end = last_break
 
         # If no paragraph break, try to break at a sentence
-        elif '. ' in chunk:
-            # Find the last sentence break
-            last_period = chunk.rfind('. ')
-            if last_period > chunk_size * 0.3:  # Only break if we're past 30% of chunk_size
-                end = start + last_period + 1
+        elif (last_period := _last_boundary(sentences, start, end - 2)) != -1:
+            if last_period - start > min_offset:
+                end = last_period + 1
 
         # Extract chunk and clean it up
         chunk = text[start:end].strip()
@@ -79,65 +372,138 @@ def chunk_text(text: str, chunk_size: int = 5000) -> List[str]:
 
     return chunks
 
-async def get_title_and_summary(chunk: str, doc_title: str, chunk_number: int) -> Dict[str, str]:
-    """Extract title and summary using GPT-4."""
-    # If it's the first chunk, use the document title
-    if chunk_number == 0 and doc_title:
-        title = doc_title
-    else:
-        # For subsequent chunks, generate a title
-        system_prompt = """You are an AI that extracts titles from documentation chunks.
-        Return a JSON object with a 'title' key.
-        Create a concise, descriptive title for this chunk of content."""
+async def extract_chunk_metadata(chunk: str, doc_title: str, chunk_number: int) -> Dict[str, Any]:
+    """
+    Extrae título, resumen y categorías de un chunk con una sola llamada a OpenAI.
+    
+    Args:
+        chunk: El texto del chunk a analizar
+        doc_title: Título del documento de Notion
+        chunk_number: Posición del chunk dentro del documento
         
-        try:
-            response = await openai_client.chat.completions.create(
-                model=os.getenv("LLM_MODEL", "gpt-4o-mini"),
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Content:\n{chunk[:1000]}..."}  # Send first 1000 chars for context
-                ],
-                response_format={ "type": "json_object" }
-            )
-            title_data = json.loads(response.choices[0].message.content)
-            title = title_data.get('title', f"{doc_title} (Part {chunk_number+1})")
-        except Exception as e:
-            print(f"Error getting title: {e}")
-            title = f"{doc_title} (Part {chunk_number+1})"
+    Returns:
+        Diccionario con las claves title, summary y categories
+    """
+    default_title = doc_title if chunk_number == 0 and doc_title else f"{doc_title} (Part {chunk_number+1})"
     
-    # Generate summary
-    system_prompt = """You are an AI that creates summaries from documentation chunks.
-    Return a JSON object with a 'summary' key.
-    Create a concise summary of the main points in this chunk."""
+    user_content = f"Contenido:\n{chunk[:2000]}..."  # Enviamos los primeros 2000 caracteres
     
-    try:
-        response = await openai_client.chat.completions.create(
-            model=os.getenv("LLM_MODEL", "gpt-4o-mini"),
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Content:\n{chunk[:1500]}..."}  # Send first 1500 chars for context
-            ],
-            response_format={ "type": "json_object" }
-        )
-        summary_data = json.loads(response.choices[0].message.content)
-        summary = summary_data.get('summary', "No summary available")
-    except Exception as e:
-        print(f"Error getting summary: {e}")
-        summary = "No summary available"
+    # OpenAI errors propagate (after retries) so the page is not stored with placeholder metadata
+    response = await throttled_call(
+        get_openai_client().chat.completions,
+        chat_rate_limiter,
+        # Prompt más un margen para la respuesta JSON
+        CHUNK_METADATA_PROMPT_TOKENS + estimate_tokens(user_content) + 500,
+        model=os.getenv("LLM_MODEL", "gpt-4o-mini"),
+        messages=[
+            CHUNK_METADATA_SYSTEM_MESSAGE,
+            {"role": "user", "content": user_content}
+        ],
+        response_format={"type": "json_object"}
+    )
+    # A malformed answer also propagates (orjson.JSONDecodeError) instead of storing placeholders
+    result = orjson.loads(response.choices[0].message.content or "")
+    if not isinstance(result, dict):
+        raise ValueError(f"Unexpected chunk metadata: {result!r}")
+    
+    # El primer chunk conserva el título del documento
+    title = default_title if chunk_number == 0 and doc_title else result.get("title") or default_title
+    summary = result.get("summary") or "No summary available"
+    
+    # Validar que las categorías estén en la lista permitida
+    extracted_categories = result.get("categories") or ["uncategorized"]
+    valid_categories = [
+        cat for cat in extracted_categories
+        if isinstance(cat, str) and (cat in ALLOWED_CATEGORIES or cat.lower() == "uncategorized")
+    ]
     
-    return {"title": title, "summary": summary}
+    return {
+        "title": title,
+        "summary": summary,
+        "categories": valid_categories or ["uncategorized"]
+    }
 
 async def get_embedding(text: str) -> List[float]:
-    """Get embedding vector from OpenAI."""
-    try:
-        response = await openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=text
+    """Get embedding vector for a single text (see get_embeddings_batch)."""
+    return (await get_embeddings_batch([text]))[0]
+
+async def get_embeddings_batch(texts: List[str]) -> List[List[float]]:
+    """
+    Get embedding vectors for many texts, reusing cached ones.
+    Identical texts share one request within a run, embeddings persist across
+    runs in the embedding_cache table keyed by content hash, and the misses are
+    sent to OpenAI together (EMBEDDING_BATCH_SIZE inputs per request).
+    """
+    keys = [hashlib.sha256(f"{EMBEDDING_MODEL}:{text}".encode()).hexdigest() for text in texts]
+
+    futures = []
+    pending = {}
+    for key, text in zip(keys, texts):
+        future = _embedding_tasks.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            _embedding_tasks[key] = future
+            pending[key] = (text, future)
+        futures.append(future)
+
+    if pending:
+        try:
+            await _fetch_embeddings(pending)
+        except BaseException as e:
+            # Never leave a future unresolved (other callers may be waiting on it)
+            # and do not keep failures in the in-process cache
+            for key, (_, future) in pending.items():
+                if not future.done():
+                    _embedding_tasks.pop(key, None)
+                    if isinstance(e, Exception):
+                        future.set_exception(e)
+                        future.exception()  # Mark as retrieved; this caller re-raises it
+                    else:
+                        future.cancel()
+            raise
+
+    return list(await asyncio.gather(*futures))
+
+async def _fetch_embeddings(pending: Dict[str, Any]):
+    """Resolve the futures in pending (hash -> (text, future)) from the cache table or OpenAI."""
+    keys = list(pending)
+    # Read EMBEDDING_BATCH_SIZE hashes per request to keep the URL of the in_ filter short
+    for i in range(0, len(keys), EMBEDDING_BATCH_SIZE):
+        try:
+            cached = await _execute(
+                get_supabase().table("embedding_cache").select("hash, embedding").in_("hash", keys[i:i + EMBEDDING_BATCH_SIZE])
+            )
+            for row in cached.data or []:
+                embedding = row["embedding"]
+                # pgvector columns come back from PostgREST as a string like "[0.1,0.2,...]"
+                pending.pop(row["hash"])[1].set_result(
+                    orjson.loads(embedding) if isinstance(embedding, str) else embedding
+                )
+        except Exception as e:
+            print(f"Error reading embedding cache: {e}")
+
+    items = list(pending.items())
+    for i in range(0, len(items), EMBEDDING_BATCH_SIZE):
+        batch = items[i:i + EMBEDDING_BATCH_SIZE]
+        inputs = [text for _, (text, _) in batch]
+        # Errors propagate: storing a zero vector would pollute the vector search
+        response = await throttled_call(
+            get_openai_client().embeddings,
+            embedding_rate_limiter,
+            estimate_tokens(*inputs),
+            model=EMBEDDING_MODEL,
+            input=inputs
         )
-        return response.data[0].embedding
-    except Exception as e:
-        print(f"Error getting embedding: {e}")
-        return [0] * 1536  # Return zero vector on error
+
+        rows = []
+        for (key, (_, future)), data in zip(batch, response.data):
+            future.set_result(data.embedding)
+            rows.append({"hash": key, "embedding": data.embedding})
+
+        try:
+            await _execute(get_supabase().table("embedding_cache").upsert(rows, ignore_duplicates=True))
+        except Exception as e:
+            print(f"Error saving embeddings to cache: {e}")
 
 def extract_text_from_rich_text(rich_text):
     """Extract plain text from Notion's rich_text array."""
@@ -145,80 +511,105 @@ def extract_text_from_rich_text(rich_text):
         return ""
     return "".join([text_obj["plain_text"] for text_obj in rich_text])
 
-def extract_content_from_blocks(blocks):
-    """Extract content from Notion blocks recursively."""
-    content = []
-    
-    for block in blocks:
-        block_type = block["type"]
-        
-        if block_type == "paragraph":
-            text = extract_text_from_rich_text(block["paragraph"]["rich_text"])
-            if text:
-                content.append(text)
-                
-        elif block_type == "heading_1":
-            text = extract_text_from_rich_text(block["heading_1"]["rich_text"])
-            if text:
-                content.append(f"# {text}")
-                
-        elif block_type == "heading_2":
-            text = extract_text_from_rich_text(block["heading_2"]["rich_text"])
-            if text:
-                content.append(f"## {text}")
-                
-        elif block_type == "heading_3":
-            text = extract_text_from_rich_text(block["heading_3"]["rich_text"])
-            if text:
-                content.append(f"### {text}")
-                
-        elif block_type == "bulleted_list_item":
-            text = extract_text_from_rich_text(block["bulleted_list_item"]["rich_text"])
-            if text:
-                content.append(f"- {text}")
-                
-        elif block_type == "numbered_list_item":
-            text = extract_text_from_rich_text(block["numbered_list_item"]["rich_text"])
-            if text:
-                content.append(f"1. {text}")
-                
-        elif block_type == "code":
-            language = block["code"].get("language", "")
-            text = extract_text_from_rich_text(block["code"]["rich_text"])
-            if text:
-                content.append(f"```{language}\n{text}\n```")
-                
-        elif block_type == "to_do":
-            checked = block["to_do"].get("checked", False)
-            text = extract_text_from_rich_text(block["to_do"]["rich_text"])
-            if text:
-                content.append(f"- {'[x]' if checked else '[ ]'} {text}")
-                
-        elif block_type == "toggle":
-            text = extract_text_from_rich_text(block["toggle"]["rich_text"])
-            if text:
-                content.append(f"**{text}**")
-                
-        elif block_type == "quote":
-            text = extract_text_from_rich_text(block["quote"]["rich_text"])
-            if text:
-                content.append(f"> {text}")
-                
-        # Add more block types as needed
-    
-    return "\n\n".join(content)
+def _prefixed(block_type: str, prefix: str) -> Callable[[Dict[str, Any]], str]:
+    """Build a formatter that prepends prefix to the block's text."""
+    def format_block(block):
+        text = extract_text_from_rich_text(block[block_type]["rich_text"])
+        return f"{prefix}{text}" if text else ""
+    return format_block
 
-async def process_chunk(chunk: str, chunk_number: int, doc_id: str, doc_title: str, 
-                       marketplace: str, category: str, source_name: List[str]) -> ProcessedChunk:
-    """Process a single chunk of text."""
-    # Get title and summary
-    extracted = await get_title_and_summary(chunk, doc_title, chunk_number)
+def _code(block):
+    language = block["code"].get("language", "")
+    text = extract_text_from_rich_text(block["code"]["rich_text"])
+    return f"```{language}\n{text}\n```" if text else ""
+
+def _to_do(block):
+    checked = block["to_do"].get("checked", False)
+    text = extract_text_from_rich_text(block["to_do"]["rich_text"])
+    return f"- {'[x]' if checked else '[ ]'} {text}" if text else ""
+
+def _toggle(block):
+    text = extract_text_from_rich_text(block["toggle"]["rich_text"])
+    return f"**{text}**" if text else ""
+
+# Block type -> formatter; add more block types as needed
+BLOCK_HANDLERS: Dict[str, Callable[[Dict[str, Any]], str]] = {
+    "paragraph": _prefixed("paragraph", ""),
+    "heading_1": _prefixed("heading_1", "# "),
+    "heading_2": _prefixed("heading_2", "## "),
+    "heading_3": _prefixed("heading_3", "### "),
+    "bulleted_list_item": _prefixed("bulleted_list_item", "- "),
+    "numbered_list_item": _prefixed("numbered_list_item", "1. "),
+    "code": _code,
+    "to_do": _to_do,
+    "toggle": _toggle,
+    "quote": _prefixed("quote", "> "),
+}
+
+async def iter_blocks(page_id: str) -> AsyncIterator[Dict[str, Any]]:
+    """Yield every child block of a page, following Notion's pagination (100 blocks per response)."""
+    cursor = None
+    while True:
+        kwargs = {"block_id": page_id, "page_size": 100}
+        if cursor:
+            kwargs["start_cursor"] = cursor
+        async with notion_limiter:
+            response = await get_notion_client().blocks.children.list(**kwargs)
+        for block in response.get("results", []):
+            yield block
+        if not response.get("has_more"):
+            break
+        cursor = response.get("next_cursor")
+
+async def extract_content_from_blocks(blocks: AsyncIterator[Dict[str, Any]]) -> str:
+    """Extract content from Notion blocks as they arrive."""
+    buffer = io.StringIO()
+    write = buffer.write
+    get_handler = BLOCK_HANDLERS.get
+    separator = ""
     
-    # Get embedding
-    embedding = await get_embedding(chunk)
+    async for block in blocks:
+        handler = get_handler(block["type"])
+        if handler and (text := handler(block)):
+            write(separator)
+            write(text)
+            separator = "\n\n"
     
-    # Extract categories using AI
-    ai_categories = await extract_categories_with_ai(chunk)
+    return buffer.getvalue()
+
+async def find_similar_chunk_metadata(embedding: List[float], doc_title: str, chunk_number: int) -> Dict[str, Any]:
+    """
+    Look up an already stored near-duplicate chunk (cosine similarity above
+    SEMANTIC_CACHE_THRESHOLD) and reuse its title, summary and categories.
+    Returns None when there is no such chunk.
+    """
+    try:
+        result = await _execute(get_supabase().rpc("match_chunk", {"embedding": embedding, "threshold": SEMANTIC_CACHE_THRESHOLD}))
+    except Exception as e:
+        print(f"Error querying similar chunks: {e}")
+        return None
+    if not result.data:
+        return None
+
+    match = result.data[0]
+    return {
+        # El primer chunk conserva el título del documento
+        "title": doc_title if chunk_number == 0 and doc_title else match["title"],
+        "summary": match["summary"],
+        "categories": match["category"] or ["uncategorized"]
+    }
+
+async def process_chunk(chunk: str, chunk_number: int, doc_id: str, doc_title: str, 
+                       marketplace: str, category: str, source_name: List[str],
+                       embedding: List[float], last_edited_time: str = None,
+                       fetched_at: str = None) -> ProcessedChunk:
+    """Process a single chunk of text (its embedding is computed per page, in one batch)."""
+    # A near-duplicate chunk already stored lets us skip the LLM call
+    extracted = await find_similar_chunk_metadata(embedding, doc_title, chunk_number)
+    if extracted is None:
+        # Get title, summary and categories (one call)
+        extracted = await extract_chunk_metadata(chunk, doc_title, chunk_number)
+    ai_categories = extracted['categories']
     
     # Create URL using doc_id
     url = f"notion://{doc_id}"
@@ -228,6 +619,9 @@ async def process_chunk(chunk: str, chunk_number: int, doc_id: str, doc_title: s
         "source": "notion",
         "doc_id": doc_id,
         "processed_at": datetime.now(timezone.utc).isoformat(),
+        # Notion's edit timestamp and when the blocks were read, used to skip unchanged pages on the next run
+        "last_edited_time": last_edited_time,
+        "fetched_at": fetched_at,
     }
     
     # Si tenemos categorías de IA, las usamos; de lo contrario, usamos la categoría de Notion
@@ -246,235 +640,277 @@ async def process_chunk(chunk: str, chunk_number: int, doc_id: str, doc_title: s
         embedding=embedding
     )
 
-async def insert_chunk(chunk: ProcessedChunk):
-    """Insert a processed chunk into Supabase."""
-    try:
-        data = {
-            "url": chunk.url,
-            "chunk_number": chunk.chunk_number,
-            "title": chunk.title,
-            "summary": chunk.summary,
-            "content": chunk.content,
-            "marketplace": chunk.marketplace,
-            "category": chunk.category,
-            "source_name": chunk.source_name,
-            "metadata": chunk.metadata,
-            "embedding": chunk.embedding,
-            # Otros campos
-            "source_id": chunk.metadata.get("doc_id"),
-            "related_links": chunk.metadata.get("related_links")
-        }
-        
-        result = supabase.table("site_pages").insert(data).execute()
-        print(f"Inserted chunk {chunk.chunk_number} for {chunk.url}")
-        return result
-    except Exception as e:
-        print(f"Error inserting chunk: {e}")
-        return None
+def chunk_to_row(chunk: ProcessedChunk) -> Dict[str, Any]:
+    """Build the site_pages row for a processed chunk."""
+    return {
+        "url": chunk.url,
+        "chunk_number": chunk.chunk_number,
+        "title": chunk.title,
+        "summary": chunk.summary,
+        "content": chunk.content,
+        "marketplace": chunk.marketplace,
+        "category": chunk.category,
+        "source_name": chunk.source_name,
+        "metadata": chunk.metadata,
+        "embedding": chunk.embedding,
+        # Otros campos
+        "source_id": chunk.metadata.get("doc_id"),
+        "related_links": chunk.metadata.get("related_links")
+    }
 
-async def process_notion_page(page):
-    """Process a single Notion page and store it in Supabase."""
-    try:
-        # Extract page properties
-        page_id = page["id"]
-        properties = page["properties"]
-        
-        # Extract document title
-        title = "Untitled Document"
-        for prop_name, prop_data in properties.items():
-            if prop_data["type"] == "title" and prop_data["title"]:
-                title = " ".join([text_obj["plain_text"] for text_obj in prop_data["title"]])
-                break
-        
-        # Extract marketplace
-        marketplace = "general"
-        if "Marketplace" in properties and properties["Marketplace"]["type"] == "select":
-            select_data = properties["Marketplace"]["select"]
-            if select_data:
-                marketplace = select_data.get("name", "general").lower()
-        
-        # Extract category from Notion (como respaldo)
-        notion_category = "uncategorized"  # Valor por defecto
-        if "Category" in properties and properties["Category"]["type"] == "multi_select":
-            multi_select_data = properties["Category"]["multi_select"]
-            if multi_select_data and multi_select_data[0].get("name"):
-                notion_category = multi_select_data[0].get("name", "uncategorized").lower()
-        elif "Category" in properties and properties["Category"]["type"] == "select":
-            select_data = properties["Category"]["select"]
-            if select_data and select_data.get("name"):
-                notion_category = select_data.get("name", "uncategorized").lower()
-        
-        # Extract source_name
-        source_name = ["notion"]  # Valor por defecto
-        if "source_name" in properties and properties["source_name"]["type"] == "multi_select":
-            multi_select_data = properties["source_name"]["multi_select"]
-            if multi_select_data:
-                source_name = [item.get("name", "").lower() for item in multi_select_data]
-                if not source_name:  # Si la lista está vacía después de procesar
-                    source_name = ["notion"]
-        
-        # Extract document ID (use custom ID if available, otherwise use page_id)
-        doc_id = page_id
-        if "ID" in properties and properties["ID"]["type"] == "number":
-            custom_id = properties["ID"]["number"]
-            if custom_id is not None:
-                doc_id = f"custom-{custom_id}"
-        
-        # Create URL for the document
-        url = f"notion://{doc_id}"
-        
-        # Check if document already exists in Supabase
-        result = supabase.from_("site_pages").select("url, chunk_number").eq("url", url).execute()
-        existing_chunks = result.data
-        
-        if existing_chunks:
-            print(f"Document {doc_id} already exists with {len(existing_chunks)} chunks. Updating...")
-            # Delete existing chunks
-            for chunk in existing_chunks:
-                supabase.from_("site_pages").delete().eq("url", url).eq("chunk_number", chunk["chunk_number"]).execute()
-            print(f"Deleted {len(existing_chunks)} existing chunks for document {doc_id}")
-        
-        # Get page content
-        blocks_response = await notion_client.blocks.children.list(block_id=page_id)
-        blocks = blocks_response.get("results", [])
-        
-        # Extract content from blocks
-        content = extract_content_from_blocks(blocks)
-        
-        if not content.strip():
-            print(f"Warning: No content extracted from page {title} ({doc_id})")
-            return
-        
-        # Split content into chunks
-        chunks = chunk_text(content)
-        print(f"Processing {len(chunks)} chunks for document: {title}")
-        
-        # Process chunks in parallel
-        tasks = [
-            process_chunk(chunk, i, doc_id, title, marketplace, notion_category, source_name) 
-            for i, chunk in enumerate(chunks)
-        ]
-        processed_chunks = await asyncio.gather(*tasks)
-        
-        # Store chunks in parallel
-        insert_tasks = [
-            insert_chunk(chunk) 
-            for chunk in processed_chunks
-        ]
-        await asyncio.gather(*insert_tasks)
-        
-        print(f"Successfully processed document: {title} ({doc_id})")
-        
-    except Exception as e:
-        print(f"Error processing page {page['id']}: {e}")
+async def delete_document_chunks(url: str, doc_id: str):
+    """Delete all stored chunks of a document in a single request."""
+    result = await _execute(get_supabase().from_("site_pages").delete(count="exact", returning="minimal").eq("url", url))
+    if result.count:
+        print(f"Deleted {result.count} existing chunks for document {doc_id}. Updating...")
 
-async def fetch_notion_documents(database_id: str):
-    """Fetch all documents from a Notion database."""
+@dataclass
+class NotionDocument:
+    page_id: str
+    doc_id: str
+    url: str
+    title: str
+    marketplace: str
+    category: str
+    source_name: List[str]
+    last_edited_time: Optional[str]
+    chunks: List[str] = field(default_factory=list)
+    fetched_at: Optional[str] = None  # When the blocks were read (UTC, ISO 8601)
+
+def parse_notion_page(page) -> NotionDocument:
+    """Read the document fields from a Notion page's properties."""
+    page_id = page["id"]
+    properties = page["properties"]
+    
+    # Extract document title
+    title = "Untitled Document"
+    for prop_name, prop_data in properties.items():
+        if prop_data["type"] == "title" and prop_data["title"]:
+            title = " ".join([text_obj["plain_text"] for text_obj in prop_data["title"]])
+            break
+    
+    # Extract marketplace
+    marketplace = "general"
+    if "Marketplace" in properties and properties["Marketplace"]["type"] == "select":
+        select_data = properties["Marketplace"]["select"]
+        if select_data:
+            marketplace = select_data.get("name", "general").lower()
+    
+    # Extract category from Notion (como respaldo)
+    notion_category = "uncategorized"  # Valor por defecto
+    if "Category" in properties and properties["Category"]["type"] == "multi_select":
+        multi_select_data = properties["Category"]["multi_select"]
+        if multi_select_data and multi_select_data[0].get("name"):
+            notion_category = multi_select_data[0].get("name", "uncategorized").lower()
+    elif "Category" in properties and properties["Category"]["type"] == "select":
+        select_data = properties["Category"]["select"]
+        if select_data and select_data.get("name"):
+            notion_category = select_data.get("name", "uncategorized").lower()
+    
+    # Extract source_name
+    source_name = ["notion"]  # Valor por defecto
+    if "source_name" in properties and properties["source_name"]["type"] == "multi_select":
+        multi_select_data = properties["source_name"]["multi_select"]
+        if multi_select_data:
+            source_name = [item.get("name", "").lower() for item in multi_select_data]
+            if not source_name:  # Si la lista está vacía después de procesar
+                source_name = ["notion"]
+    
+    # Extract document ID (use custom ID if available, otherwise use page_id)
+    doc_id = page_id
+    if "ID" in properties and properties["ID"]["type"] == "number":
+        custom_id = properties["ID"]["number"]
+        if custom_id is not None:
+            doc_id = f"custom-{custom_id}"
+    
+    return NotionDocument(
+        page_id=page_id,
+        doc_id=doc_id,
+        url=f"notion://{doc_id}",
+        title=title,
+        marketplace=marketplace,
+        category=notion_category,
+        source_name=source_name,
+        last_edited_time=page.get("last_edited_time")
+    )
+
+def _parse_timestamp(value: str) -> datetime:
+    # Notion uses a "Z" suffix, which fromisoformat only accepts from Python 3.11
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+def is_unchanged(last_edited_time: str, stored: Dict[str, Any]) -> bool:
+    """
+    Whether the stored version of a page already includes its latest edit.
+    Notion truncates last_edited_time to the minute, so an equal timestamp is not enough:
+    an edit later in that same minute could have been missed. The stored copy is only
+    up to date if its blocks were read a full minute after last_edited_time.
+    """
+    if stored.get("last_edited_time") != last_edited_time:
+        return False
+    # Rows stored before fetched_at existed only have processed_at
+    read_at = stored.get("fetched_at") or stored.get("processed_at")
+    if not read_at:
+        return False
     try:
-        print(f"Fetching documents from Notion database: {database_id}")
-        
-        # Query the database
-        response = await notion_client.databases.query(database_id=database_id)
-        pages = response.get("results", [])
-        
-        if not pages:
-            print("No documents found in the database")
-            return
-        
-        print(f"Found {len(pages)} documents in Notion database")
-        
-        # Process each page
-        for page in pages:
-            await process_notion_page(page)
-            
-        print("Finished processing all documents")
-        
-    except Exception as e:
-        print(f"Error fetching Notion documents: {e}")
+        return _parse_timestamp(read_at) >= _parse_timestamp(last_edited_time) + timedelta(minutes=1)
+    except ValueError:
+        return False
 
-async def extract_categories_with_ai(chunk: str) -> List[str]:
+async def load_notion_page(page) -> Optional[NotionDocument]:
     """
-    Utiliza IA para extraer categorías relevantes del contenido del chunk.
-    
-    Args:
-        chunk: El texto del chunk a analizar
-        
-    Returns:
-        Lista de categorías identificadas
+    Fetch and chunk the content of a Notion page.
+    Returns None when the page is unchanged since the last run or has no content.
     """
-    categories_list = [
-        "Logística", "Regulaciones y Aduanas", "Marketing y Publicidad", 
-        "Ventas y Conversión", "Finanzas y Costos", "Estrategia de Negocio", 
-        "Legales y Compliance", "Operaciones y Gestión de Inventario", 
-        "Optimización de Listados", "Customer Service y Devoluciones", 
-        "Amazon FBA y FBM", "Análisis de Competencia", 
-        "Expansión a Otros Mercados", "Amazon Seller Central", 
-        "Reembolsos y Cargos Ocultos"
-    ]
+    doc = parse_notion_page(page)
     
-    categories_with_descriptions = {
-        "Logística": "Envíos, fulfillment, almacenamiento y tiempos de entrega.",
-        "Regulaciones y Aduanas": "Requisitos de importación, documentación, fracciones arancelarias.",
-        "Marketing y Publicidad": "Amazon Ads, estrategias de PPC, branding en Amazon.",
-        "Ventas y Conversión": "Cómo mejorar listados, obtener más reviews, Buy Box.",
-        "Finanzas y Costos": "Tarifas de Amazon, impuestos, costos ocultos, márgenes de ganancia.",
-        "Estrategia de Negocio": "Modelos de venta (FBA vs FBM), expansión, nichos rentables.",
-        "Legales y Compliance": "Propiedad intelectual, restricciones de productos, términos de servicio.",
-        "Operaciones y Gestión de Inventario": "Stock, reabastecimiento, proveedores, gestión con Amazon.",
-        "Optimización de Listados": "Keywords, títulos, bullet points, imágenes, descripciones.",
-        "Customer Service y Devoluciones": "Manejo de clientes, disputas, reembolsos y reputación.",
-        "Amazon FBA y FBM": "Comparación entre modelos, ventajas y desventajas.",
-        "Análisis de Competencia": "Herramientas para investigar a otros vendedores.",
-        "Expansión a Otros Mercados": "Cómo escalar de Amazon US a otros marketplaces.",
-        "Amazon Seller Central": "Manejo de la plataforma, reports, troubleshooting.",
-        "Reembolsos y Cargos Ocultos": "Cómo reclamar cobros indebidos en Amazon."
-    }
+    # Skip pages that have not been edited since they were last ingested
+    if doc.last_edited_time:
+        stored = await _execute(
+            get_supabase().from_("site_pages")
+                .select("last_edited_time:metadata->>last_edited_time, fetched_at:metadata->>fetched_at, processed_at:metadata->>processed_at")
+                .eq("url", doc.url)
+                .limit(1)
+        )
+        if stored.data and is_unchanged(doc.last_edited_time, stored.data[0]):
+            print(f"Skipping unchanged document: {doc.title} ({doc.doc_id})")
+            return None
+    
+    # Get page content (all pages of blocks) and extract it as it arrives
+    doc.fetched_at = datetime.now(timezone.utc).isoformat()
+    content = await extract_content_from_blocks(iter_blocks(doc.page_id))
     
-    # Crear una descripción detallada de cada categoría para el prompt
-    categories_description = "\n".join([f"- {cat}: {desc}" for cat, desc in categories_with_descriptions.items()])
+    if not content.strip():
+        print(f"Warning: No content extracted from page {doc.title} ({doc.doc_id})")
+        await delete_document_chunks(doc.url, doc.doc_id)
+        return None
     
-    system_prompt = f"""Eres un agente especializado en analizar contenido relacionado con Amazon Seller.
-Tu tarea es identificar las categorías más relevantes para el texto proporcionado.
+    # Split content into chunks
+    doc.chunks = chunk_text(content)
+    print(f"Processing {len(doc.chunks)} chunks for document: {doc.title}")
+    return doc
 
-CATEGORÍAS DISPONIBLES:
-{categories_description}
+async def analyze_document(doc: NotionDocument) -> List[ProcessedChunk]:
+    """Embed and analyze the chunks of a document."""
+    chunks = doc.chunks
+    
+    # Identical chunks (repeated sections, templates) are processed only once
+    chunk_hashes = [hashlib.blake2b(chunk.encode(), digest_size=16).digest() for chunk in chunks]
+    first_index = {}
+    for i, chunk_hash in enumerate(chunk_hashes):
+        first_index.setdefault(chunk_hash, i)
+    unique_indexes = list(first_index.values())  # In order of first appearance
+    unique_chunks = [chunks[i] for i in unique_indexes]
+    if len(unique_chunks) < len(chunks):
+        print(f"Skipping {len(chunks) - len(unique_chunks)} duplicate chunks for document: {doc.title}")
+    
+    # Embed every chunk of the page with one request
+    embeddings = await get_embeddings_batch(unique_chunks)
+    
+    # Process chunks in parallel
+    tasks = [
+        process_chunk(chunk, i, doc.doc_id, doc.title, doc.marketplace, doc.category, doc.source_name,
+                      embedding, doc.last_edited_time, doc.fetched_at) 
+        for i, chunk, embedding in zip(unique_indexes, unique_chunks, embeddings)
+    ]
+    processed_by_hash = dict(zip(first_index, await asyncio.gather(*tasks)))
+    
+    # Copy each result to every position where its chunk appears
+    processed_chunks = []
+    for i, chunk_hash in enumerate(chunk_hashes):
+        processed = processed_by_hash[chunk_hash]
+        processed_chunks.append(processed if processed.chunk_number == i else replace(processed, chunk_number=i))
+    return processed_chunks
 
-INSTRUCCIONES:
-1. Lee cuidadosamente el contenido proporcionado.
-2. Identifica las categorías que mejor representan el tema principal del contenido.
-3. Puedes seleccionar una o varias categorías, pero solo de la lista proporcionada.
-4. Devuelve un objeto JSON con una clave "categories" que contenga un array de las categorías seleccionadas.
-5. Si no encuentras ninguna categoría relevante, incluye "uncategorized" en el array.
+async def store_document(doc: NotionDocument, processed_chunks: List[ProcessedChunk]):
+    """
+    Replace the stored chunks of a document with the new ones. The delete and the
+    insert run in one transaction (replace_document_chunks), so if storing fails the
+    document keeps its previous version; errors propagate to the caller.
+    """
+    result = await _execute(get_supabase().rpc("replace_document_chunks", {
+        "p_url": doc.url,
+        "p_rows": [chunk_to_row(chunk) for chunk in processed_chunks]
+    }))
+    print(f"Inserted {result.data} chunks for {doc.url}")
+    print(f"Successfully processed document: {doc.title} ({doc.doc_id})")
 
-Ejemplo de respuesta:
-{{"categories": ["Logística", "Amazon FBA y FBM"]}}
-"""
+async def fetch_notion_documents(database_id: str):
+    """
+    Fetch and process all documents from a Notion database as a pipeline:
+    database pages -> block fetching (NOTION_CONCURRENCY workers) -> embeddings and
+    analysis (ANALYZE_CONCURRENCY workers) -> Supabase writes. The stages are linked by
+    bounded queues, so a slow stage makes the previous ones wait instead of piling up
+    pages in memory.
+    """
+    pages_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    documents_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    analyzed_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
     
-    try:
-        response = await openai_client.chat.completions.create(
-            model=os.getenv("LLM_MODEL", "gpt-4o-mini"),
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Contenido a categorizar:\n{chunk[:2000]}..."}  # Enviamos los primeros 2000 caracteres
-            ],
-            response_format={"type": "json_object"}
-        )
-        
-        result = json.loads(response.choices[0].message.content)
-        extracted_categories = result.get("categories", ["uncategorized"])
-        
-        # Validar que las categorías estén en la lista permitida
-        valid_categories = [cat for cat in extracted_categories if cat in categories_list or cat.lower() == "uncategorized"]
-        
-        # Si no hay categorías válidas, usar "uncategorized"
-        if not valid_categories:
-            valid_categories = ["uncategorized"]
-            
-        return valid_categories
-        
-    except Exception as e:
-        print(f"Error extrayendo categorías con IA: {e}")
-        return ["uncategorized"]
+    async def fetch_pages() -> int:
+        total = 0
+        try:
+            print(f"Fetching documents from Notion database: {database_id}")
+            cursor = None
+            while True:
+                kwargs = {"database_id": database_id, "page_size": 100}
+                if cursor:
+                    kwargs["start_cursor"] = cursor
+                async with notion_limiter:
+                    response = await get_notion_client().databases.query(**kwargs)
+                for page in response.get("results", []):
+                    total += 1
+                    await pages_queue.put(page)
+                if not response.get("has_more"):
+                    break
+                cursor = response.get("next_cursor")
+        except Exception as e:
+            print(f"Error fetching Notion documents: {e}")
+        finally:
+            for _ in range(NOTION_CONCURRENCY):
+                await pages_queue.put(None)
+        return total
+    
+    async def run_stage(handler, workers: int, in_queue, out_queue=None, out_workers: int = 0):
+        async def worker():
+            while (item := await in_queue.get()) is not None:
+                result = await handler(item)
+                if result is not None and out_queue is not None:
+                    await out_queue.put(result)
+        await asyncio.gather(*[worker() for _ in range(workers)])
+        # Tell every worker of the next stage that there is no more input
+        for _ in range(out_workers):
+            await out_queue.put(None)
+    
+    async def fetch_blocks(page):
+        try:
+            return await load_notion_page(page)
+        except Exception as e:
+            print(f"Error processing page {page['id']}: {e}")
+    
+    async def embed_and_analyze(doc: NotionDocument):
+        try:
+            return doc, await analyze_document(doc)
+        except Exception as e:
+            print(f"Error processing page {doc.page_id}: {e}")
+    
+    async def insert_batch(item):
+        doc, processed_chunks = item
+        try:
+            await store_document(doc, processed_chunks)
+        except Exception as e:
+            print(f"Error processing page {doc.page_id}: {e}")
+    
+    total, *_ = await asyncio.gather(
+        fetch_pages(),
+        run_stage(fetch_blocks, NOTION_CONCURRENCY, pages_queue, documents_queue, ANALYZE_CONCURRENCY),
+        run_stage(embed_and_analyze, ANALYZE_CONCURRENCY, documents_queue, analyzed_queue, 1),
+        run_stage(insert_batch, 1, analyzed_queue)
+    )
+    
+    if not total:
+        print("No documents found in the database")
+    else:
+        print(f"Finished processing all {total} documents")
 
 async def main():
     # Get Notion database ID from environment variable
@@ -483,8 +919,11 @@ async def main():
         print("Error: NOTION_DATABASE_ID environment variable not set")
         return
     
-    # Process all documents in the database
-    await fetch_notion_documents(database_id)
+    try:
+        # Process all documents in the database
+        await fetch_notion_documents(database_id)
+    finally:
+        await close_clients()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,53 @@
+import re
+import unicodedata
+from typing import Optional
+
+# Respuestas fijas para mensajes que no necesitan pasar por el LLM
+GREETING_RESPONSE = (
+    "¡Hola! Soy el asistente de Exbordia. Puedo ayudarte a vender en Amazon USA: "
+    "registro como vendedor, requisitos fiscales, logística, listados y precios. "
+    "¿Qué te gustaría saber?"
+)
+THANKS_RESPONSE = "¡Con gusto! Si tienes otra pregunta sobre vender en Amazon USA, aquí estoy."
+HELP_RESPONSE = (
+    "Puedo responder preguntas sobre cómo vender en Amazon USA desde México: "
+    "registro, impuestos, envíos y FBA, optimización de listados, precios y atención al cliente. "
+    "Escribe tu pregunta con un poco de detalle para darte una mejor respuesta."
+)
+
+DIRECT_RESPONSES = {
+    **dict.fromkeys(
+        ["hola", "hi", "hello", "hey", "buenas", "buen dia", "buenos dias", "buenas tardes", "buenas noches"],
+        GREETING_RESPONSE,
+    ),
+    **dict.fromkeys(
+        ["gracias", "muchas gracias", "ok", "okay", "vale", "perfecto", "listo", "thanks", "thank you"],
+        THANKS_RESPONSE,
+    ),
+    **dict.fromkeys(
+        ["ayuda", "help", "test", "prueba", "que puedes hacer", "que haces"],
+        HELP_RESPONSE,
+    ),
+}
+
+_NON_WORD = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+def normalize_message(message: str) -> str:
+    """
+    Normaliza un mensaje para compararlo: minúsculas, sin acentos ni signos de puntuación.
+    """
+    text = unicodedata.normalize("NFKD", message.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = _NON_WORD.sub(" ", text)
+    return _SPACES.sub(" ", text).strip()
+
+def direct_response(message: str) -> Optional[str]:
+    """
+    Devuelve una respuesta fija para saludos, agradecimientos, pedidos de ayuda o
+    mensajes vacíos (solo espacios o signos); None si el mensaje debe pasar por el agente.
+    """
+    normalized = normalize_message(message)
+    if not normalized:
+        return HELP_RESPONSE
+    return DIRECT_RESPONSES.get(normalized)
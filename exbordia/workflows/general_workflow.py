@@ -1,8 +1,61 @@
 import time
 import asyncio
-from typing import Dict, Any, Optional
+import logging
+from typing import Dict, Any, Optional, List, AsyncIterator
 from .base_workflow import BaseWorkflow
 
+logger = logging.getLogger(__name__)
+
+# Referencias a los guardados en segundo plano para que no los recolecte el GC antes de terminar
+_background_tasks = set()
+
+# Los análisis (lentos, una llamada al LLM) van a una cola acotada atendida por un número
+# fijo de workers; si la cola está llena el análisis se descarta (la conversación ya está guardada)
+ANALYSIS_QUEUE_SIZE = 256
+ANALYSIS_WORKERS = 8
+_analysis_queue: Optional[asyncio.Queue] = None
+_analysis_workers: List[asyncio.Task] = []
+
+async def _analysis_worker() -> None:
+    while True:
+        conversation_service, openai_client, conversation = await _analysis_queue.get()
+        try:
+            await conversation_service.analyze_and_update_conversation(
+                conversation_id=conversation["id"],
+                openai_client=openai_client,
+                conversation=conversation  # Ya tenemos la fila: no volver a leerla
+            )
+        except Exception:
+            logger.exception("Error analizando la conversación")
+        finally:
+            _analysis_queue.task_done()
+
+def _enqueue_analysis(conversation_service, openai_client, conversation: Dict[str, Any]) -> None:
+    """
+    Encola el análisis de una conversación guardada, arrancando los workers la primera vez.
+    """
+    global _analysis_queue
+    if _analysis_queue is None:
+        _analysis_queue = asyncio.Queue(maxsize=ANALYSIS_QUEUE_SIZE)
+        _analysis_workers.extend(asyncio.create_task(_analysis_worker()) for _ in range(ANALYSIS_WORKERS))
+    try:
+        _analysis_queue.put_nowait((conversation_service, openai_client, conversation))
+    except asyncio.QueueFull:
+        logger.warning("Cola de análisis llena; se omite el análisis de la conversación %s", conversation["id"])
+
+async def drain_background_tasks() -> None:
+    """
+    Espera a que terminen los guardados y los análisis encolados (se llama al apagar la API).
+    """
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+    if _analysis_queue is not None:
+        await _analysis_queue.join()
+        for worker in _analysis_workers:
+            worker.cancel()
+        await asyncio.gather(*_analysis_workers, return_exceptions=True)
+        _analysis_workers.clear()
+
 class GeneralWorkflow(BaseWorkflow):
     """
     Workflow para procesar preguntas generales.
@@ -14,24 +67,7 @@ class GeneralWorkflow(BaseWorkflow):
         """
         start_time = time.time()
         
-        # Obtener contexto de conversaciones anteriores
-        conversation_context = await self.conversation_service.get_conversation_context(
-            telegram_id=user_id,
-            session_id=session_id,
-            limit=5  # Últimas 5 conversaciones
-        )
-        
-        # Preparar mensajes para OpenAI
-        messages = [
-            {"role": "system", "content": "Eres un asistente de IA avanzado que proporciona respuestas detalladas, actualizadas y precisas. Responde con contexto relevante y menciona información clave cuando sea necesario."}
-        ]
-        
-        # Añadir mensajes del contexto si existen
-        if conversation_context.get("messages"):
-            messages.extend(conversation_context.get("messages"))
-        
-        # Añadir el mensaje actual del usuario
-        messages.append({"role": "user", "content": message})
+        messages = await self._build_messages(user_id, session_id, message)
         
         # Generar respuesta con OpenAI
         completion = await self.openai_client.chat.completions.create(
@@ -48,27 +84,118 @@ class GeneralWorkflow(BaseWorkflow):
         execution_time = time.time() - start_time
         total_tokens = completion.usage.total_tokens
         
-        # Guardar la conversación
-        conversation = await self.conversation_service.save_conversation(
-            telegram_id=user_id,
-            session_id=session_id,
-            question=message,
-            answer=response,
-            total_tokens=total_tokens,
-            execution_time=execution_time
-        )
-        
-        # Iniciar análisis en segundo plano (sin esperar)
-        if conversation and "id" in conversation:
-            asyncio.create_task(
-                self.conversation_service.analyze_and_update_conversation(
-                    conversation_id=conversation["id"],
-                    openai_client=self.openai_client
-                )
+        # Guardar y analizar la conversación en segundo plano (sin esperar);
+        # el usuario no necesita que la base de datos termine para recibir la respuesta
+        task = asyncio.create_task(
+            self._save_and_analyze(
+                user_id=user_id,
+                session_id=session_id,
+                question=message,
+                answer=response,
+                total_tokens=total_tokens,
+                execution_time=execution_time
             )
+        )
+        self._track(task)
         
         return {
             "response": response,
             "session_id": session_id,
             "workflow": "general"
-        } 
\ No newline at end of file
+        } 
+    
+    async def stream(self, user_id: str, session_id: str, message: str, context: Dict[str, Any] = None) -> AsyncIterator[str]:
+        """
+        Procesa un mensaje general y va devolviendo la respuesta a medida que el modelo la genera.
+        Al terminar guarda la conversación completa en segundo plano, igual que process.
+        """
+        start_time = time.time()
+        
+        messages = await self._build_messages(user_id, session_id, message)
+        
+        stream = await self.openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0.4,
+            max_tokens=1000,
+            stream=True,
+            stream_options={"include_usage": True}  # El último chunk trae el uso de tokens
+        )
+        
+        # Acumular la respuesta completa para poder guardarla al final
+        parts = []
+        total_tokens = 0
+        async for chunk in stream:
+            if chunk.usage:
+                total_tokens = chunk.usage.total_tokens
+            if chunk.choices and chunk.choices[0].delta.content:
+                delta = chunk.choices[0].delta.content
+                parts.append(delta)
+                yield delta
+        
+        task = asyncio.create_task(
+            self._save_and_analyze(
+                user_id=user_id,
+                session_id=session_id,
+                question=message,
+                answer="".join(parts),
+                total_tokens=total_tokens,
+                execution_time=time.time() - start_time
+            )
+        )
+        self._track(task)
+    
+    async def _build_messages(self, user_id: str, session_id: str, message: str) -> List[Dict[str, str]]:
+        """
+        Prepara los mensajes para OpenAI con el contexto de las conversaciones anteriores.
+        """
+        # Obtener contexto de conversaciones anteriores
+        conversation_context = await self.conversation_service.get_conversation_context(
+            telegram_id=user_id,
+            session_id=session_id,
+            limit=5  # Últimas 5 conversaciones
+        )
+        
+        # Preparar mensajes para OpenAI
+        messages = [
+            {"role": "system", "content": "Eres un asistente de IA avanzado que proporciona respuestas detalladas, actualizadas y precisas. Responde con contexto relevante y menciona información clave cuando sea necesario."}
+        ]
+        
+        # Añadir mensajes del contexto si existen
+        if conversation_context.get("messages"):
+            messages.extend(conversation_context.get("messages"))
+        
+        # Añadir el mensaje actual del usuario
+        messages.append({"role": "user", "content": message})
+        
+        return messages
+    
+    @staticmethod
+    def _track(task: asyncio.Task) -> None:
+        # Guardar la referencia hasta que la tarea termine
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    
+    async def _save_and_analyze(self, user_id: str, session_id: str, question: str, answer: str,
+                                total_tokens: int, execution_time: float) -> None:
+        """
+        Guarda la conversación y, si se guardó, encola su análisis.
+        
+        El guardado no espera a ningún análisis: el siguiente turno de la sesión debe
+        encontrar este en el contexto.
+        """
+        try:
+            conversation = await self.conversation_service.save_conversation(
+                telegram_id=user_id,
+                session_id=session_id,
+                question=question,
+                answer=answer,
+                total_tokens=total_tokens,
+                execution_time=execution_time
+            )
+        except Exception:
+            logger.exception("Error guardando la conversación")
+            return
+        
+        if conversation and "id" in conversation:
+            _enqueue_analysis(self.conversation_service, self.openai_client, conversation)